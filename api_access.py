@@ -4,8 +4,11 @@ import pandas as pd
 import numpy as np
 import os
 import json
-from keys import OPENAI_API_KEY
+import uuid
+from credential_pool import get_pool, estimate_tokens
+from hedging import get_hedger
 from construction_format import ConstructionFormat, ArrowFormat, QAFormat
+from together_ingest import SOLUTIONS_PATH
 
 class APIAccess:
     """
@@ -14,10 +17,12 @@ class APIAccess:
     Attributes:
         prompt (Prompt): the prompt for which to calculate token probabilities
         parspeed_prompt_df (DataFrame): the prompt as a DataFrame 
+        rendered_prompts (dict): cache of formatted prompts keyed by (format, needs_instruction)
     """
     def __init__(self, prompt):
         self.prompt = prompt
         self.parsed_prompt_df = pd.DataFrame([e.as_dict() for e in self.prompt.examples])
+        self.rendered_prompts = {}
     
     def request(self, model, format, needs_instruction):
         """
@@ -31,16 +36,70 @@ class APIAccess:
             output (openai.openai_object.OpenAIObject): output from OpenAI API
         """
         prompt = self.generate_formatted_prompt(format, needs_instruction, to_togethercomputer=False)
-        openai.api_key = OPENAI_API_KEY
-        output = openai.Completion.create(
+        output = get_pool('OPENAI_API_KEY').call(lambda api_key: openai.Completion.create(
             engine=model,
             prompt=prompt,
             max_tokens=0, 
             logprobs=4,
             echo=True,
-        )
+            api_key=api_key,
+            request_timeout=get_hedger().timeout,
+        ), estimate_tokens(prompt))
         return output
 
+    def request_query_only(self, model, format, needs_instruction):
+        """
+        Query the API with the generated prompt cut off right after the query infix ('\n>' for 'arrow', '\nA: ' for 'qa')
+        and retrieve only the top logprobs for the next token.
+
+        Unlike request(), the prompt is not echoed back, so the size of the response does not depend on the length of the prompt.
+        Only the query (last example) is scored.
+
+        Args:
+            model (str): the OpenAI model to query with generated prompt
+            format (str): the format of the prompt ['arrow', 'qa']
+            needs_instruction (bool): True if need to include instruction in prompt and False otherwise
+        Returns:
+            output (openai.openai_object.OpenAIObject): output from OpenAI API
+        """
+        prompt = self.generate_query_prompt(format, needs_instruction)
+        output = get_pool('OPENAI_API_KEY').call(lambda api_key: openai.Completion.create(
+            engine=model,
+            prompt=prompt,
+            max_tokens=1,
+            temperature=0,
+            logprobs=4,
+            echo=False,
+            api_key=api_key,
+            request_timeout=get_hedger().timeout,
+        ), estimate_tokens(prompt, 1))
+        return output
+
+    def request_stream(self, model, format, needs_instruction, max_tokens=64):
+        """
+        Request a streamed greedy completion of the clarifying prompt (see generate_clarifying_prompt()), so that the response can be
+        classified as it arrives and the stream closed as soon as the outcome is known
+
+        Args:
+            model (str): the OpenAI model to query with generated prompt
+            format (str): the format of the prompt ['arrow', 'qa']
+            needs_instruction (bool): True if need to include instruction in prompt and False otherwise
+            max_tokens (int): the maximum number of tokens to generate
+        Returns:
+            stream (generator): chunks of the completion, each with the new text in ['choices'][0]['text']
+        """
+        prompt = self.generate_clarifying_prompt(format, needs_instruction)
+        stream = get_pool('OPENAI_API_KEY').call(lambda api_key: openai.Completion.create(
+            engine=model,
+            prompt=prompt,
+            max_tokens=max_tokens,
+            temperature=0,
+            stream=True,
+            api_key=api_key,
+            request_timeout=get_hedger().timeout,
+        ), estimate_tokens(prompt, max_tokens))
+        return stream
+
     def generate_data_for_openai_finetuning(self, format, needs_instruction): 
         """
         Skips quering the API and instead creates a file containing information necessary for finetuning the model
@@ -75,6 +134,10 @@ class APIAccess:
         '''
         Skips quering the API and instead creates a file containing information necessary for querying TogetherComputer (t0pp) via Stanford internal API
 
+        Every request (one per example, ending right before its label) carries a unique request_id, and a solution record with the same
+        request_id, the label and the example itself is appended to togethercomputer/for_rebuttal_solutions.jsonl, so that the results
+        can be joined back to their examples by id however often the files were appended to (see together_ingest.py)
+
         Args:
             format (str): the desired format ['arrow', 'qa']
             request_type (str): the type of request to send to t0pp, here always "language-model-inference"
@@ -87,19 +150,27 @@ class APIAccess:
             None
         '''
         prompt_list, solutions = self.generate_formatted_prompt(format, needs_instruction, to_togethercomputer=True)
-        for prompt in prompt_list:
+        prompt_key = uuid.uuid4().hex[:16]
+        requests = []
+        solution_records = []
+        for prompt, solution, example in zip(prompt_list, solutions['solution'], self.prompt.examples):
+            request_id = f"{prompt_key}-{example.example_number}"
             request = {
+                "request_id": request_id,
                 "request_type": request_type, 
                 "model": model, 
                 "prompt": prompt, 
                 "max_tokens": max_tokens, 
                 "logprobs": logprobs
                 }
-            filepath = f"togethercomputer/for_rebuttal.jsonl"
+            requests.append(json.dumps(request) + '\n')
+            solution_records.append(json.dumps({"request_id": request_id, "model": model, "solution": solution, "example": example.as_dict()}) + '\n')
 
-            with open(filepath, 'a+') as f:
-                f.write(json.dumps(request))
-                f.write('\n')
+        # single unbuffered appends, so that the lines of concurrent cells do not interleave
+        with open(f"togethercomputer/for_rebuttal.jsonl", 'ab', buffering=0) as f:
+            f.write(''.join(requests).encode('utf-8'))
+        with open(SOLUTIONS_PATH, 'ab', buffering=0) as f:
+            f.write(''.join(solution_records).encode('utf-8'))
             
         solutions.to_csv(f"togethercomputer/for_rebuttal_solutions.csv", mode='a', header=False)
         
@@ -161,11 +232,16 @@ class APIAccess:
         Returns:
             (str): formatted prompt as a single string for API query
         """
+        if not to_togethercomputer and (format, needs_instruction) in self.rendered_prompts:
+            return self.rendered_prompts[(format, needs_instruction)]
+
         self.format_constructions(format)
         if not to_togethercomputer:
+            formatted_prompt = self.parsed_prompt_df['formatted_construction'].str.cat(sep='\n')
             if needs_instruction:
-                return self.prompt.get_instruction() + '\n' + self.parsed_prompt_df['formatted_construction'].str.cat(sep='\n')
-            return self.parsed_prompt_df['formatted_construction'].str.cat(sep='\n')
+                formatted_prompt = self.prompt.get_instruction() + '\n' + formatted_prompt
+            self.rendered_prompts[(format, needs_instruction)] = formatted_prompt
+            return formatted_prompt
         else:
             construction_list = self.parsed_prompt_df['formatted_construction'].to_list()
             
@@ -184,6 +260,37 @@ class APIAccess:
                 raise ValueError('invalid format')
             return (construction_list, sols)
     
+    def generate_query_prompt(self, format, needs_instruction):
+        """
+        Formats the prompt as in generate_formatted_prompt() but removes the label (and suffix) of the query,
+        so that the prompt ends with the query infix and the next token is the model's answer
+
+        Args:
+            format (str): the desired format ['arrow', 'qa']
+            needs_instruction (bool): True if need to include instruction in prompt and False otherwise
+        Returns:
+            (str): formatted prompt ending with the query infix
+        """
+        prompt = self.generate_formatted_prompt(format, needs_instruction, to_togethercomputer=False)
+        query_label = self.parsed_prompt_df['XY_relabeled'].iloc[-1]
+        suffix = self.get_format_class(format).make_suffix()
+        
+        return prompt[:len(prompt) - len(query_label + suffix)]
+
+    def generate_clarifying_prompt(self, format, needs_instruction):
+        """
+        Formats the prompt as in generate_query_prompt(), preceded by the clarifying assertion of the Prompt, which invites the model
+        to ask a clarifying question instead of answering the query if it is unsure of the task
+
+        Args:
+            format (str): the desired format ['arrow', 'qa']
+            needs_instruction (bool): True if need to include instruction in prompt and False otherwise
+        Returns:
+            (str): the clarifying assertion followed by the formatted prompt ending with the query infix
+        """
+        self.prompt.clarifying_assertion = self.prompt.generate_clarifying_assertion()
+        return self.prompt.get_clarifying_assertion() + self.generate_query_prompt(format, needs_instruction)
+
     def to_numpy_dataframe(self, output):
         """
         Reformat the output of the API into a numpy dataframe
@@ -202,6 +309,30 @@ class APIAccess:
         
         return unpacked_df 
 
+    def to_query_dataframe(self, output):
+        """
+        Reformat the output of request_query_only() into a single-row DataFrame with the same columns as isolate_probs(to_numpy_dataframe(output))
+
+        The 'tokens' column holds the correct label of the query and 'top_logprobs' the top logprobs of the model's next token
+
+        Args:
+            output (openai.openai_object.OpenAIObject): output from request_query_only()
+        Returns:
+            query_df (pd.DataFrame): a DataFrame with one row for the query
+        """
+        top_logprobs = dict(self.query_top_logprobs(output))
+        query_label = self.parsed_prompt_df['XY_relabeled'].iloc[-1]
+        
+        query_df = pd.DataFrame({
+            'tokens': [query_label],
+            'top_logprobs': [top_logprobs],
+            'example_number': [self.parsed_prompt_df['example_number'].iloc[-1]]
+        })
+        return query_df
+
+    def query_top_logprobs(self, output):
+        return output["choices"][0]["logprobs"]["top_logprobs"][0]
+
     def isolate_probs(self, df):
         """
         Removes all columns that are not the tokens and the corresponding probabilities
@@ -211,7 +342,7 @@ class APIAccess:
         Returns:
             df (pd.DataFrame): a dataframe will all superfluous columns removed
         """
-        df.drop(df.columns.difference(['tokens', '%', 'top_logprobs', 'index']), 1, inplace = True)
+        df.drop(df.columns.difference(['tokens', '%', 'token_logprobs', 'top_logprobs', 'index']), 1, inplace = True)
         return df
 
     def save_to_file(self, model, construction_format, construction_type, shots, unpacked_df, iteration=0):
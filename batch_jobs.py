@@ -0,0 +1,324 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from api_access import APIAccess
+from query_pipeline import QueryPipeline, parse_model_specs, PAIRED_FORMATS
+from response_archive import score_record
+from structured_logging import log
+from worker_pool import get_worker_pool
+
+# statuses after which a job does not change any more (as reported by the OpenAI batch API)
+TERMINAL_STATUSES = ['completed', 'failed', 'expired', 'cancelled']
+# settings of a cell which cannot be run as batch requests: they write files or stream completions instead of scoring a prompt
+UNBATCHABLE_SETTINGS = ['togethercomputer', 'for_finetuning', 'clarifying']
+
+def request_body(model, prompt_text, query_only):
+    """
+    Returns the completion request APIAccess.request() (or request_query_only() if query_only) sends for a prompt
+    """
+    if query_only:
+        return {'model': model, 'prompt': prompt_text, 'max_tokens': 1, 'temperature': 0, 'logprobs': 4, 'echo': False}
+    return {'model': model, 'prompt': prompt_text, 'max_tokens': 0, 'logprobs': 4, 'echo': True}
+
+def shard_paths(path, shard):
+    return {name: os.path.join(path, f"{name}_{shard}.jsonl") for name in ['requests', 'records', 'results']}
+
+def write_manifest(path, manifest):
+    temporary_path = os.path.join(path, 'manifest.json.tmp')
+    with open(temporary_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temporary_path, os.path.join(path, 'manifest.json'))
+
+def read_manifest(path):
+    with open(os.path.join(path, 'manifest.json')) as f:
+        return json.load(f)
+
+class ShardedRequestWriter:
+    """
+    Appends batch requests and their records to the current shard, starting a new shard every shard_size requests
+
+    Every request is a line of the OpenAI batch input format ({custom_id, method, url, body}), and its record (a line of
+    records_<k>.jsonl with the same custom_id) holds what is needed to score the response as a ResponseArchive record would:
+    the cell, backend, instruction and examples of the Prompt
+    """
+    def __init__(self, path, shard_size):
+        self.path = path
+        self.shard_size = shard_size
+        self.shards = []
+        self.files = None
+
+    def add(self, custom_id, body, record):
+        if not self.shards or self.shards[-1]['count'] == self.shard_size:
+            self.next_shard()
+        self.files['requests'].write(json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': '/v1/completions', 'body': body}) + '\n')
+        self.files['records'].write(json.dumps(dict(record, custom_id=custom_id)) + '\n')
+        self.shards[-1]['count'] += 1
+
+    def next_shard(self):
+        self.close()
+        shard = len(self.shards)
+        self.shards.append({'shard': shard, 'count': 0, 'job_id': None, 'status': 'written', 'attempts': 0})
+        paths = shard_paths(self.path, shard)
+        self.files = {name: open(paths[name], 'w') for name in ['requests', 'records']}
+
+    def close(self):
+        if self.files:
+            for f in self.files.values():
+                f.close()
+            self.files = None
+
+def write_batch(path, cells, shard_size=50000):
+    """
+    Renders every Prompt of a sweep, for every model and format, as a batch request, without querying any API
+
+    The custom_id of a request ('c<cell>-p<prompt id>-<format>-<model>') only depends on the position of the cell in the sweep,
+    so it is stable across reruns; with a replicate seed (see Tester.replicate_rng()) the prompts are too.
+
+    Layout of the batch directory:
+        manifest.json: the cells and, for each shard, its number of requests and the id, status and attempts of its job
+        requests_<k>.jsonl: the requests of shard k, as uploaded
+        records_<k>.jsonl: the record of every request of shard k (see ShardedRequestWriter)
+        results_<k>.jsonl: the results of shard k, once downloaded (see run_batch())
+
+    Args:
+        path (str): directory of the batch
+        cells (list(dict)): the keyword arguments of Tester.run_test() for every cell (see Tester.sweep_cells())
+        shard_size (int): number of requests per shard (at most 50000 for the OpenAI batch API)
+    Returns:
+        manifest (dict): the contents of manifest.json
+    """
+    # imported here as the tester imports every sweep
+    from tester import replicate_rng
+
+    os.makedirs(path, exist_ok=True)
+    writer = ShardedRequestWriter(path, shard_size)
+    for i, cell in enumerate(cells):
+        for setting in UNBATCHABLE_SETTINGS:
+            if cell.get(setting):
+                raise Exception(f"cells with {setting} cannot be run as a batch job")
+
+        model_specs = parse_model_specs(cell['models'], cell['crfm']) if cell.get('models') else [('crfm' if cell['crfm'] else 'openai', cell['model'])]
+        if any(backend == 'crfm' for backend, _ in model_specs):
+            raise Exception("models on the CRFM API cannot be run as a batch job")
+
+        pipeline = QueryPipeline(cell['construction_type'], cell['shots'], cell['model'], cell['construction_format'], cell['crfm'], models=model_specs)
+        formats = PAIRED_FORMATS if cell.get('paired') else [cell['construction_format']]
+        query_only = cell.get('query_only', False)
+        rng = replicate_rng(cell, cell['replicate'], cell.get('seed')) if cell.get('replicate') is not None else None
+        prompts = pipeline.iter_prompts(cell['queries'], cell['needs_instruction'], cell['needs_informative'], cell['include_ambiguous_examples'], cell['prob_of_ambiguous'],
+                                        False, cell['finetuning_control'], cell.get('salient_task'), cell.get('stratified', False), cell.get('corpus'), cell.get('corpus_start', 0), rng=rng)
+
+        for prompt_id, prompt in prompts:
+            api_access = APIAccess(prompt)
+            examples = [e.as_dict() for e in prompt.get_examples()]
+            for format in formats:
+                prompt_text = pipeline.render(api_access, format, cell['needs_instruction'], query_only)
+                for backend, model in model_specs:
+                    record_cell = {'model': model, 'construction_type': cell['construction_type'], 'format_type': format, 'shots': cell['shots'],
+                                   'salient_task': cell.get('salient_task'), 'needs_instruction': cell['needs_instruction'], 'query_only': query_only}
+                    if cell.get('paired'): record_cell['pair_id'] = f"c{i}-{prompt_id}"
+                    if cell.get('replicate') is not None: record_cell['replicate'] = cell['replicate']
+                    record = {'key': hashlib.sha256(prompt_text.encode('utf-8')).hexdigest(), 'cell': record_cell, 'backend': backend,
+                              'instruction': prompt.get_instruction(), 'examples': examples}
+                    writer.add(f"c{i}-p{prompt_id}-{format}-{model}", request_body(model, prompt_text, query_only), record)
+    writer.close()
+
+    manifest = {'requests': sum(shard['count'] for shard in writer.shards), 'shards': writer.shards}
+    write_manifest(path, manifest)
+    return manifest
+
+class LocalSubmitter:
+    """
+    Stands in for a batch API: runs each submitted shard in a background thread with local models (see local_access.LocalLM),
+    the model of every request being a local checkpoint directory or model name, and writes results in the OpenAI batch output format
+
+    Jobs only live as long as the process: a job id from an earlier run is reported as 'expired', so its shard is submitted again
+    """
+    def __init__(self, batch_size=16):
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, requests_path):
+        job_id = f"local-{len(self.jobs)}-{os.path.basename(requests_path)}"
+        with self.lock:
+            self.jobs[job_id] = self.executor.submit(self.run, requests_path)
+        return job_id
+
+    def poll(self, job_id):
+        with self.lock:
+            future = self.jobs.get(job_id)
+        if future is None:
+            return 'expired'
+        if not future.done():
+            return 'in_progress'
+        return 'failed' if future.exception() else 'completed'
+
+    def download(self, job_id, results_path):
+        with open(results_path, 'w') as f:
+            for result in self.jobs[job_id].result():
+                f.write(json.dumps(result) + '\n')
+
+    def run(self, requests_path):
+        # imported here so that writing and ingesting batches does not require torch
+        from local_access import LocalLM
+
+        with open(requests_path) as f:
+            requests = [json.loads(line) for line in f]
+
+        results = []
+        for start in range(0, len(requests), self.batch_size):
+            batch = requests[start:start + self.batch_size]
+            # requests are written model by model within a prompt, so consecutive requests of one model are scored together
+            for model in dict.fromkeys(request['body']['model'] for request in batch):
+                model_requests = [request for request in batch if request['body']['model'] == model]
+                lm = LocalLM.get(model)
+                echoed = [request for request in model_requests if request['body']['echo']]
+                outputs = dict(zip((request['custom_id'] for request in echoed), lm.score_batch([request['body']['prompt'] for request in echoed])))
+                for request in model_requests:
+                    if not request['body']['echo']:
+                        outputs[request['custom_id']] = lm.score_next_token(request['body']['prompt'])
+                    results.append({'custom_id': request['custom_id'], 'response': {'status_code': 200, 'body': outputs[request['custom_id']]}, 'error': None})
+        return results
+
+class OpenAISubmitter:
+    """
+    Submits shards to the OpenAI batch API over HTTP: uploads the requests file, creates a batch on /v1/completions and,
+    once it is completed, downloads its output file (followed by its error file, if any)
+    """
+    url = "https://api.openai.com/v1"
+
+    def __init__(self, completion_window='24h'):
+        # imported here so that the local submitter does not require an OpenAI key
+        import requests
+        from keys import OPENAI_API_KEY
+        self.completion_window = completion_window
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f"Bearer {OPENAI_API_KEY}"
+
+    def call(self, method, endpoint, **kwargs):
+        response = self.session.request(method, self.url + endpoint, timeout=600, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def submit(self, requests_path):
+        with open(requests_path, 'rb') as f:
+            input_file = self.call('POST', '/files', files={'file': f}, data={'purpose': 'batch'}).json()
+        batch = self.call('POST', '/batches', json={'input_file_id': input_file['id'], 'endpoint': '/v1/completions', 'completion_window': self.completion_window}).json()
+        return batch['id']
+
+    def poll(self, job_id):
+        return self.call('GET', f"/batches/{job_id}").json()['status']
+
+    def download(self, job_id, results_path):
+        batch = self.call('GET', f"/batches/{job_id}").json()
+        with open(results_path, 'wb') as f:
+            for file_id in [batch.get('output_file_id'), batch.get('error_file_id')]:
+                if file_id:
+                    with self.session.get(f"{self.url}/files/{file_id}/content", stream=True, timeout=600) as response:
+                        response.raise_for_status()
+                        for block in response.iter_content(chunk_size=1 << 20):
+                            f.write(block)
+
+SUBMITTERS = {'openai': OpenAISubmitter, 'local': LocalSubmitter}
+
+def run_batch(path, submitter, poll_seconds=60, retries=2):
+    """
+    Submits every shard of a batch which has no results yet and polls the jobs until each has finished, downloading the results of
+    every completed job; a job which fails or expires is submitted again, up to retries times
+
+    The manifest is updated after every change, so an interrupted run resumes where it stopped: jobs already submitted are polled
+    instead of being submitted again.
+
+    Args:
+        path (str): directory of the batch (see write_batch())
+        submitter (LocalSubmitter or OpenAISubmitter): the batch API
+        poll_seconds (int): seconds to wait between two rounds of polling
+        retries (int): number of times a failed shard is submitted again
+    Returns:
+        manifest (dict): the contents of manifest.json
+    """
+    manifest = read_manifest(path)
+    while True:
+        pending = 0
+        for shard in manifest['shards']:
+            if shard['status'] == 'downloaded' or (shard['status'] in TERMINAL_STATUSES and shard['attempts'] > retries):
+                continue
+
+            paths = shard_paths(path, shard['shard'])
+            if shard['job_id'] is None or shard['status'] in TERMINAL_STATUSES[1:]:
+                if shard['job_id'] is not None:
+                    log(logging.WARNING, 'resubmitting batch shard', shard=shard['shard'], job_id=shard['job_id'], status=shard['status'])
+                shard['job_id'] = submitter.submit(paths['requests'])
+                shard['status'] = 'submitted'
+                shard['attempts'] += 1
+            else:
+                shard['status'] = submitter.poll(shard['job_id'])
+                if shard['status'] == 'completed':
+                    submitter.download(shard['job_id'], paths['results'])
+                    shard['status'] = 'downloaded'
+                    log(logging.INFO, 'batch shard downloaded', shard=shard['shard'], job_id=shard['job_id'], requests=shard['count'])
+                elif shard['status'] in TERMINAL_STATUSES and shard['attempts'] > retries:
+                    log(logging.ERROR, 'batch shard failed', shard=shard['shard'], job_id=shard['job_id'], status=shard['status'])
+
+            write_manifest(path, manifest)
+            if shard['status'] != 'downloaded' and not (shard['status'] in TERMINAL_STATUSES and shard['attempts'] > retries):
+                pending += 1
+
+        if not pending:
+            return manifest
+        time.sleep(poll_seconds)
+
+def score_shard(path, shard):
+    """
+    Joins the downloaded results of a shard to their records by custom_id and scores every response as a replayed archive record
+
+    Returns:
+        shard_df (pd.DataFrame): the result rows of the shard, in the order of the results file
+    """
+    paths = shard_paths(path, shard)
+    records = {}
+    with open(paths['records']) as f:
+        for line in f:
+            record = json.loads(line)
+            records[record['custom_id']] = record
+
+    scored = []
+    errors = 0
+    with open(paths['results']) as f:
+        for line in f:
+            result = json.loads(line)
+            response = result.get('response') or {}
+            record = records.pop(result['custom_id'], None)
+            if record is None:
+                continue
+            if result.get('error') or response.get('status_code') != 200:
+                errors += 1
+                continue
+            record['response'] = response['body']
+            scored.append(score_record(record))
+
+    if errors or records:
+        log(logging.WARNING, 'batch requests without a result', shard=shard, errors=errors, missing=len(records))
+    return pd.concat(scored, ignore_index=True) if scored else pd.DataFrame()
+
+def collect_batch(path, workers=None):
+    """
+    Scores the downloaded results of every shard of a batch across the worker pool (see worker_pool.py)
+
+    Args:
+        path (str): directory of the batch
+        workers (int): number of worker processes, if the worker pool is not started yet (defaults to the number of CPUs)
+    Returns:
+        all_tests (pd.DataFrame): the result rows of every shard, in shard order
+    """
+    shards = [shard['shard'] for shard in read_manifest(path)['shards'] if shard['status'] == 'downloaded']
+    scored = get_worker_pool(workers).map_frames(score_shard, [path] * len(shards), shards)
+
+    return pd.concat(scored, ignore_index=True) if scored else pd.DataFrame()
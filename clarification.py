@@ -0,0 +1,79 @@
+import time
+
+RESPONSE_TYPES = ['X', 'Y', 'question', 'other']
+
+def classify_response(text, finished):
+    """
+    Classifies a (possibly partial) completion of a clarifying prompt as soon as its outcome is decided
+
+    A completion starting with the label 'X' or 'Y' (as a whole word) is a direct answer. Any other completion is a clarifying
+    question once it contains a '?', and something else once its first line ends (or the completion ends) without one.
+
+    Args:
+        text (str): the completion received so far
+        finished (bool): True if the completion has ended
+    Returns:
+        response_type (str): one of RESPONSE_TYPES, or None if more text is needed to decide
+    """
+    stripped = text.lstrip()
+    if not stripped:
+        return 'other' if finished else None
+
+    if stripped[0] in ('X', 'Y'):
+        if len(stripped) == 1:
+            return stripped if finished else None
+        if not stripped[1].isalnum():
+            return stripped[0]
+
+    if '?' in stripped:
+        return 'question'
+    if '\n' in stripped or finished:
+        return 'other'
+    return None
+
+def consume_stream(stream):
+    """
+    Reads a completion stream (see APIAccess.request_stream()) until its outcome is decided, then closes it so that no further
+    tokens are generated or transferred
+
+    Args:
+        stream (iterable(dict)): chunks with the new text in ['choices'][0]['text']
+    Returns:
+        outcome (dict): 'response_type' (one of RESPONSE_TYPES), 'response' (the text read), 'chunks' (number of chunks read)
+        and 'decision_seconds' (time from the request to the decision, including the time to the first chunk)
+    """
+    start = time.perf_counter()
+    text = ""
+    chunks = 0
+    response_type = None
+    try:
+        for chunk in stream:
+            text += chunk['choices'][0]['text']
+            chunks += 1
+            response_type = classify_response(text, finished=False)
+            if response_type is not None:
+                break
+    finally:
+        if hasattr(stream, 'close'):
+            stream.close()
+
+    if response_type is None:
+        response_type = classify_response(text, finished=True)
+
+    return {'response_type': response_type, 'response': text, 'chunks': chunks, 'decision_seconds': time.perf_counter() - start}
+
+def clarification_summary(test_df):
+    """
+    Summarizes the outcomes of a clarifying run per model, salient task and format
+
+    Args:
+        test_df (pd.DataFrame): result rows of a clarifying run (see QueryPipeline.stream_clarifying())
+    Returns:
+        summary_df (pd.DataFrame): the share of each response type, the accuracy of the direct answers and the mean decision time
+    """
+    groups = test_df.groupby(['model', 'salient_task', 'format_type'], dropna=False)
+    summary_df = groups['response_type'].value_counts(normalize=True).unstack(fill_value=0).reindex(columns=RESPONSE_TYPES, fill_value=0)
+    summary_df['answer_accuracy'] = groups.apply(lambda df: df.loc[df['response_type'].isin(['X', 'Y']), 'accurate'].mean())
+    summary_df['decision_seconds'] = groups['decision_seconds'].mean()
+    summary_df['prompts'] = groups.size()
+    return summary_df.reset_index()
@@ -0,0 +1,288 @@
+import itertools
+import os
+import numpy as np
+import pandas as pd
+from logprob_tensor import load_results, LOGPROB_COLUMNS
+
+# every comparison is made separately for each of these groups
+GROUP_KEYS = ['salient_task', 'format_type', 'example_number']
+# the rows of two conditions are paired on these columns (those present in both), on top of the group keys
+PAIR_KEYS = ['construction_type', 'shots', 'replicate', 'prompt_id']
+# number of groups resampled in one task
+GROUPS_PER_TASK = 64
+# number of resampled values held in memory at once by a task
+BLOCK_VALUES = 2 ** 22
+
+def resample_means(values, draws, rng):
+    """
+    Returns the means of draws bootstrap resamples of every row of values, (groups, n) -> (draws, groups)
+    """
+    indices = rng.integers(0, values.shape[1], size=(draws,) + values.shape)
+    return np.take_along_axis(np.broadcast_to(values, indices.shape), indices, axis=2).mean(axis=2)
+
+def blocks(resamples, values_per_resample):
+    # splits the resamples so that at most BLOCK_VALUES values are held at once
+    block = max(1, BLOCK_VALUES // max(values_per_resample, 1))
+    return [min(block, resamples - start) for start in range(0, resamples, block)]
+
+def paired_statistics(values_a, values_b, resamples, rng):
+    """
+    Resamples the mean paired difference of every group: under the null hypothesis the sign of every difference is flipped at
+    random (permutation test), and the pairs are drawn with replacement (bootstrap)
+
+    Args:
+        values_a, values_b (np.ndarray): (groups, n) the paired values of every group
+    Returns:
+        (tuple(np.ndarray, np.ndarray)): (resamples, groups) the permuted and the bootstrapped mean differences
+    """
+    differences = values_a - values_b
+    groups, n = differences.shape
+    if is_binary(values_a) and is_binary(values_b):
+        # differences are -1, 0 or 1: only the counts of each are resampled
+        plus = (differences > 0).sum(axis=1)
+        minus = (differences < 0).sum(axis=1)
+        flipped = rng.binomial(plus + minus, 0.5, size=(resamples, groups))
+        bootstrap_plus = rng.binomial(n, plus / n, size=(resamples, groups))
+        bootstrap_minus = rng.binomial(n - bootstrap_plus, np.divide(minus, n - plus, out=np.zeros(groups), where=n > plus))
+        return (2 * flipped - plus - minus) / n, (bootstrap_plus - bootstrap_minus) / n
+
+    permuted = []
+    bootstrapped = []
+    for draws in blocks(resamples, groups * n):
+        signs = rng.integers(0, 2, size=(draws, groups, n)) * 2 - 1
+        permuted.append((signs * differences).mean(axis=2))
+        bootstrapped.append(resample_means(differences, draws, rng))
+    return np.concatenate(permuted), np.concatenate(bootstrapped)
+
+def unpaired_statistics(values_a, values_b, resamples, rng):
+    """
+    Resamples the difference of the means of every group: under the null hypothesis the values of both conditions are pooled and
+    split at random into samples of the original sizes (permutation test), and each condition is drawn with replacement (bootstrap)
+
+    Args:
+        values_a (np.ndarray): (groups, n_a) the values of the first condition in every group
+        values_b (np.ndarray): (groups, n_b) the values of the second condition in every group
+    Returns:
+        (tuple(np.ndarray, np.ndarray)): (resamples, groups) the permuted and the bootstrapped differences of the means
+    """
+    groups, n_a = values_a.shape
+    n_b = values_b.shape[1]
+    if is_binary(values_a) and is_binary(values_b):
+        # the number of ones drawn into the first sample is hypergeometric, and the ones of a bootstrap sample binomial
+        ones_a = values_a.sum(axis=1).astype(np.int64)
+        ones = ones_a + values_b.sum(axis=1).astype(np.int64)
+        drawn = rng.hypergeometric(ones, n_a + n_b - ones, n_a, size=(resamples, groups))
+        permuted = drawn / n_a - (ones - drawn) / n_b
+        bootstrapped = rng.binomial(n_a, ones_a / n_a, size=(resamples, groups)) / n_a - rng.binomial(n_b, (ones - ones_a) / n_b, size=(resamples, groups)) / n_b
+        return permuted, bootstrapped
+
+    pooled = np.concatenate([values_a, values_b], axis=1)
+    total = pooled.sum(axis=1)
+    permuted = []
+    bootstrapped = []
+    for draws in blocks(resamples, groups * (n_a + n_b)):
+        sum_a = rng.permuted(np.broadcast_to(pooled, (draws,) + pooled.shape), axis=2)[:, :, :n_a].sum(axis=2)
+        permuted.append(sum_a / n_a - (total - sum_a) / n_b)
+        bootstrapped.append(resample_means(values_a, draws, rng) - resample_means(values_b, draws, rng))
+    return np.concatenate(permuted), np.concatenate(bootstrapped)
+
+def is_binary(values):
+    return bool(np.isin(values, (0, 1)).all())
+
+def compare_groups(groups, values_a, values_b, paired, resamples, confidence, seed):
+    """
+    Tests the difference between two conditions in every group of a chunk (run in the worker pool, see compare_conditions())
+
+    Args:
+        groups (list(tuple)): the group keys of every group
+        values_a, values_b (np.ndarray): (groups, n_a) and (groups, n_b) the metric values of each condition in every group
+            (aligned pairs if paired)
+        paired (bool): True to test the paired differences
+        resamples (int): number of permutations and of bootstrap resamples
+        confidence (float): level of the bootstrap interval of the difference
+        seed (np.random.SeedSequence): the random stream of the chunk
+    Returns:
+        (pd.DataFrame): one row per group (see compare_conditions())
+    """
+    rng = np.random.default_rng(seed)
+    means_a = values_a.mean(axis=1)
+    means_b = values_b.mean(axis=1)
+    observed = means_a - means_b
+    if paired:
+        permuted, bootstrapped = paired_statistics(values_a, values_b, resamples, rng)
+    else:
+        permuted, bootstrapped = unpaired_statistics(values_a, values_b, resamples, rng)
+
+    # two-sided, counting the observed difference as one of the permutations (so that p is never 0)
+    extreme = (np.abs(permuted) >= np.abs(observed) - 1e-12).sum(axis=0)
+    alpha = 1 - confidence
+    comparison_df = pd.DataFrame(list(groups), columns=GROUP_KEYS)
+    comparison_df['n_a'] = values_a.shape[1]
+    comparison_df['n_b'] = values_b.shape[1]
+    comparison_df['mean_a'] = means_a
+    comparison_df['mean_b'] = means_b
+    comparison_df['difference'] = observed
+    comparison_df['ci_low'] = np.quantile(bootstrapped, alpha / 2, axis=0)
+    comparison_df['ci_high'] = np.quantile(bootstrapped, 1 - alpha / 2, axis=0)
+    comparison_df['p_value'] = (extreme + 1) / (resamples + 1)
+    return comparison_df
+
+def holm(p_values):
+    """
+    Returns the Holm-Bonferroni adjusted p-values (controlling the family-wise error rate)
+    """
+    p_values = np.asarray(p_values, dtype=float)
+    m = len(p_values)
+    order = np.argsort(p_values)
+    adjusted = np.empty(m)
+    adjusted[order] = np.minimum(np.maximum.accumulate((m - np.arange(m)) * p_values[order]), 1)
+    return adjusted
+
+def benjamini_hochberg(p_values):
+    """
+    Returns the Benjamini-Hochberg adjusted p-values (controlling the false discovery rate)
+    """
+    p_values = np.asarray(p_values, dtype=float)
+    m = len(p_values)
+    order = np.argsort(p_values)
+    adjusted = np.empty(m)
+    adjusted[order] = np.minimum(np.minimum.accumulate((m / np.arange(1, m + 1) * p_values[order])[::-1])[::-1], 1)
+    return adjusted
+
+CORRECTIONS = {'holm': holm, 'bh': benjamini_hochberg}
+
+def group_values(tests_a, tests_b, metric, paired):
+    """
+    Splits the metric values of two conditions by group (GROUP_KEYS), pairing their rows on the group and pair keys if paired
+    (the rows of each condition must then be unique on those keys)
+
+    Returns:
+        (tuple(list(tuple), list(np.ndarray), list(np.ndarray))): the keys and the values of each condition of every group found
+        in both conditions
+    """
+    if paired:
+        keys = GROUP_KEYS + [key for key in PAIR_KEYS if key in tests_a.columns and key in tests_b.columns]
+        # rows which share their keys would be paired with every row of the other condition sharing them
+        for tests in (tests_a, tests_b):
+            if tests.duplicated(keys).any():
+                raise Exception(f"paired rows must be unique on {', '.join(keys)}: compare one model per condition (see conditions_by())")
+        merged = tests_a[keys + [metric]].merge(tests_b[keys + [metric]], on=keys, how='inner', suffixes=('_a', '_b'), validate='one_to_one')
+        merged = merged.dropna(subset=[metric + '_a', metric + '_b'])
+        grouped = [(key, group[metric + '_a'].to_numpy(float), group[metric + '_b'].to_numpy(float)) for key, group in merged.groupby(GROUP_KEYS, dropna=False)]
+    else:
+        grouped_b = {key: group[metric].dropna().to_numpy(float) for key, group in tests_b.groupby(GROUP_KEYS, dropna=False)}
+        grouped = [(key, group[metric].dropna().to_numpy(float), grouped_b.get(key)) for key, group in tests_a.groupby(GROUP_KEYS, dropna=False)]
+    grouped = [(key, a, b) for key, a, b in grouped if b is not None and len(a) and len(b)]
+    return [key for key, _, _ in grouped], [a for _, a, _ in grouped], [b for _, _, b in grouped]
+
+def compare_conditions(conditions, metric='accurate', paired=False, resamples=10000, confidence=0.95, correction='holm', family=None, seed=None, pool=None):
+    """
+    Compares every pair of conditions (models, finetuning conditions, ...) separately in every (salient_task, format_type,
+    example_number) group: a permutation test of the difference of the means, a bootstrap interval of the difference, and
+    p-values adjusted for multiple comparisons
+
+    The resampling is vectorized over the resamples and the groups of a chunk (groups of the same sizes), and the chunks of every
+    pair of conditions are spread over the worker pool (see worker_pool.py) if one is given. For 0/1 metrics such as 'accurate',
+    only the counts of ones are resampled, drawn from their exact (hypergeometric or binomial) distributions.
+
+    Args:
+        conditions (dict(str, pd.DataFrame or ResultStore)): the results of every condition, by name, e.g.
+            {'control': control_df, 'ambiguous': ambig_df} (see Visualizer.plot_individual_finetuning_performance_for_heldout())
+        metric (str): the result column to compare, e.g. 'accurate' or '%'
+        paired (bool): True if the conditions scored the same Prompts (e.g. several models of one run), whose rows are paired on
+            their keys (GROUP_KEYS and PAIR_KEYS); False to compare independent samples
+        resamples (int): number of permutations and of bootstrap resamples of every test
+        confidence (float): level of the bootstrap interval of the difference
+        correction (str): 'holm' (family-wise error rate), 'bh' (false discovery rate) or None
+        family (list(str)): the columns of the result whose values delimit a family of tests for the correction, e.g.
+            ['condition_a', 'condition_b'] to correct every pair of conditions separately (None for one family of every test)
+        seed (int): seed of the resampling (None for a random one)
+        pool (WorkerPool): the pool in which to resample (None to resample in this process)
+    Returns:
+        comparison_df (pd.DataFrame): one row per pair of conditions and group, with the number of values and the mean of each
+        condition, the difference (a - b), its bootstrap interval (ci_low, ci_high), p_value, p_adjusted and significant
+        (p_adjusted below 1 - confidence)
+    """
+    if correction is not None and correction not in CORRECTIONS:
+        raise Exception("invalid correction")
+    names = list(conditions)
+    frames = {}
+    for name in names:
+        available = set(conditions[name].columns)
+        # '%' and 'accurate' can be derived from the logprob columns
+        if set(LOGPROB_COLUMNS).issubset(available):
+            available |= {'%', 'accurate'}
+        if metric not in available:
+            raise Exception(f"results of {name} have no {metric} column")
+        frames[name] = load_results(conditions[name], [column for column in GROUP_KEYS + PAIR_KEYS + [metric] if column in available])
+        missing = [key for key in GROUP_KEYS if key not in frames[name].columns]
+        if missing:
+            raise Exception(f"results of {name} have no {', '.join(missing)} column")
+        # without the Prompt of every row, rows of the same group could only be paired by position
+        if paired and 'prompt_id' not in frames[name].columns:
+            raise Exception(f"results of {name} have no prompt_id column, so they cannot be compared pair by pair")
+
+    pairs = []
+    tasks = []
+    for name_a, name_b in itertools.combinations(names, 2):
+        groups, values_a, values_b = group_values(frames[name_a], frames[name_b], metric, paired)
+        # groups of the same sizes are resampled together, as the rows of one matrix
+        sizes = {}
+        for i in range(len(groups)):
+            sizes.setdefault((len(values_a[i]), len(values_b[i])), []).append(i)
+        for indices in sizes.values():
+            for start in range(0, len(indices), GROUPS_PER_TASK):
+                chunk = indices[start:start + GROUPS_PER_TASK]
+                pairs.append((name_a, name_b))
+                tasks.append(([groups[i] for i in chunk], np.stack([values_a[i] for i in chunk]), np.stack([values_b[i] for i in chunk])))
+
+    seeds = np.random.SeedSequence(seed).spawn(len(tasks))
+    arguments = [[task[i] for task in tasks] for i in range(3)] + [[paired] * len(tasks), [resamples] * len(tasks), [confidence] * len(tasks), seeds]
+    if pool is None:
+        results = [compare_groups(*task_arguments) for task_arguments in zip(*arguments)]
+    else:
+        results = pool.map_frames(compare_groups, *arguments)
+    if not results:
+        return pd.DataFrame()
+
+    comparison_df = pd.concat([result.assign(condition_a=name_a, condition_b=name_b, pair=names.index(name_a) * len(names) + names.index(name_b))
+                               for result, (name_a, name_b) in zip(results, pairs)], ignore_index=True)
+    comparison_df = comparison_df.sort_values(['pair'] + GROUP_KEYS, kind='stable', ignore_index=True)
+    comparison_df = comparison_df[['condition_a', 'condition_b'] + [column for column in comparison_df.columns if column not in ('condition_a', 'condition_b', 'pair')]]
+
+    if correction is None:
+        comparison_df['p_adjusted'] = comparison_df['p_value']
+    elif family is None:
+        comparison_df['p_adjusted'] = CORRECTIONS[correction](comparison_df['p_value'])
+    else:
+        comparison_df['p_adjusted'] = comparison_df.groupby(family, dropna=False)['p_value'].transform(CORRECTIONS[correction])
+    comparison_df['significant'] = comparison_df['p_adjusted'] < 1 - confidence
+    return comparison_df
+
+def open_results(path):
+    """
+    Opens the results saved at path: a result store directory (see result_store.py), a Parquet file or a CSV file
+    """
+    if os.path.isdir(path):
+        from result_store import ResultStore
+        return ResultStore(path)
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+def conditions_by(tests, column='model'):
+    """
+    Splits results into one condition per value of column, e.g. the models scored in one run
+
+    Returns:
+        (dict(str, pd.DataFrame or ResultStore)): the results of every value of column
+    """
+    if column not in tests.columns:
+        raise Exception(f"results without a {column} column cannot be split into conditions")
+    if isinstance(tests, pd.DataFrame):
+        return {value: group for value, group in tests.groupby(column)}
+    from result_store import PARTITION_COLUMNS
+    # a result store is filtered on a partition column without reading the other columns; on any other column its rows are split
+    if column in PARTITION_COLUMNS:
+        return {value: tests.filter(**{column: value}) for value in tests.read([column])[column].dropna().unique()}
+    return {value: group for value, group in tests.read().groupby(column)}
@@ -0,0 +1,257 @@
+import re
+import pandas as pd
+from api_access import APIAccess
+from prompt import Prompt
+from query_pipeline import parse_model_specs, PAIRED_FORMATS
+
+# (USD per 1K tokens, context window in tokens) of the OpenAI models used in the paper, and of their completion-API successor
+MODEL_LIMITS = {
+    'davinci': (0.02, 2049),
+    'text-davinci-002': (0.02, 4097),
+    'text-davinci-003': (0.02, 4097),
+    'curie': (0.002, 2049),
+    'babbage': (0.0005, 2049),
+    'ada': (0.0004, 2049),
+    'gpt-3.5-turbo-instruct': (0.0015, 4096),
+}
+# finetuned models are billed at a higher rate, e.g. 'davinci:ft-personal-2022-11-01'
+FINETUNED_PRICES = {
+    'davinci': 0.12,
+    'curie': 0.012,
+    'babbage': 0.0024,
+    'ada': 0.0016,
+}
+DEFAULT_LIMITS = (0.02, 2049)
+# completion tokens are billed at the prompt rate, except for the models listed here (USD per 1K tokens)
+COMPLETION_PRICES = {
+    'gpt-3.5-turbo-instruct': 0.002,
+}
+# tokens generated for every clarifying request at most (see QueryPipeline.stream_clarifying()), the stream being closed as soon as
+# its outcome is decided: the plan counts them all, as an upper bound
+CLARIFYING_MAX_TOKENS = 64
+
+# approximates GPT-2/GPT-3 pre-tokenization, which splits text before byte-pair encoding
+GPT_PRETOKENIZER = re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?[A-Za-z]+| ?[0-9]+| ?[^\sA-Za-z0-9]+|\s+(?!\S)|\s+""")
+
+def get_tokenizer(name):
+    """
+    Returns a function counting the tokens of a string
+
+    Args:
+        name (str): 'approx' to count GPT-2 pre-tokenization pieces (most words of AmbiBench are a single BPE token),
+            'tiktoken:<encoding>' (e.g. 'tiktoken:p50k_base') or 'hf:<path or model name>' for a transformers tokenizer
+    Returns:
+        count_tokens (function): str -> int
+    """
+    if name == 'approx':
+        return lambda text: len(GPT_PRETOKENIZER.findall(text))
+
+    kind, _, encoding = name.partition(':')
+    if kind == 'tiktoken':
+        import tiktoken
+        tokenizer = tiktoken.get_encoding(encoding)
+        return lambda text: len(tokenizer.encode(text))
+    if kind == 'hf':
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(encoding)
+        return lambda text: len(tokenizer(text)['input_ids'])
+
+    raise Exception("invalid tokenizer")
+
+class TokenBudgetPlanner:
+    """
+    Plans a sweep without querying the API: counts the requests, prompt tokens, cost and wall-clock time it would take
+    and flags cells whose prompts may not fit in the context window of the model
+
+    Prompts are rendered exactly as they would be sent (APIAccess.generate_formatted_prompt(), generate_query_prompt() or
+    generate_clarifying_prompt()), and the tokens generated for each request (one for query-only requests, up to
+    CLARIFYING_MAX_TOKENS for clarifying ones) are priced at the completion rate of the model.
+    Token counts are cached per line: a prompt consists of an instruction line and one line per example, drawn from the
+    small vocabulary of the generators, so after a few prompts nearly every line is already counted. As GPT-style tokenizers
+    split text at line breaks before merging tokens, the sum of the line counts equals the count of the whole prompt.
+
+    Cells sharing the same prompt settings (construction_type, format, shots, salient_task, instruction, query_only and clarifying)
+    are only sampled once, so planning a grid costs O(distinct settings x samples) rather than O(prompts). Given a worker pool
+    (see worker_pool.py), the settings are sampled in its processes, one task per setting.
+
+    Attributes:
+        count_tokens (function): str -> int, the tokenizer (see get_tokenizer())
+        samples (int): number of prompts rendered for each distinct setting
+        requests_per_minute (int): rate limit on requests
+        tokens_per_minute (int): rate limit on tokens
+        tokenizer (str): the name count_tokens was built from (see get_tokenizer()), needed to sample in a worker pool
+        line_tokens (dict): cache of token counts per line
+    """
+    def __init__(self, count_tokens, samples=20, requests_per_minute=3000, tokens_per_minute=250000, tokenizer=None):
+        self.count_tokens = count_tokens
+        self.tokenizer = tokenizer
+        self.samples = samples
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.line_tokens = {}
+
+    def count_prompt_tokens(self, text):
+        lines = text.split('\n')
+        total = 0
+        for i, line in enumerate(lines):
+            if i < len(lines) - 1:
+                line += '\n'
+            if line not in self.line_tokens:
+                self.line_tokens[line] = self.count_tokens(line)
+            total += self.line_tokens[line]
+        return total
+
+    def sample_setting(self, cell):
+        """
+        Renders sample prompts for the settings of a cell
+
+        Args:
+            cell (dict): the keyword arguments of Tester.run_test()
+        Returns:
+            (tuple(float, int, int)): the mean and maximum token count of the sampled prompts, and an upper bound on the
+            token count of any prompt with these settings (longest sampled instruction + shots x longest sampled example)
+        """
+        counts = []
+        longest_instruction = 0
+        longest_example = 0
+        for _ in range(self.samples):
+            prompt = Prompt(shots=cell['shots'], construction_type=cell['construction_type'], format_type=cell['construction_format'], needs_instruction=cell['needs_instruction'],
+                            needs_informative=cell['needs_informative'], include_ambiguous_examples=cell['include_ambiguous_examples'], prob_of_ambiguous=cell['prob_of_ambiguous'],
+                            for_finetuning=cell['for_finetuning'], finetuning_control=cell['finetuning_control'], salient_task=cell['salient_task'])
+            api_access = APIAccess(prompt)
+            if cell.get('clarifying'):
+                text = api_access.generate_clarifying_prompt(cell['construction_format'], cell['needs_instruction'])
+            elif cell.get('query_only'):
+                text = api_access.generate_query_prompt(cell['construction_format'], cell['needs_instruction'])
+            else:
+                text = api_access.generate_formatted_prompt(cell['construction_format'], cell['needs_instruction'], to_togethercomputer=False)
+            counts.append(self.count_prompt_tokens(text))
+
+            if cell['needs_instruction']:
+                longest_instruction = max(longest_instruction, self.count_prompt_tokens(prompt.get_instruction() + '\n'))
+            for formatted_construction in api_access.parsed_prompt_df['formatted_construction']:
+                longest_example = max(longest_example, self.count_prompt_tokens(formatted_construction + '\n'))
+
+        bound = longest_instruction + len(prompt.get_examples()) * longest_example
+        if cell.get('clarifying'):
+            bound += self.count_prompt_tokens(prompt.get_clarifying_assertion())
+        return sum(counts) / len(counts), max(counts), bound
+
+    def plan(self, cells, cooldown=0, pool=None):
+        """
+        Plans every cell of a sweep
+
+        Args:
+            cells (list(dict)): the keyword arguments of Tester.run_test() for every cell (see Tester.sweep_cells())
+            cooldown (int): seconds the sweep waits after each cell
+            pool (WorkerPool): the pool in which to sample the settings (None to sample them in this process)
+        Returns:
+            plan_df (pd.DataFrame): one row per distinct setting and model with the number of cells, prompts and requests,
+            the mean/max/bound prompt tokens, completion tokens, total tokens, estimated cost and whether the bound (with the
+            completion) exceeds the context window
+        """
+        settings = {}
+        for cell in cells:
+            models = parse_model_specs(cell['models'], cell['crfm']) if cell.get('models') else [('crfm' if cell['crfm'] else 'openai', cell['model'])]
+            offline = cell['for_finetuning'] or cell['togethercomputer']
+            # paired cells send every Prompt in each format
+            for construction_format in (PAIRED_FORMATS if cell.get('paired') else [cell['construction_format']]):
+                key = (cell['construction_type'], construction_format, cell['shots'], cell['salient_task'], cell['needs_instruction'],
+                       cell['needs_informative'], bool(cell.get('query_only')), bool(cell.get('clarifying')), offline)
+                if key not in settings:
+                    settings[key] = {'cell': dict(cell, construction_format=construction_format), 'cells': 0, 'prompts': 0, 'models': models}
+                settings[key]['cells'] += 1
+                settings[key]['prompts'] += cell['queries']
+
+        setting_cells = [setting['cell'] for setting in settings.values()]
+        if pool is None:
+            sampled = [self.sample_setting(cell) for cell in setting_cells]
+        else:
+            if self.tokenizer is None:
+                raise Exception("sampling in a worker pool needs the name of the tokenizer")
+            frames = pool.map_frames(sample_settings, [self.tokenizer] * len(setting_cells), [self.samples] * len(setting_cells), [[cell] for cell in setting_cells])
+            sampled = [row for frame in frames for row in frame.itertuples(index=False)]
+
+        rows = []
+        for (key, setting), (mean_tokens, max_tokens, bound_tokens) in zip(settings.items(), sampled):
+            offline = key[-1]
+            for backend, model in setting['models']:
+                price, context = model_limits(model)
+                completion_price = COMPLETION_PRICES.get(model.split(':')[0], price)
+                # local models only cost compute time
+                if backend == 'local': price = completion_price = 0
+                requests = 0 if offline else setting['prompts']
+                # query-only requests generate one token on top of the prompt, clarifying requests a whole completion
+                generated = CLARIFYING_MAX_TOKENS if key[7] else (1 if key[6] else 0)
+                prompt_tokens = requests * mean_tokens
+                completion_tokens = requests * generated
+                total_tokens = prompt_tokens + completion_tokens
+                rows.append({
+                    'construction_type': key[0], 'format_type': key[1], 'shots': key[2], 'salient_task': key[3], 'backend': backend, 'model': model,
+                    'cells': setting['cells'], 'prompts': setting['prompts'], 'requests': requests,
+                    'mean_prompt_tokens': mean_tokens, 'max_prompt_tokens': max_tokens, 'bound_prompt_tokens': bound_tokens,
+                    'completion_tokens': completion_tokens, 'total_tokens': total_tokens,
+                    'cost': (prompt_tokens * price + completion_tokens * completion_price) / 1000,
+                    'exceeds_context': bound_tokens + generated > context
+                })
+
+        plan_df = pd.DataFrame(rows)
+        plan_df.attrs['minutes'] = self.estimate_minutes(plan_df, cooldown * len(cells))
+        return plan_df
+
+    def estimate_minutes(self, plan_df, cooldown_seconds):
+        """
+        Estimates the wall-clock time of the sweep: the slower of the request and token rate limits of the API models, plus the cooldowns between cells
+        """
+        if plan_df.empty:
+            return cooldown_seconds / 60
+        api_df = plan_df[plan_df['backend'] != 'local']
+        rate_limited = max(api_df['requests'].sum() / self.requests_per_minute, api_df['total_tokens'].sum() / self.tokens_per_minute)
+        return rate_limited + cooldown_seconds / 60
+
+# the planner of a worker process for every (tokenizer, samples), kept across tasks with its cache of line token counts
+worker_planners = {}
+
+def sample_settings(tokenizer, samples, cells):
+    """
+    Samples the settings of cells in a worker process (see TokenBudgetPlanner.plan())
+
+    Returns:
+        (pd.DataFrame): the mean_tokens, max_tokens and bound_tokens of every cell (see TokenBudgetPlanner.sample_setting())
+    """
+    if (tokenizer, samples) not in worker_planners:
+        worker_planners[(tokenizer, samples)] = TokenBudgetPlanner(get_tokenizer(tokenizer), samples, tokenizer=tokenizer)
+    planner = worker_planners[(tokenizer, samples)]
+    return pd.DataFrame([planner.sample_setting(cell) for cell in cells], columns=['mean_tokens', 'max_tokens', 'bound_tokens'])
+
+def model_limits(model):
+    """
+    Returns the price per 1K tokens and the context window of a model, including finetuned models (e.g. 'davinci:ft-...')
+
+    Returns:
+        (tuple(float, int)): (USD per 1K tokens, context window in tokens)
+    """
+    if model in MODEL_LIMITS:
+        return MODEL_LIMITS[model]
+
+    base_model = model.split(':')[0]
+    if base_model in FINETUNED_PRICES:
+        return FINETUNED_PRICES[base_model], MODEL_LIMITS[base_model][1]
+    return DEFAULT_LIMITS
+
+def summarize_plan(plan_df):
+    """
+    Returns a printable summary of a plan: totals and the cells exceeding the context window
+    """
+    lines = [
+        f"requests: {int(plan_df['requests'].sum())}",
+        f"prompt tokens: {int(plan_df['total_tokens'].sum() - plan_df['completion_tokens'].sum())}",
+        f"completion tokens: {int(plan_df['completion_tokens'].sum())}",
+        f"estimated cost: ${plan_df['cost'].sum():.2f}",
+        f"estimated time: {plan_df.attrs.get('minutes', 0):.1f} minutes",
+    ]
+    exceeding = plan_df[plan_df['exceeds_context']]
+    if not exceeding.empty:
+        lines.append("cells which may exceed the context window:")
+        lines.append(str(exceeding[['construction_type', 'format_type', 'shots', 'salient_task', 'model', 'bound_prompt_tokens']]))
+    return '\n'.join(lines)
@@ -0,0 +1,202 @@
+import collections
+import logging
+import threading
+import time
+import keys
+from structured_logging import log
+
+# seconds a key is left out after an error of each kind (see classify_error())
+QUARANTINE_SECONDS = {'auth': 3600, 'quota': 600, 'rate': 20}
+# characters per token, to estimate the tokens of a request before sending it
+CHARS_PER_TOKEN = 4
+WINDOW_SECONDS = 60
+# times a rate-limited request is retried, each once a key is free again, however many keys the pool has
+RATE_LIMIT_RETRIES = 5
+
+def classify_error(error):
+    """
+    Returns the kind of a request error which says something about the key rather than the request: 'auth' (invalid or revoked key),
+    'quota' (exhausted quota or billing limit), 'rate' (rate limit) or None for any other error
+
+    Errors are told apart by their type or HTTP status (the http_status of the errors of the OpenAI SDK and of LeanClient), and by
+    the wording of the message for clients which raise plain Exceptions
+    """
+    name = type(error).__name__
+    status = getattr(error, 'http_status', None)
+    message = str(error).lower()
+    if name in ('AuthenticationError', 'PermissionError') or status in (401, 403) or 'invalid api key' in message or 'incorrect api key' in message:
+        return 'auth'
+    if 'quota' in message or 'billing' in message:
+        return 'quota'
+    if name == 'RateLimitError' or status == 429 or 'rate limit' in message:
+        return 'rate'
+    return None
+
+def estimate_tokens(prompt, max_tokens=0):
+    return len(prompt) // CHARS_PER_TOKEN + 1 + max_tokens
+
+class KeyBudget:
+    """
+    The usage of one key over the last minute
+
+    Attributes:
+        key (str): the API key
+        rpm (int): requests per minute allowed for the key
+        tpm (int): tokens per minute allowed for the key
+        events (collections.deque): the (time, tokens) of every request sent with the key in the last minute
+        tokens (int): the tokens of the requests in events
+        quarantined_until (float): time until which the key is not used
+        quarantine_reason (str): kind of the error which quarantined the key
+    """
+    def __init__(self, key, rpm, tpm):
+        self.key = key
+        self.rpm = rpm
+        self.tpm = tpm
+        self.events = collections.deque()
+        self.tokens = 0
+        self.quarantined_until = 0
+        self.quarantine_reason = None
+
+    def expire(self, now):
+        while self.events and self.events[0][0] <= now - WINDOW_SECONDS:
+            self.tokens -= self.events.popleft()[1]
+
+    def headroom(self, tokens):
+        """
+        Returns the smallest fraction of the request and token budgets left after a request of tokens tokens (negative if it does not fit)
+        """
+        return min(1 - (len(self.events) + 1) / self.rpm, 1 - (self.tokens + tokens) / self.tpm)
+
+    def next_release(self, now):
+        return max(self.events[0][0] + WINDOW_SECONDS, now) if self.events else now
+
+class CredentialPool:
+    """
+    Routes every request to one of several API keys, tracking the requests and tokens of each key over the last minute
+
+    A request goes to the key with the most headroom (the smaller of its remaining request and token budgets, as a fraction of its
+    limits); if no key can take it, acquire() waits until one can. Keys which fail with an auth or quota error (or a rate limit) are
+    quarantined for a while (see QUARANTINE_SECONDS) and the request is retried with another key, or once the quarantine of a
+    rate-limited key is over. The key is passed to each request
+    (api_key=...) instead of being set globally, so concurrent requests can use different keys.
+
+    Attributes:
+        budgets (list(KeyBudget)): the usage of every key
+        condition (threading.Condition): guards the budgets
+    """
+    def __init__(self, api_keys, rpm=3000, tpm=250000):
+        if not api_keys:
+            raise Exception("the credential pool needs at least one key")
+        self.budgets = []
+        for api_key in api_keys:
+            # a key is either a string or a dict with its own limits, e.g. {'key': 'sk-...', 'rpm': 60, 'tpm': 150000}
+            if isinstance(api_key, dict):
+                self.budgets.append(KeyBudget(api_key['key'], api_key.get('rpm', rpm), api_key.get('tpm', tpm)))
+            else:
+                self.budgets.append(KeyBudget(api_key, rpm, tpm))
+        self.condition = threading.Condition()
+
+    @classmethod
+    def from_keys(cls, name, rpm=3000, tpm=250000):
+        """
+        Builds the pool of the keys listed in keys.py as <name>S (e.g. OPENAI_API_KEYS), or of the single key <name>
+        """
+        api_keys = getattr(keys, name + 'S', None) or [getattr(keys, name)]
+        return cls(api_keys, rpm, tpm)
+
+    def acquire(self, tokens):
+        """
+        Reserves a request of tokens tokens on the key with the most headroom, waiting until a key can take it
+
+        Returns:
+            (KeyBudget): the budget of the chosen key
+        """
+        with self.condition:
+            while True:
+                now = time.time()
+                available = [budget for budget in self.budgets if budget.quarantined_until <= now]
+                if not available and all(budget.quarantine_reason == 'auth' for budget in self.budgets):
+                    raise Exception("every API key of the pool failed to authenticate")
+
+                for budget in available:
+                    budget.expire(now)
+                # a request larger than a whole minute of tokens can only go to an idle key
+                candidates = [budget for budget in available if budget.headroom(tokens) >= 0 or not budget.events]
+                if candidates:
+                    budget = max(candidates, key=lambda budget: budget.headroom(tokens))
+                    budget.events.append((now, tokens))
+                    budget.tokens += tokens
+                    return budget
+
+                releases = [budget.next_release(now) for budget in available] or [min(budget.quarantined_until for budget in self.budgets)]
+                self.condition.wait(timeout=max(min(releases) - now, 0.01))
+
+    def quarantine(self, budget, reason):
+        with self.condition:
+            budget.quarantined_until = time.time() + QUARANTINE_SECONDS[reason]
+            budget.quarantine_reason = reason
+            self.condition.notify_all()
+        log(logging.WARNING, 'API key quarantined', key=budget.key[-4:], reason=reason, seconds=QUARANTINE_SECONDS[reason])
+
+    def call(self, request, tokens):
+        """
+        Sends a request with a key of the pool, retrying it with another key (up to once per key) if the key fails to authenticate or
+        is out of quota, and up to RATE_LIMIT_RETRIES times if it is rate limited: acquire() then waits for a key to be free again,
+        even if the pool has a single key
+
+        Args:
+            request (function): api_key -> response, e.g. lambda api_key: openai.Completion.create(..., api_key=api_key)
+            tokens (int): the estimated tokens of the request (see estimate_tokens())
+        Returns:
+            the response of the request
+        """
+        key_failures = 0
+        rate_limits = 0
+        while True:
+            budget = self.acquire(tokens)
+            try:
+                return request(budget.key)
+            except Exception as e:
+                reason = classify_error(e)
+                if reason is None:
+                    raise
+                self.quarantine(budget, reason)
+                if reason == 'rate':
+                    rate_limits += 1
+                    if rate_limits > RATE_LIMIT_RETRIES:
+                        raise
+                else:
+                    key_failures += 1
+                    if key_failures == len(self.budgets):
+                        raise
+
+    def usage(self):
+        """
+        Returns the requests and tokens of every key over the last minute, and whether it is quarantined
+        """
+        with self.condition:
+            now = time.time()
+            for budget in self.budgets:
+                budget.expire(now)
+            return [{'key': budget.key[-4:], 'requests': len(budget.events), 'tokens': budget.tokens, 'quarantined': budget.quarantined_until > now} for budget in self.budgets]
+
+pools = {}
+pool_settings = {'rpm': 3000, 'tpm': 250000}
+pools_lock = threading.Lock()
+
+def configure_credentials(rpm=3000, tpm=250000):
+    """
+    Sets the default per-key limits of the pools (keys listed as dicts keep their own limits); pools are rebuilt on next use
+    """
+    with pools_lock:
+        pool_settings.update(rpm=rpm, tpm=tpm)
+        pools.clear()
+
+def get_pool(name):
+    """
+    Returns the pool of the keys named name in keys.py (e.g. 'OPENAI_API_KEY'), built once per process
+    """
+    with pools_lock:
+        if name not in pools:
+            pools[name] = CredentialPool.from_keys(name, **pool_settings)
+        return pools[name]
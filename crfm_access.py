@@ -1,8 +1,8 @@
 import pandas as pd
 import numpy as np
 import sys
-from keys import CRFM_API_KEY
 from api_access import APIAccess
+from credential_pool import get_pool, estimate_tokens
 
 sys.path.append('/Users/khanda/Documents/code/projects/pulls/GitHub/benchmarking')
 
@@ -26,20 +26,78 @@ class CRFMAccess(APIAccess):
             request_result (RequestResult): output from CRFM API query
         """
 
-        auth = Authentication(api_key=CRFM_API_KEY)
         prompt = self.generate_formatted_prompt(format, needs_instruction, to_togethercomputer=False)
         service = RemoteService("https://crfm-models.stanford.edu")
         request = Request(
             prompt=prompt, 
-            model="ai21/j1-jumbo",
+            model=self.crfm_model_name(model),
             top_k_per_token=4,
             max_tokens=0,
             echo_prompt=True,
         )
         
-        request_result: RequestResult = service.make_request(auth, request)
+        request_result: RequestResult = get_pool('CRFM_API_KEY').call(lambda api_key: service.make_request(Authentication(api_key=api_key), request), estimate_tokens(prompt, request.max_tokens))
         
         return request_result
+
+    def request_query_only(self, model, format, needs_instruction):
+        """
+        Query the API with the generated prompt cut off right after the query infix and retrieve only the top logprobs for the next token
+        
+        Parameters:
+            model (str): the model on CRFM to query with generated prompt
+            format (str): the format of the prompt ['arrow', 'qa']
+            needs_instruction (bool): True if need to include instruction in prompt and False otherwise
+        Returns:
+            request_result (RequestResult): output from CRFM API query
+        """
+        prompt = self.generate_query_prompt(format, needs_instruction)
+        service = RemoteService("https://crfm-models.stanford.edu")
+        request = Request(
+            prompt=prompt, 
+            model=self.crfm_model_name(model),
+            top_k_per_token=4,
+            max_tokens=1,
+            echo_prompt=False,
+        )
+        
+        request_result: RequestResult = get_pool('CRFM_API_KEY').call(lambda api_key: service.make_request(Authentication(api_key=api_key), request), estimate_tokens(prompt, request.max_tokens))
+        
+        return request_result
+
+    def request_stream(self, model, format, needs_instruction, max_tokens=64):
+        """
+        Request a greedy completion of the clarifying prompt; CRFM does not stream completions, so the whole completion is returned
+        as a single chunk in the format of APIAccess.request_stream()
+        
+        Parameters:
+            model (str): the model on CRFM to query with generated prompt
+            format (str): the format of the prompt ['arrow', 'qa']
+            needs_instruction (bool): True if need to include instruction in prompt and False otherwise
+            max_tokens (int): the maximum number of tokens to generate
+        Returns:
+            stream (list): a single chunk with the completion in ['choices'][0]['text']
+        """
+        prompt = self.generate_clarifying_prompt(format, needs_instruction)
+        service = RemoteService("https://crfm-models.stanford.edu")
+        request = Request(
+            prompt=prompt, 
+            model=self.crfm_model_name(model),
+            max_tokens=max_tokens,
+            temperature=0,
+            echo_prompt=False,
+        )
+        
+        request_result: RequestResult = get_pool('CRFM_API_KEY').call(lambda api_key: service.make_request(Authentication(api_key=api_key), request), estimate_tokens(prompt, request.max_tokens))
+        
+        return [{'choices': [{'text': request_result.completions[0].text}]}]
+
+    def crfm_model_name(self, model):
+        # CRFM model names are prefixed by their organization (e.g. 'ai21/j1-jumbo'); other names fall back to the model used in the paper
+        return model if '/' in model else "ai21/j1-jumbo"
+
+    def query_top_logprobs(self, output):
+        return output.completions[0].tokens[0].top_logprobs
     
     def to_numpy_dataframe(self, output):
         """
@@ -50,7 +108,8 @@ class CRFMAccess(APIAccess):
         Returns:
             unpacked_df (pd.DataFrame): the DataFrame obtained from the API call
         """
-        unpacked_df = pd.DataFrame(output.completions[0].tokens)
+        # one row per token, from its fields (Token dataclasses of the API, or the tokens rebuilt from an archive)
+        unpacked_df = pd.DataFrame([vars(token) for token in output.completions[0].tokens])
         
         unpacked_df["%"] = unpacked_df["logprob"].apply(lambda x: 100*np.e**x)
         unpacked_df.rename(columns={'logprob':'token_logprobs', 'text':'tokens'}, inplace=True)
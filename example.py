@@ -14,6 +14,9 @@ class Example:
     task_b_label: True  # the label for the second task, in this case, if task_b_label is True, the contstruction contains a reference to an indoor location (as opposed to an outdoor location)
     active_task_label: True  # the label for the example overall -- the "user-facing" label for the example
     salient_task: 'task_a'  # the task that determines the salient task -- the task that determines the active_task_label
+    prompt_id: 3  # the id of the Prompt the example belongs to
+    example_number: 2  # the position of the example in its Prompt, starting at 1 (the query is the last example)
+    feature_labels: '1011'  # the labels of every feature, for constructions with more than two features (see feature_schema.py)
 
     Attributes:x
         construction_type (str): the type of construction contained in this example
@@ -22,6 +25,9 @@ class Example:
         task_b_label (bool): the label of the second task
         active_task_label (bool): label of the overall construction, the active task [task_a, task_b] is the task that determines the overall label of the construction
         salient_task (str): the name of the task that is the salient task for this construction, determined after instantiation ]
+        prompt_id (int): the id of the Prompt containing this example, set once the Prompt is complete
+        example_number (int): the position of this example in its Prompt, set once the Prompt is complete; (prompt_id, example_number) identifies the example
+        feature_labels (str): the label of every feature as '0'/'1', for constructions with more than two features (None otherwise)
     """
     construction_type: str
     format_type: str
@@ -30,7 +36,22 @@ class Example:
     task_b_label: bool
     active_task_label: bool
     salient_task: str = None
+    prompt_id: int = None
+    example_number: int = None
+    feature_labels: str = None
 
     def as_dict(self):
-        return {'construction_type':self.construction_type, 'salient_task':self.salient_task, 'format_type':self.format_type, 'construction':self.construction,
-        'task_a_label':self.task_a_label, 'task_b_label':self.task_b_label, 'active_task_label':self.active_task_label}
+        example_dict = {'construction_type':self.construction_type, 'salient_task':self.salient_task, 'format_type':self.format_type, 'construction':self.construction,
+        'task_a_label':self.task_a_label, 'task_b_label':self.task_b_label, 'active_task_label':self.active_task_label,
+        'prompt_id':self.prompt_id, 'example_number':self.example_number}
+        if self.feature_labels is not None:
+            example_dict['feature_labels'] = self.feature_labels
+        return example_dict
+
+def number_examples(examples, prompt_id):
+    """
+    Sets the (prompt_id, example_number) key of every example of a Prompt, numbering the examples from 1 in order
+    """
+    for example_number, example in enumerate(examples, 1):
+        example.prompt_id = prompt_id
+        example.example_number = example_number
@@ -1,28 +1,54 @@
 import random
-from example import Example
-
-# These are used in multiple subclasses of ExampleGeneration and as such are included as global constants
-URBAN_LOCATIONS = ["laboratory", "theatre", "museum", "courtroom", "apartment building", "restaurant", "house", "film studio", "hotel lobby", "grocery store"]
-NATURAL_LOCATIONS = ["river", "pond", "woodlands", "cave", "canyon", "prairie", "jungle", "marsh", "lagoon", "meadow"]
-HUMAN_SUBJECTS = ["student", "reporter", "hiker", "researcher", "firefighter", "fugitive", "critic", "photographer", "director", "surveyor"]
+# the shared vocabularies are defined with the schemas, and still importable from here
+from feature_schema import SCHEMAS, URBAN_LOCATIONS, NATURAL_LOCATIONS, HUMAN_SUBJECTS, to_example
 
 class ExampleGenerator:
     """
     Generate examples which are used to generate prompts for a language model 
+
+    The vocabulary, template and instructions of each construction type are described by its FeatureSchema (see feature_schema.py)
     
     Attributes:
-        construction_type (str): specificies the type of example to generate: one of {subject_location, religious_pronoun, propn_negation}
+        construction_type (str): specificies the type of example to generate: one of SCHEMAS, e.g. {subject_location, religious_pronoun, propn_negation}
         format_type (str): specifies the format needed to generate the example: one of {qa, arrow}
+        rng (random.Random): source of every random choice (the global random module by default)
+        schema (FeatureSchema): the features, vocabularies and template of the construction type
     """
-    def __init__(self, construction_type, format_type):
+    def __init__(self, construction_type, format_type, rng=random):
         self.construction_type = construction_type
         self.format_type = format_type
+        self.rng = rng
+        self.schema = SCHEMAS[construction_type]
 
     def get_locations(self):
         return NATURAL_LOCATIONS + URBAN_LOCATIONS
 
-    def generate_example(self, task_a_feature, task_b_feature, active_task_label, salient_task = None):
-        raise NotImplementedError
+    def generate_example(self, task_a_label, task_b_label, active_task_label, salient_task = None):
+        """
+        Generates a construction of a two-feature construction type
+
+        Args:
+            task_a_label (bool): the label of the first feature (e.g. True to select a human subject for subject_location)
+            task_b_label (bool): the label of the second feature (e.g. True to select an urban location for subject_location)
+            active_task_label (bool): the ouput label for the example: either True or False
+            salient_task (str): the task which is salient for the example
+        Returns:
+            Example (Example): Example object with relevant metadata
+        """
+        return self.generate_feature_example([task_a_label, task_b_label], active_task_label, salient_task)
+
+    def generate_feature_example(self, labels, active_task_label, salient_task = None):
+        """
+        Generates a construction with the given label for every feature of the schema
+
+        Args:
+            labels (list(bool)): the label of every feature, in the order of the schema
+            active_task_label (bool): the ouput label for the example: either True or False
+            salient_task (str): the task which is salient for the example
+        Returns:
+            Example (Example): Example object with relevant metadata
+        """
+        return to_example(self.schema, self.format_type, self.schema.render(labels, self.rng), labels, active_task_label, salient_task)
 
     def generate_example_given_salient(self, test_example):
         """
@@ -35,7 +61,7 @@ class ExampleGenerator:
         Returns:
             example (Example): an example mirroring the inputted test_example
         """
-        mirror_example = random.choice([True, False])
+        mirror_example = self.rng.choice([True, False])
         if mirror_example:
             task_a_label = test_example.task_a_label
             task_b_label = test_example.task_b_label
@@ -52,107 +78,15 @@ class SubjectLocationGenerator(ExampleGenerator):
     Generates subject-location-type constructions
     An example construction: The {horse} is in the {lagoon}.
     """
-    def generate_example(self, task_a_label, task_b_label, active_task_label, salient_task = None):
-        """
-        Generates an construction of the above format.
-
-        Args:
-            task_a_label (str): True to randomly select a human subject, False to randomly select an animal subject
-            task_b_label (str): True to randomly select an urban location, False to randomly select a natural location
-            active_task_label (bool): the ouput label for the example: either True or False
-            salient_task (str): the task which is salient for the example: one of {'task_a', 'task_b', None}
-        Returns:
-            Example (Example): Example object with relevant metadata
-        """
-       
-        animal_subjects = ["boar", "worm", "hawk", "hound", "butterfly", "snake",
-        "duck", "bear", "mountain lion", "horse"]
-
-        if task_a_label:
-            choice_a = random.choice(HUMAN_SUBJECTS)
-        else:
-            choice_a = random.choice(animal_subjects)
-        
-        if task_b_label:
-            choice_b = random.choice(URBAN_LOCATIONS)
-        else:
-            choice_b = random.choice(NATURAL_LOCATIONS)
-
-        construction = f"The {choice_a} is in the {choice_b}."
-
-        return Example(construction_type=self.construction_type, format_type=self.format_type, construction=construction, task_a_label=task_a_label, task_b_label=task_b_label, active_task_label=active_task_label, salient_task=salient_task)
 
 class ReligiousPronounGenerator(ExampleGenerator):
     """
     Generates religious-pronoun-type constructions
     An example construction: {She} is in the laboratory with the {rabbi}.
     """
-    def generate_example(self, task_a_label, task_b_label, active_task_label, salient_task = None):
-        """
-        Generates an construction of the above format.
-
-        Args:
-            task_a_feature (bool): True to randomly select a relgious leader, False to randomly select a secular leader
-            task_b_feature (bool): True to select the pronoun 'he', False to select the pronoun 'she'
-            active_task_label (bool): the ouput label for the example: either True or False
-            salient_task (str): the task which is salient for the example: one of {task_a, task_b, None}
-        Returns:
-            Example (Example): Example object with relevant metadata
-        """
-        religious_leaders = ["pope", "reverend", "bishop", "Dalai Lama", "rabbi", "cardinal", "pastor", "deacon", "imam", "ayatollah"]
-        secular_leaders = ["president", "CEO", "principal", "sheriff", "judge", "ambassador", "officer", "prime minister", "colonel", "professor"]
-
-        if task_a_label:
-            choice_a = random.choice(religious_leaders)
-        else:
-            choice_a = random.choice(secular_leaders)
-        
-        if task_b_label:
-            choice_b = 'He'
-        else:
-            choice_b = "She"
-
-        urban_location = random.choice(URBAN_LOCATIONS)
-
-        construction = f"{choice_b} is in the {urban_location} with the {choice_a}."
-
-        return Example(construction_type=self.construction_type, format_type=self.format_type, construction=construction, task_a_label=task_a_label, task_b_label=task_b_label, active_task_label=active_task_label, salient_task=salient_task)
 
 class ProperNounNegationGenerator(ExampleGenerator):
     """
         Generates propn-negation-type constructions
         An example construction: {Noam Chomsky} {was not} in the theatre.
     """
-    def generate_example(self, task_a_label, task_b_label, active_task_label, salient_task = None):
-        """
-        Generates an construction of the above format.
-
-        Args:
-            task_a_feature (bool): True to randomly select a proper noun, False to select a common noun
-            task_b_feature (bool): True to not contain a negation, False to contain a negation
-            active_task_label (bool): the ouput label for the example: either True or False
-            salient_task (str): the task which is salient for the example: one of {task_a, task_b, None}
-        Returns:
-            Example (Example): Example object with relevant metadata
-        """
-        propn = ["Lebron James", "Bernie Sanders", "Christopher Nolan", "Paul Atreides", "Noam Chomsky", "Serena Williams", "Margot Robbie", "Alexandria Ocasio-Cortez", "Hermione Granger", "Jane Goodall"]
-
-        positives = ["is", "was", "has been", "may be", "could be"]
-        negatives = ["is not", "was not", "has not been", "may not be", "could not be"]
-
-        if task_a_label:
-            choice_a = random.choice(propn)
-        else:
-            choice_a = random.choice(HUMAN_SUBJECTS)
-            choice_a = "The " + choice_a
-
-        if task_b_label:
-            choice_b = random.choice(positives)
-        else:
-            choice_b = random.choice(negatives)
-
-        urban_location = random.choice(URBAN_LOCATIONS)
-
-        construction = f"{choice_a} {choice_b} in the {urban_location}."
-
-        return Example(construction_type=self.construction_type, format_type=self.format_type, construction=construction, task_a_label=task_a_label, task_b_label=task_b_label, active_task_label=active_task_label, salient_task=salient_task)
\ No newline at end of file
@@ -0,0 +1,222 @@
+from dataclasses import dataclass, field
+import numpy as np
+from example import Example
+
+URBAN_LOCATIONS = ["laboratory", "theatre", "museum", "courtroom", "apartment building", "restaurant", "house", "film studio", "hotel lobby", "grocery store"]
+NATURAL_LOCATIONS = ["river", "pond", "woodlands", "cave", "canyon", "prairie", "jungle", "marsh", "lagoon", "meadow"]
+HUMAN_SUBJECTS = ["student", "reporter", "hiker", "researcher", "firefighter", "fugitive", "critic", "photographer", "director", "surveyor"]
+ANIMAL_SUBJECTS = ["boar", "worm", "hawk", "hound", "butterfly", "snake", "duck", "bear", "mountain lion", "horse"]
+RELIGIOUS_LEADERS = ["pope", "reverend", "bishop", "Dalai Lama", "rabbi", "cardinal", "pastor", "deacon", "imam", "ayatollah"]
+SECULAR_LEADERS = ["president", "CEO", "principal", "sheriff", "judge", "ambassador", "officer", "prime minister", "colonel", "professor"]
+PROPER_NOUNS = ["Lebron James", "Bernie Sanders", "Christopher Nolan", "Paul Atreides", "Noam Chomsky", "Serena Williams", "Margot Robbie", "Alexandria Ocasio-Cortez", "Hermione Granger", "Jane Goodall"]
+POSITIVES = ["is", "was", "has been", "may be", "could be"]
+NEGATIVES = ["is not", "was not", "has not been", "may not be", "could not be"]
+
+INSTRUCTION_TEMPLATE = "Output 'X' if the sentence {} and 'Y' otherwise."
+
+@dataclass
+class Feature:
+    """
+    A binary feature of a construction: the label of the feature is True if the word filling its slot comes from true_values
+
+    Attributes:
+        name (str): the name of the feature, which is also the salient task it defines (e.g. 'subject')
+        true_values (list(str)): the vocabulary of the slot when the label is True
+        false_values (list(str)): the vocabulary of the slot when the label is False
+        true_description (str): completes INSTRUCTION_TEMPLATE when the sentences labeled 'X' are those whose label is True
+        false_description (str): completes INSTRUCTION_TEMPLATE when the sentences labeled 'X' are those whose label is False
+    """
+    name: str
+    true_values: list
+    false_values: list
+    true_description: str
+    false_description: str
+
+@dataclass
+class FeatureSchema:
+    """
+    Describes a construction with K binary features: a sentence template with one slot per feature (named after the feature)
+    and free slots (fillers) whose words do not affect any label
+
+    Features are keyed 'task_a', 'task_b', ... in order, so the first two features of a schema are the task_a and task_b of the
+    two-feature constructions. Labels are handled as a boolean matrix with one column per feature, so the labels of whole batches
+    of Prompts are sampled and checked with array operations (see sample_labels()).
+
+    Attributes:
+        construction_type (str): the name of the construction
+        template (str): the sentence, with a {slot} for every feature and filler
+        features (list(Feature)): the features, in order
+        fillers (dict(str, list(str))): the vocabulary of every free slot
+    """
+    construction_type: str
+    template: str
+    features: list
+    fillers: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.task_keys = ['task_' + chr(ord('a') + k) for k in range(len(self.features))]
+        # (task key, label of the feature for the sentences labeled 'X') -> description
+        self.descriptions = {}
+        for task_key, feature in zip(self.task_keys, self.features):
+            self.descriptions[(task_key, True)] = feature.true_description
+            self.descriptions[(task_key, False)] = feature.false_description
+
+    @property
+    def feature_names(self):
+        return [feature.name for feature in self.features]
+
+    def feature_index(self, salient_task):
+        if salient_task not in self.feature_names:
+            raise Exception("invalid salient task")
+        return self.feature_names.index(salient_task)
+
+    def task_index(self, task_key):
+        return self.task_keys.index(task_key)
+
+    def instruction(self, salient_task_key):
+        """
+        Returns the informative instruction for a (task key, label of the salient feature for 'X') pair, e.g. ('task_a', True)
+        """
+        return INSTRUCTION_TEMPLATE.format(self.descriptions[salient_task_key])
+
+    def example_labels(self, salient_index, salient_value, ambiguous, rng):
+        """
+        Returns the feature labels of one example whose salient feature has salient_value: every other feature agrees with it
+        in an ambiguous example; in a disambiguating example the other features are random but at least one disagrees
+        (with two features the other feature always disagrees, and rng is not used)
+        """
+        if ambiguous:
+            return [salient_value] * len(self.features)
+
+        others = [k for k in range(len(self.features)) if k != salient_index]
+        if len(others) == 1:
+            values = [not salient_value]
+        else:
+            values = [rng.choice([True, False]) for _ in others]
+            if all(value == salient_value for value in values):
+                values[rng.randrange(len(values))] = not salient_value
+
+        labels = [salient_value] * len(self.features)
+        for k, value in zip(others, values):
+            labels[k] = value
+        return labels
+
+    def render(self, labels, rng):
+        """
+        Fills the template for one example: a word for each feature slot from the vocabulary of its label, then a word for each filler
+        (drawn in that order from rng, a random.Random-like source; single-word vocabularies do not consume randomness)
+        """
+        words = {}
+        for feature, label in zip(self.features, labels):
+            words[feature.name] = choose(feature.true_values if label else feature.false_values, rng)
+        for slot, values in self.fillers.items():
+            words[slot] = choose(values, rng)
+        return self.template.format(**words)
+
+    def sample_labels(self, prompts, shots, salient_task, prob_of_ambiguous, rng):
+        """
+        Samples the labels of a batch of Prompts at once
+
+        As in Prompt.make_given_distribution_examples(), every Prompt draws which label of the salient feature goes with 'X', and every
+        example its task ordering (which label it shows) and whether it is ambiguous (every feature agrees with the salient feature) or
+        disambiguating (the other features are random, and at least one of them disagrees with the salient feature)
+
+        Args:
+            prompts (int): the number of Prompts
+            shots (int): the number of examples of each Prompt
+            salient_task (str): the name of the salient feature
+            prob_of_ambiguous (float): number from 0 to 100, the percentage of ambiguous examples
+            rng (np.random.Generator): source of randomness
+        Returns:
+            (tuple(np.ndarray, np.ndarray, np.ndarray)): the (prompts, shots, K) feature labels, the (prompts, shots) active labels
+            and the (prompts,) label of the salient feature for 'X'
+        """
+        salient_index = self.feature_index(salient_task)
+        features = len(self.features)
+
+        x_values = rng.random(prompts) < 0.5
+        active = rng.random((prompts, shots)) < 0.5
+        salient_values = active == x_values[:, None]
+        ambiguous = rng.random((prompts, shots)) * 100 < prob_of_ambiguous
+
+        labels = rng.random((prompts, shots, features)) < 0.5
+        labels[..., salient_index] = salient_values
+        others = np.delete(np.arange(features), salient_index)
+        if len(others):
+            # flips one random other feature of the disambiguating examples in which every feature agrees with the salient feature
+            agreeing = (labels[..., others] == salient_values[..., None]).all(axis=-1) & ~ambiguous
+            flipped = others[rng.integers(len(others), size=(prompts, shots))]
+            p, s = np.nonzero(agreeing)
+            labels[p, s, flipped[p, s]] = ~salient_values[p, s]
+        labels[ambiguous] = salient_values[ambiguous][:, None]
+
+        return labels, active, x_values
+
+    def render_batch(self, labels, rng):
+        """
+        Fills the template for a batch of examples, drawing the words of every slot with one array operation
+
+        Args:
+            labels (np.ndarray): the (n, K) feature labels of the examples
+            rng (np.random.Generator): source of randomness
+        Returns:
+            sentences (list(str)): the n sentences
+        """
+        n = len(labels)
+        columns = {}
+        for k, feature in enumerate(self.features):
+            true_values = np.array(feature.true_values, dtype=object)
+            false_values = np.array(feature.false_values, dtype=object)
+            columns[feature.name] = np.where(labels[:, k], true_values[rng.integers(len(true_values), size=n)], false_values[rng.integers(len(false_values), size=n)])
+        for slot, values in self.fillers.items():
+            columns[slot] = np.array(values, dtype=object)[rng.integers(len(values), size=n)]
+
+        slots = list(columns)
+        return [self.template.format(**dict(zip(slots, words))) for words in zip(*(columns[slot] for slot in slots))]
+
+def choose(values, rng):
+    return values[0] if len(values) == 1 else rng.choice(values)
+
+def feature_labels(example):
+    """
+    Returns the labels of every feature of an Example, as a tuple of bools
+    """
+    if example.feature_labels is not None:
+        return tuple(label == '1' for label in example.feature_labels)
+    return (example.task_a_label, example.task_b_label)
+
+def to_example(schema, format_type, sentence, labels, active_label, salient_task):
+    """
+    Builds the Example of a sentence; the labels of the first two features are its task_a and task_b labels, and K-feature
+    schemas also record every label as a string of 0s and 1s
+    """
+    return Example(construction_type=schema.construction_type, format_type=format_type, construction=sentence, task_a_label=bool(labels[0]), task_b_label=bool(labels[1]),
+                   active_task_label=bool(active_label), salient_task=salient_task, feature_labels=''.join('1' if label else '0' for label in labels) if len(labels) > 2 else None)
+
+SCHEMAS = {schema.construction_type: schema for schema in [
+    FeatureSchema('subject_location', "The {subject} is in the {location}.", [
+        Feature('subject', HUMAN_SUBJECTS, ANIMAL_SUBJECTS, 'contains a reference to a human', 'contains a reference to an animal'),
+        Feature('location', URBAN_LOCATIONS, NATURAL_LOCATIONS, 'contains a reference to an indoor setting', 'contains a reference to an outdoor setting'),
+    ]),
+    FeatureSchema('religious_pronoun', "{pronoun} is in the {urban_location} with the {religious}.", [
+        Feature('religious', RELIGIOUS_LEADERS, SECULAR_LEADERS, 'contains a reference to a religious leader', 'does not contain a reference to a religious leader'),
+        Feature('pronoun', ["He"], ["She"], 'contains a male pronoun', 'contains a female pronoun'),
+    ], {'urban_location': URBAN_LOCATIONS}),
+    FeatureSchema('propn_negation', "{propn} {negation} in the {urban_location}.", [
+        Feature('propn', PROPER_NOUNS, ["The " + subject for subject in HUMAN_SUBJECTS], 'contains a proper noun', 'does not contain a proper noun'),
+        Feature('negation', POSITIVES, NEGATIVES, 'does not contain a negation', 'contains a negation'),
+    ], {'urban_location': URBAN_LOCATIONS}),
+    # four interacting features in one sentence
+    FeatureSchema('subject_negation_location_religious', "The {subject} {negation} in the {location} with the {religious}.", [
+        Feature('subject', HUMAN_SUBJECTS, ANIMAL_SUBJECTS, 'contains a reference to a human', 'contains a reference to an animal'),
+        Feature('negation', POSITIVES, NEGATIVES, 'does not contain a negation', 'contains a negation'),
+        Feature('location', URBAN_LOCATIONS, NATURAL_LOCATIONS, 'contains a reference to an indoor setting', 'contains a reference to an outdoor setting'),
+        Feature('religious', RELIGIOUS_LEADERS, SECULAR_LEADERS, 'contains a reference to a religious leader', 'does not contain a reference to a religious leader'),
+    ]),
+]}
+
+# constructions with more than the two features of the original tasks
+K_FEATURE_CONSTRUCTION_TYPES = [name for name, schema in SCHEMAS.items() if len(schema.features) > 2]
+# the construction type of the original two-feature tests in which each salient task is a feature, e.g. 'location' -> 'subject_location'
+CONSTRUCTION_TYPES_MAP = {feature_name: construction_type for construction_type, schema in SCHEMAS.items()
+                          if construction_type not in K_FEATURE_CONSTRUCTION_TYPES for feature_name in schema.feature_names}
@@ -0,0 +1,280 @@
+import json
+import os
+import random
+import threading
+import numpy as np
+from api_access import APIAccess
+from example import Example, number_examples
+from prompt import Prompt
+from prompt_sampler import StratifiedSampler
+
+# settings which change how the Prompts of a cell are generated (besides the corpus key)
+GENERATION_SETTINGS = ['needs_instruction', 'needs_informative', 'include_ambiguous_examples', 'prob_of_ambiguous', 'for_finetuning', 'finetuning_control', 'stratified']
+
+EXAMPLE_DTYPE = np.dtype([
+    ('task_a_label', '?'),
+    ('task_b_label', '?'),
+    ('active_task_label', '?'),
+    ('salient_task', 'i1'),     # index into the 'salient_tasks' list of the manifest
+])
+
+def corpus_key(cell):
+    """
+    Returns the key of the group of Prompts a cell draws from: (construction_type, salient_task, format_type, shots)
+    """
+    return (cell['construction_type'], cell['salient_task'], cell['construction_format'], cell['shots'])
+
+def assign_prompt_ids(cells, corpus):
+    """
+    Points every cell to its own range of prompt ids in a corpus: cells sharing a corpus key (e.g. the repeats of a sweep)
+    take consecutive ranges, in the order of the sweep
+
+    Args:
+        cells (list(dict)): the keyword arguments of Tester.run_test() for every cell
+        corpus (str): path of the materialized corpus
+    Returns:
+        cells (list(dict)): the cells with 'corpus' and 'corpus_start' set
+    Raises:
+        Exception: if the corpus lacks the Prompts of a cell (e.g. it was materialized for another sweep or fewer replicates)
+    """
+    frozen_corpus = FrozenCorpus.open(corpus)
+    next_prompt_id = {}
+    for cell in cells:
+        key = corpus_key(cell)
+        cell['corpus'] = corpus
+        cell['corpus_start'] = next_prompt_id.get(key, 0)
+        next_prompt_id[key] = cell['corpus_start'] + cell['queries']
+    for key, count in next_prompt_id.items():
+        if frozen_corpus.group(*key)['count'] < count:
+            raise Exception(f"corpus {corpus} has {frozen_corpus.group(*key)['count']} prompts for {key}, the sweep needs {count}")
+    return cells
+
+def encode_strings(strings):
+    """
+    Packs strings into one uint8 blob of UTF-8 bytes and the int64 offsets of each string (n + 1 offsets)
+    """
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+class ShardWriter:
+    """
+    Buffers the Prompts of one shard and writes them as columnar .npy files:
+        prompts: instruction and rendered prompt (blob + offsets), example_offsets (first example of each prompt, n + 1 offsets)
+        examples: construction (blob + offsets) and the EXAMPLE_DTYPE labels
+    """
+    def __init__(self, path, salient_tasks):
+        self.path = path
+        self.salient_tasks = salient_tasks
+        self.instructions = []
+        self.rendered = []
+        self.example_offsets = [0]
+        self.constructions = []
+        self.labels = []
+
+    def __len__(self):
+        return len(self.rendered)
+
+    def add(self, prompt, rendered):
+        self.instructions.append(prompt.get_instruction())
+        self.rendered.append(rendered)
+        for example in prompt.get_examples():
+            if example.feature_labels is not None:
+                raise Exception(f"constructions with more than two features ({example.construction_type}) cannot be materialized")
+            if example.salient_task not in self.salient_tasks:
+                self.salient_tasks.append(example.salient_task)
+            self.constructions.append(example.construction)
+            self.labels.append((example.task_a_label, example.task_b_label, example.active_task_label, self.salient_tasks.index(example.salient_task)))
+        self.example_offsets.append(len(self.constructions))
+
+    def write(self):
+        os.makedirs(self.path, exist_ok=True)
+        columns = {'example_offsets': np.asarray(self.example_offsets, dtype=np.int64), 'labels': np.array(self.labels, dtype=EXAMPLE_DTYPE)}
+        for name, strings in [('instruction', self.instructions), ('rendered', self.rendered), ('construction', self.constructions)]:
+            columns[name + '_blob'], columns[name + '_offsets'] = encode_strings(strings)
+        for name, column in columns.items():
+            np.save(os.path.join(self.path, name + '.npy'), column)
+
+def materialize(path, cells, seed=0, shard_size=10000):
+    """
+    Generates the Prompts of every cell of a grid once and writes them as a frozen corpus which runs can read instead of generating Prompts
+
+    Every group of Prompts sharing a corpus key is generated from its own seed (derived from seed and the key), so a group is identical
+    whichever grid it is materialized with. Cells sharing a key take consecutive prompt ids (see assign_prompt_ids()).
+
+    Layout of the corpus directory:
+        manifest.json: the seed, shard size, salient task names and, for each group, its key, generation settings and first global row
+        shard_<k>/: the columns of global rows [k * shard_size, (k + 1) * shard_size) (see ShardWriter)
+
+    Args:
+        path (str): directory of the corpus
+        cells (list(dict)): the keyword arguments of Tester.run_test() for every cell (see Tester.sweep_cells())
+        seed (int): seed of the corpus
+        shard_size (int): number of Prompts per shard
+    Returns:
+        manifest (dict): the contents of manifest.json
+    """
+    groups = {}
+    for cell in cells:
+        key = corpus_key(cell)
+        settings = {name: cell.get(name) for name in GENERATION_SETTINGS}
+        if key not in groups:
+            groups[key] = {'settings': settings, 'queries': []}
+        elif groups[key]['settings'] != settings:
+            raise Exception(f"cells with corpus key {key} have different generation settings")
+        groups[key]['queries'].append(cell['queries'])
+
+    salient_tasks = []
+    manifest_groups = []
+    shard = ShardWriter(os.path.join(path, 'shard_0'), salient_tasks)
+    row = 0
+    for (construction_type, salient_task, format_type, shots), group in groups.items():
+        settings = group['settings']
+        rng = random.Random(f"{seed}:{construction_type}:{salient_task}:{format_type}:{shots}")
+        manifest_groups.append({'construction_type': construction_type, 'salient_task': salient_task, 'format_type': format_type, 'shots': shots,
+                                'start': row, 'count': sum(group['queries']), 'settings': settings})
+
+        for queries in group['queries']:
+            # samples each cell's chunk as QueryPipeline.run_pipeline() would
+            sampler = StratifiedSampler(queries, shots, settings['prob_of_ambiguous'], rng) if settings['stratified'] and salient_task != None else None
+            for _ in range(queries):
+                prompt = Prompt(shots=shots, construction_type=construction_type, format_type=format_type, needs_instruction=settings['needs_instruction'], needs_informative=settings['needs_informative'],
+                                include_ambiguous_examples=settings['include_ambiguous_examples'], prob_of_ambiguous=settings['prob_of_ambiguous'], for_finetuning=settings['for_finetuning'],
+                                finetuning_control=settings['finetuning_control'], salient_task=salient_task, plan=sampler.next_plan() if sampler else None, prompt_id=row - manifest_groups[-1]['start'], rng=rng)
+                shard.add(prompt, APIAccess(prompt).generate_formatted_prompt(format_type, settings['needs_instruction'], to_togethercomputer=False))
+                row += 1
+
+                if len(shard) == shard_size:
+                    shard.write()
+                    shard = ShardWriter(os.path.join(path, f"shard_{row // shard_size}"), salient_tasks)
+
+    if len(shard):
+        shard.write()
+
+    manifest = {'seed': seed, 'shard_size': shard_size, 'prompts': row, 'salient_tasks': salient_tasks, 'groups': manifest_groups}
+    temporary_path = os.path.join(path, 'manifest.json.tmp')
+    with open(temporary_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temporary_path, os.path.join(path, 'manifest.json'))
+    return manifest
+
+class FrozenPrompt(Prompt):
+    """
+    A Prompt read from a frozen corpus instead of being generated; it can be used wherever a Prompt is used
+
+    Attributes:
+        prompt_id (int): the id of the Prompt within its group of the corpus
+        rendered (str): the prompt exactly as rendered by APIAccess.generate_formatted_prompt() when the corpus was materialized
+    """
+    def __init__(self, shots, construction_type, format_type, examples, instruction, prompt_id, rendered):
+        self.shots = shots
+        self.construction_type = construction_type
+        self.format_type = format_type
+        self.examples = examples
+        self.instruction = instruction
+        self.clarifying_assertion = ""
+        self.prompt_id = prompt_id
+        self.rendered = rendered
+        number_examples(self.examples, prompt_id)
+
+class FrozenCorpus:
+    """
+    Reads Prompts from a corpus written by materialize(); shard columns are memory-mapped when first used,
+    so reading any Prompt takes O(1) time regardless of the size of the corpus
+
+    Attributes:
+        path (str): directory of the corpus
+        manifest (dict): the contents of manifest.json
+    """
+    opened = {}
+    opening_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.groups = {(group['construction_type'], group['salient_task'], group['format_type'], group['shots']): group for group in self.manifest['groups']}
+        self.shards = {}
+
+    @classmethod
+    def open(cls, path):
+        """
+        Opens a corpus once per process
+        """
+        with cls.opening_lock:
+            if path not in cls.opened:
+                cls.opened[path] = cls(path)
+            return cls.opened[path]
+
+    def __len__(self):
+        return self.manifest['prompts']
+
+    def group(self, construction_type, salient_task, format_type, shots):
+        key = (construction_type, salient_task, format_type, shots)
+        if key not in self.groups:
+            raise Exception(f"corpus {self.path} has no prompts for {key}")
+        return self.groups[key]
+
+    def check_settings(self, construction_type, salient_task, format_type, shots, **settings):
+        """
+        Raises an Exception if the group was generated with other settings (see GENERATION_SETTINGS) than the given ones
+        """
+        group_settings = self.group(construction_type, salient_task, format_type, shots)['settings']
+        for name, value in settings.items():
+            if name in group_settings and group_settings[name] != value:
+                raise Exception(f"corpus {self.path} was materialized with {name}={group_settings[name]}, not {value}")
+
+    def shard(self, index):
+        if index not in self.shards:
+            shard_path = os.path.join(self.path, f"shard_{index}")
+            self.shards[index] = {name[:-len('.npy')]: np.load(os.path.join(shard_path, name), mmap_mode='r') for name in os.listdir(shard_path) if name.endswith('.npy')}
+        return self.shards[index]
+
+    def locate(self, construction_type, salient_task, format_type, shots, prompt_id):
+        """
+        Returns:
+            (tuple(dict, int)): the columns of the shard holding the Prompt and its row within the shard
+        """
+        group = self.group(construction_type, salient_task, format_type, shots)
+        if not 0 <= prompt_id < group['count']:
+            raise Exception(f"prompt id {prompt_id} out of range for {construction_type}, {salient_task}, {format_type}, {shots} ({group['count']} prompts)")
+        row = group['start'] + prompt_id
+        return self.shard(row // self.manifest['shard_size']), row % self.manifest['shard_size']
+
+    def get(self, construction_type, salient_task, format_type, shots, prompt_id):
+        """
+        Reads a Prompt
+
+        Args:
+            construction_type (str): one of {subject_location, religious_pronoun, propn_negation}
+            salient_task (str): the salient task of the Prompt (None for Prompts generated without one)
+            format_type (str): one of {qa, arrow}
+            shots (int): the shots of the Prompt
+            prompt_id (int): the id of the Prompt within its group
+        Returns:
+            (FrozenPrompt): the Prompt
+        """
+        columns, row = self.locate(construction_type, salient_task, format_type, shots, prompt_id)
+        first_example, last_example = columns['example_offsets'][row], columns['example_offsets'][row + 1]
+
+        examples = []
+        for i in range(first_example, last_example):
+            labels = columns['labels'][i]
+            examples.append(Example(construction_type=construction_type, format_type=format_type, construction=read_string(columns, 'construction', i),
+                                    task_a_label=bool(labels['task_a_label']), task_b_label=bool(labels['task_b_label']), active_task_label=bool(labels['active_task_label']),
+                                    salient_task=self.manifest['salient_tasks'][labels['salient_task']]))
+
+        return FrozenPrompt(shots=shots, construction_type=construction_type, format_type=format_type, examples=examples, instruction=read_string(columns, 'instruction', row),
+                            prompt_id=prompt_id, rendered=read_string(columns, 'rendered', row))
+
+    def rendered(self, construction_type, salient_task, format_type, shots, prompt_id):
+        """
+        Reads only the rendered prompt text of a Prompt
+        """
+        columns, row = self.locate(construction_type, salient_task, format_type, shots, prompt_id)
+        return read_string(columns, 'rendered', row)
+
+def read_string(columns, name, i):
+    offsets = columns[name + '_offsets']
+    return columns[name + '_blob'][offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
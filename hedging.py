@@ -0,0 +1,156 @@
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+from structured_logging import log
+
+PERCENTILES = [50, 95, 99]
+
+class LatencyWindow:
+    """
+    The latencies (in seconds) of the last window requests
+    """
+    def __init__(self, window=1000):
+        self.latencies = collections.deque(maxlen=window)
+
+    def add(self, seconds):
+        self.latencies.append(seconds)
+
+    def __len__(self):
+        return len(self.latencies)
+
+    def percentile(self, q):
+        return float(np.percentile(self.latencies, q)) if self.latencies else None
+
+class Hedger:
+    """
+    Sends scoring requests with a deadline and, optionally, hedges them: a request still running after the p95 latency of its
+    model is sent a second time and whichever answer arrives first is used
+
+    Only idempotent requests are hedged (the scoring requests of APIAccess.request() and request_query_only(), which echo the prompt
+    with max_tokens=0 or greedily score the next token), and at most budget percent extra requests are sent. The p95 threshold is
+    taken over the latencies of the first attempts of the model, once min_samples of them are known.
+
+    Latencies are reported both without hedging (of the first attempt of every request, recorded even when a hedge answered first)
+    and with hedging (of the answer actually used).
+
+    Attributes:
+        timeout (float): seconds after which a request (with its hedge) fails with a TimeoutError (None for no deadline)
+        budget (float): number from 0 to 100, the maximum percentage of extra (hedge) requests (0 to never hedge)
+        min_samples (int): number of latencies of a model needed before its requests are hedged
+        requests (int): number of requests sent (not counting hedges)
+        hedges (int): number of hedge requests sent
+        hedge_wins (int): number of requests answered by their hedge
+        timeouts (int): number of requests which missed their deadline
+    """
+    def __init__(self, timeout=None, budget=0, min_samples=20, window=1000, max_workers=64):
+        self.timeout = timeout
+        self.budget = budget
+        self.min_samples = min_samples
+        self.window = window
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.model_latencies = {}
+        self.unhedged = LatencyWindow(window)
+        self.hedged = LatencyWindow(window)
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+
+    def hedge_after(self, key):
+        """
+        Returns the seconds after which a request of the model key is hedged, or None if it is not hedged (no budget left or too few latencies)
+        """
+        with self.lock:
+            latencies = self.model_latencies.get(key)
+            if self.budget <= 0 or latencies is None or len(latencies) < self.min_samples or self.hedges + 1 > self.budget / 100 * self.requests:
+                return None
+            return latencies.percentile(95)
+
+    def record_attempt(self, key, start, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        seconds = time.perf_counter() - start
+        with self.lock:
+            if key not in self.model_latencies:
+                self.model_latencies[key] = LatencyWindow(self.window)
+            self.model_latencies[key].add(seconds)
+            self.unhedged.add(seconds)
+
+    def call(self, request, key, idempotent=True):
+        """
+        Sends a request, waiting at most timeout seconds for an answer and hedging it if it is idempotent (see class docstring)
+
+        Args:
+            request (function): () -> response, sends the request
+            key (str): the model of the request, whose latencies set the hedging threshold
+            idempotent (bool): True if sending the request twice is harmless
+        Returns:
+            the first response to arrive
+        """
+        start = time.perf_counter()
+        with self.lock:
+            self.requests += 1
+        primary = self.executor.submit(request)
+        primary.add_done_callback(lambda future: self.record_attempt(key, start, future))
+        attempts = [primary]
+
+        hedge_after = self.hedge_after(key) if idempotent else None
+        if hedge_after is not None:
+            done, _ = wait(attempts, timeout=hedge_after if self.timeout is None else min(hedge_after, self.timeout))
+            if not done and (self.timeout is None or time.perf_counter() - start < self.timeout):
+                with self.lock:
+                    self.hedges += 1
+                attempts.append(self.executor.submit(request))
+
+        # waits for the first successful answer, or until every attempt failed or the deadline passed
+        pending = set(attempts)
+        error = None
+        while pending:
+            remaining = None if self.timeout is None else self.timeout - (time.perf_counter() - start)
+            if remaining is not None and remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    with self.lock:
+                        self.hedged.add(time.perf_counter() - start)
+                        if future is not primary:
+                            self.hedge_wins += 1
+                    return future.result()
+                error = error or future.exception()
+
+        if error is not None and not pending:
+            raise error
+        with self.lock:
+            self.timeouts += 1
+        log(logging.WARNING, 'request deadline missed', model=key, timeout=self.timeout, attempts=len(attempts))
+        raise TimeoutError(f"no answer from {key} within {self.timeout} seconds")
+
+    def report(self):
+        """
+        Returns the counts of requests, hedges and timeouts and the latency percentiles (in seconds) without and with hedging
+        """
+        with self.lock:
+            report = {'requests': self.requests, 'hedges': self.hedges, 'hedge_rate': round(100 * self.hedges / self.requests, 2) if self.requests else 0,
+                      'hedge_wins': self.hedge_wins, 'timeouts': self.timeouts}
+            for name, latencies in [('unhedged', self.unhedged), ('hedged', self.hedged)]:
+                for q in PERCENTILES:
+                    value = latencies.percentile(q)
+                    report[f"{name}_p{q}"] = round(value, 3) if value is not None else None
+            return report
+
+hedger = Hedger()
+
+def configure_hedging(timeout=None, budget=0, min_samples=20):
+    """
+    Replaces the hedger used for every scoring request of the process (see Hedger)
+    """
+    global hedger
+    hedger = Hedger(timeout=timeout, budget=budget, min_samples=min_samples)
+
+def get_hedger():
+    return hedger
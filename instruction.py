@@ -1,4 +1,4 @@
-import random
+from feature_schema import SCHEMAS, feature_labels
 
 class Instruction:
     """
@@ -14,7 +14,7 @@ class Instruction:
     """
     def __init__(self, construction_type):
         self.construction_type = construction_type
-        self.tasks = [None, None]
+        self.tasks = SCHEMAS[construction_type].feature_names if construction_type in SCHEMAS else [None, None]
     
     def make_uninformative_instruction(self):
         return "Output 'X' if the sentence contains a [category withheld] and 'Y' otherwise."
@@ -60,6 +60,9 @@ class Instruction:
             current_examples (Example): a list of all the examples (and the query) in the current prompt
         Returns: 
             tuple: (name of salient task, bool of that tasks' label)
+
+        For more than two tasks, the task is the first one (in the order of the schema) on which the salient example and the query
+        agree, and the last one when they agree on none
         """
         first_example = current_examples[0]
         second_example = current_examples[1]
@@ -70,30 +73,17 @@ class Instruction:
         else:
             salient_example = second_example
 
+        # the first task (in the order of the schema) on which the salient example and the query agree; when they agree on none
+        # (the examples are not consistent with any task) the last task, as the two-task logic always fell back to 'task_b'
+        schema = SCHEMAS[self.construction_type]
+        query_labels = feature_labels(query)
+        salient_labels = feature_labels(salient_example)
+        index = next((k for k in range(len(query_labels) - 1) if query_labels[k] == salient_labels[k]), len(query_labels) - 1)
+
         if query.active_task_label:
-            if query.task_a_label == salient_example.task_a_label:
-                if query.task_a_label:
-                    return ('task_a', True)
-                    
-                else:
-                    return ('task_a', False)
-                    
-            else:
-                if query.task_b_label:
-                    return ('task_b', True)
-                else:
-                    return ('task_b', False)
+            return (schema.task_keys[index], query_labels[index])
         else:
-            if query.task_a_label == salient_example.task_a_label:
-                if query.task_a_label:
-                    return ('task_a', False)
-                else:
-                    return ('task_a', True)
-            else:
-                if query.task_b_label:
-                    return ('task_b', False)
-                else:
-                    return ('task_b', True)
+            return (schema.task_keys[index], not query_labels[index])
 
     def set_salient_task(self, current_examples, include_ambiguous_examples, salient_task_a_or_b):
         '''
@@ -117,12 +107,7 @@ class Instruction:
         else:
             salient_task_key = self.create_salient_task_key(current_examples, salient_task_a_or_b)
 
-        construction_type_map = {
-            'subject_location' : SubjectLocationInstruction(self.construction_type),
-            'religious_pronoun': ReligiousPronounInstruction(self.construction_type),
-            'propn_negation': PropNNegationInstruction(self.construction_type)
-        }
-        construction_type_map[self.construction_type].set_custom_salient_task(salient_task_key, current_examples)
+        self.set_custom_salient_task(salient_task_key, current_examples)
 
     def create_salient_task_key(self, current_examples, salient_task_a_or_b):
         """
@@ -130,17 +115,13 @@ class Instruction:
 
         Args:
             current_examples (list(Example)): a list of all the examples (and the query) in the current prompt
-            salient_task_a_or_b (str): the salient task for the current prompt, one of {'task_a', 'task_b'}
+            salient_task_a_or_b (str): the salient task for the current prompt, one of {'task_a', 'task_b', ...} (see FeatureSchema.task_keys)
         Returns:
             tuple(str, bool): (name of salient task, bool of that tasks' label for set of examples)
         """
         query = current_examples[-1]
+        key_task_label = feature_labels(query)[SCHEMAS[self.construction_type].task_index(salient_task_a_or_b)]
 
-        if salient_task_a_or_b == 'task_a':
-            key_task_label = query.task_a_label
-        else:
-            key_task_label = query.task_b_label
-            
         if query.active_task_label:
             return (salient_task_a_or_b, key_task_label)
         else:
@@ -161,23 +142,13 @@ class Instruction:
         else:
             salient_task_key = self.create_salient_task_key(current_examples, salient_task_a_or_b)
         
-        # creates an instruction based on the construction_type
-        construction_type_map = {
-            'subject_location' : SubjectLocationInstruction(self.construction_type),
-            'religious_pronoun': ReligiousPronounInstruction(self.construction_type),
-            'propn_negation': PropNNegationInstruction(self.construction_type)
-        }
-
-        instruction = construction_type_map[self.construction_type].make_instruction(salient_task_key)
-        return instruction
+        # looks the instruction up in the schema of the construction_type
+        return SCHEMAS[self.construction_type].instruction(salient_task_key)
 
     def set_custom_salient_task(self, salient_task_key, current_examples):
-        if salient_task_key[0] == 'task_a':
-            for e in current_examples:
-                e.salient_task = self.tasks[0]
-        else:
-            for e in current_examples:
-                e.salient_task = self.tasks[1]
+        schema = SCHEMAS[self.construction_type]
+        for e in current_examples:
+            e.salient_task = schema.feature_names[schema.task_index(salient_task_key[0])]
         return current_examples
 
 class SubjectLocationInstruction(Instruction):
@@ -186,22 +157,8 @@ class SubjectLocationInstruction(Instruction):
 
     For example: 'Output 'X' if the sentence contains a reference to an outdoor setting and 'Y' otherwise'
     """
-    def __init__(self, construction_type):
-        self.construction_type = construction_type
-        self.tasks = ['subject', 'location']
-
     def make_instruction(self, salient_task_key):
-        salient_task_map = {
-            ('task_a', True):'a human', 
-            ('task_a', False):'an animal',
-            ('task_b', True):'an indoor setting', 
-            ('task_b', False):'an outdoor setting'
-        }
-
-        salient_feature = salient_task_map[salient_task_key]
-        instruction = f"Output 'X' if the sentence contains a reference to {salient_feature} and 'Y' otherwise."
-
-        return instruction
+        return SCHEMAS['subject_location'].instruction(salient_task_key)
 
 class ReligiousPronounInstruction(Instruction):
     """
@@ -209,22 +166,8 @@ class ReligiousPronounInstruction(Instruction):
 
     For example: 'Output 'X' if the sentence contains a female pronoun and 'Y' otherwise'
     """
-    def __init__(self, construction_type):
-        self.construction_type = construction_type
-        self.tasks = ['religious', 'pronoun']
-
     def make_instruction(self, salient_task_key):
-        salient_task_map = {
-            ('task_a', True):'contains a reference to a religious leader', 
-            ('task_a', False):'does not contain a reference to a religious leader',
-            ('task_b', True):'contains a male pronoun', 
-            ('task_b', False):'contains a female pronoun'
-        }
-
-        salient_feature = salient_task_map[salient_task_key]
-        instruction = f"Output 'X' if the sentence {salient_feature} and 'Y' otherwise."
-
-        return instruction
+        return SCHEMAS['religious_pronoun'].instruction(salient_task_key)
 
 class PropNNegationInstruction(Instruction):
     """
@@ -232,22 +175,5 @@ class PropNNegationInstruction(Instruction):
 
     For example: 'Output 'X' if the sentence contains a proper noun and 'Y' otherwise'
     """
-    def __init__(self, construction_type):
-        self.construction_type = construction_type
-        self.tasks = ['propn', 'negation']
-
     def make_instruction(self, salient_task_key):
-        salient_task_map = {
-            ('task_a', True):'contains a proper noun', 
-            ('task_a', False):'does not contain a proper noun',
-            ('task_b', True):'does not contain a negation', 
-            ('task_b', False):'contains a negation'
-        }
-        
-        salient_feature = salient_task_map[salient_task_key]
-        instruction = f"Output 'X' if the sentence {salient_feature} and 'Y' otherwise."
-
-        return instruction
-
-
-    
+        return SCHEMAS['propn_negation'].instruction(salient_task_key)
@@ -0,0 +1,125 @@
+import threading
+from urllib.parse import quote_plus
+import numpy as np
+import openai
+import pandas as pd
+import requests
+from api_access import APIAccess
+from credential_pool import get_pool, estimate_tokens
+from hedging import get_hedger
+
+try:
+    # parses a scoring response several times faster than json, into the same dicts and lists
+    import orjson
+    loads, dumps = orjson.loads, orjson.dumps
+except ImportError:
+    import json
+    loads, dumps = json.loads, lambda body: json.dumps(body).encode('utf-8')
+
+# connections kept open to the API, enough for every model, format and hedge of the cells run concurrently
+POOL_SIZE = 64
+# seconds the SDK waits for an answer when no request deadline is set
+TIMEOUT_SECONDS = 600
+# the errors raised by the SDK for the HTTP statuses of error responses which concern the key or the load (openai.error.APIError for any other)
+ERROR_CLASSES = {401: openai.error.AuthenticationError, 403: openai.error.PermissionError, 429: openai.error.RateLimitError,
+                 503: openai.error.ServiceUnavailableError}
+
+class LeanClient:
+    """
+    Sends completion requests as the OpenAI SDK does (POST <openai.api_base>/engines/<model>/completions) without its object model:
+    one session of the process keeps up to pool_size kept-alive connections (responses gzip-compressed), and every response is
+    parsed from its bytes into plain dicts and lists instead of being converted into nested OpenAIObjects, one per token.
+
+    Requests go to openai.api_base like those of the SDK, so a stub server set there (see load_test.py) serves both. An error response
+    is raised as the error the SDK raises for its HTTP status (e.g. openai.error.RateLimitError for 429), carrying the status and the
+    message of the API, so credential_pool.classify_error() treats both alike.
+
+    Attributes:
+        session (requests.Session): the pooled connections
+    """
+    def __init__(self, pool_size=POOL_SIZE):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=2)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip', 'Content-Type': 'application/json'})
+
+    def post(self, model, body, api_key, stream=False):
+        response = self.session.post(f"{openai.api_base}/engines/{quote_plus(model)}/completions", data=dumps(body), stream=stream,
+                                     headers={'Authorization': f"Bearer {api_key}"}, timeout=get_hedger().timeout or TIMEOUT_SECONDS)
+        if response.status_code != 200:
+            try:
+                message = loads(response.content)['error']['message']
+            except Exception:
+                message = response.text
+            response.close()
+            error_class = ERROR_CLASSES.get(response.status_code, openai.error.APIError)
+            raise error_class(f"{response.status_code} error from {model}: {message}", http_status=response.status_code)
+        return response
+
+    def complete(self, model, body, api_key):
+        """
+        Returns the parsed response of a completion request: {'choices': [{'logprobs': {'tokens', 'token_logprobs', ...}}], ...}
+        """
+        return loads(self.post(model, body, api_key).content)
+
+    def stream(self, model, body, api_key):
+        """
+        Returns the chunks of a streamed completion request as they arrive; closing the generator closes the connection
+        """
+        response = self.post(model, dict(body, stream=True), api_key, stream=True)
+
+        def chunks():
+            with response:
+                for line in response.iter_lines():
+                    if not line.startswith(b'data: '):
+                        continue
+                    if line == b'data: [DONE]':
+                        return
+                    yield loads(line[6:])
+
+        return chunks()
+
+client = None
+client_lock = threading.Lock()
+
+def get_client():
+    """
+    Returns the LeanClient of the process, created on first use
+    """
+    global client
+    with client_lock:
+        if client is None:
+            client = LeanClient()
+        return client
+
+class LeanAccess(APIAccess):
+    """
+    Queries the OpenAI API through a LeanClient instead of the SDK: the requests, keys and deadlines are those of APIAccess, and the
+    echoed logprobs are read from the lists of the response straight into the columns of the scored DataFrame. Results are identical
+    to those of APIAccess; outputs are plain dicts (archived and replayed as those of APIAccess).
+    """
+    def request(self, model, format, needs_instruction):
+        prompt = self.generate_formatted_prompt(format, needs_instruction, to_togethercomputer=False)
+        body = {'prompt': prompt, 'max_tokens': 0, 'logprobs': 4, 'echo': True}
+        return get_pool('OPENAI_API_KEY').call(lambda api_key: get_client().complete(model, body, api_key), estimate_tokens(prompt))
+
+    def request_query_only(self, model, format, needs_instruction):
+        prompt = self.generate_query_prompt(format, needs_instruction)
+        body = {'prompt': prompt, 'max_tokens': 1, 'temperature': 0, 'logprobs': 4, 'echo': False}
+        return get_pool('OPENAI_API_KEY').call(lambda api_key: get_client().complete(model, body, api_key), estimate_tokens(prompt, 1))
+
+    def request_stream(self, model, format, needs_instruction, max_tokens=64):
+        prompt = self.generate_clarifying_prompt(format, needs_instruction)
+        body = {'prompt': prompt, 'max_tokens': max_tokens, 'temperature': 0}
+        return get_pool('OPENAI_API_KEY').call(lambda api_key: get_client().stream(model, body, api_key), estimate_tokens(prompt, max_tokens))
+
+    def to_numpy_dataframe(self, output):
+        """
+        Builds the DataFrame of APIAccess.to_numpy_dataframe() column by column: the logprobs (None for the first token) are read
+        into one float array, from which '%' is computed at once
+        """
+        logprobs = output["choices"][0]["logprobs"]
+        token_logprobs = np.array(logprobs["token_logprobs"], dtype=float)
+        return pd.DataFrame({'tokens': logprobs["tokens"], 'token_logprobs': token_logprobs, 'top_logprobs': logprobs["top_logprobs"],
+                             '%': 100 * np.exp(token_logprobs)})
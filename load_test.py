@@ -0,0 +1,73 @@
+import time
+import openai
+from hedging import get_hedger
+from stub_server import StubServer
+
+# the columns identifying the scoring request which produced a result row (those present in the results)
+REQUEST_KEY = ['construction_type', 'salient_task', 'format_type', 'shots', 'replicate', 'model', 'prompt_id']
+
+def scored_requests(all_tests):
+    """
+    Returns the number of scoring requests whose result made it into the results (one per Prompt, model and format)
+    """
+    if all_tests.empty:
+        return 0
+    return len(all_tests.drop_duplicates([column for column in REQUEST_KEY if column in all_tests.columns]))
+
+def run_load_test(tester, cells, server, cooldown=0, workers=1, retries=0):
+    """
+    Runs the given tests against a stub server (see stub_server.py) instead of the OpenAI API, and reports how the request path
+    held up: the achieved throughput, the tail latency, the retries and the requests sent in vain
+
+    Args:
+        tester (Tester): runs the tests
+        cells (list(dict)): the keyword arguments of Tester.run_test() for every test (see Tester.sweep_cells())
+        server (StubServer): the started stub server
+        cooldown (int): seconds each worker waits after each test (the cooldowns of the sweeps are meant for the real API, so 0 by default)
+        workers (int): number of tests run concurrently
+        retries (int): number of times a failed test is retried
+    Returns:
+        all_tests (pd.DataFrame): the result rows of the tests
+        report (dict): the wall-clock seconds; the cells run, failed and retried; the requests sent to the server, answered,
+            rate limited (over the limits or injected 429s) and failed; the scored requests (whose results were kept) and the
+            wasted ones (answered but not kept, e.g. by a retried cell or a hedge); the throughput in scored requests and rows per
+            second; the hedges, timeouts and latency percentiles of the hedger (see Hedger.report())
+    """
+    api_base = openai.api_base
+    openai.api_base = server.url
+    start = time.perf_counter()
+    try:
+        all_tests = tester.run_cells(cells, cooldown, workers, retries)
+    finally:
+        openai.api_base = api_base
+    seconds = time.perf_counter() - start
+
+    stats = server.stats()
+    scored = scored_requests(all_tests)
+    latency = get_hedger().report()
+    report = {
+        'seconds': round(seconds, 3),
+        'cells': len(cells),
+        'failed_cells': len(all_tests.attrs.get('failed_cells', [])),
+        'cell_retries': all_tests.attrs.get('retries', 0),
+        'requests_sent': stats.get('requests', 0),
+        'requests_answered': stats.get('ok', 0),
+        'rate_limited': stats.get('rate_limited', 0) + stats.get('injected_429', 0),
+        'server_errors': stats.get('server_errors', 0) + stats.get('context_errors', 0),
+        'scored_requests': scored,
+        'wasted_requests': stats.get('ok', 0) - scored,
+        'requests_per_second': round(scored / seconds, 2) if seconds else None,
+        'rows_per_second': round(len(all_tests) / seconds, 2) if seconds else None,
+        'response_bytes': stats.get('response_bytes', 0),
+    }
+    report.update({key: value for key, value in latency.items() if key in ('hedges', 'hedge_wins', 'timeouts') or key.startswith(('unhedged_', 'hedged_'))})
+    return all_tests, report
+
+def load_test_sweep(tester, args):
+    """
+    Runs a sweep (args.sweep) against a stub server configured from the stub_* arguments of main (see run_load_test())
+    """
+    server = StubServer(latency=args.stub_latency, rpm=args.stub_rpm, tpm=args.stub_tpm, window_seconds=args.stub_window,
+                        error_rate=args.stub_error_rate, server_error_rate=args.stub_server_error_rate)
+    with server:
+        return run_load_test(tester, tester.sweep_cells(args.sweep, args), server, cooldown=args.cooldown, workers=args.replicate_workers, retries=args.retries)
@@ -0,0 +1,309 @@
+import threading
+import time
+from concurrent.futures import Future
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache
+from api_access import APIAccess
+
+class PrefixState:
+    """
+    The key/value cache of a causal LM after reading a token sequence, together with the scores of every token in it
+
+    Attributes:
+        token_ids (list(int)): the token sequence that has been read
+        cache (DynamicCache): the key/value cache for token_ids
+        token_logprobs (list(float)): logprob of each token given the tokens before it (None for the first token)
+        top_logprobs (list(dict)): the top-k tokens and logprobs at each position (None for the first token)
+        next_logprobs (torch.Tensor): the log-distribution over the token following token_ids
+    """
+    def __init__(self):
+        self.token_ids = []
+        self.cache = DynamicCache()
+        self.token_logprobs = []
+        self.top_logprobs = []
+        self.next_logprobs = None
+
+class LocalLM:
+    """
+    Scores prompts with a local causal LM, reusing the key/value cache of previously scored prompts which share a prefix
+
+    Prompts of a replicate are often strict extensions of each other (e.g. the cumulative prefixes written by
+    APIAccess.to_togethercomputer()) or share their instruction. For each new prompt the cached prefix state with the longest
+    common token prefix is cropped to that prefix and extended with the remaining tokens only, instead of re-encoding the prompt.
+    Prompts without a useful cached prefix can be scored together in one padded batch (see score_batch()): score() gathers the
+    prompts requested concurrently (the formats, models and replicates the pipeline scores at once) into such batches.
+
+    Outputs mimic the OpenAI completion objects used by APIAccess ('choices'[0]['logprobs'] with 'tokens', 'token_logprobs',
+    'top_logprobs' and 'text_offset'), so LocalAccess can reuse APIAccess.to_numpy_dataframe().
+
+    Attributes:
+        model (PreTrainedModel): the causal LM, e.g. a tiny randomly initialized GPT2LMHeadModel for testing
+        tokenizer (PreTrainedTokenizer): the tokenizer of the model
+        top_k (int): number of top logprobs returned at every position (as logprobs=4 in APIAccess.request())
+        max_states (int): number of prefix states kept in memory
+        min_shared_prefix (int): minimum number of cached tokens for a prompt to be extended incrementally in score_batch()
+        batch_seconds (float): how long the first of several concurrent score() calls waits for the others to join its batch
+    """
+    loaded = {}
+    loading_lock = threading.Lock()
+
+    def __init__(self, model, tokenizer, top_k=4, max_states=8, min_shared_prefix=16, batch_seconds=0.005):
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.top_k = top_k
+        self.max_states = max_states
+        self.min_shared_prefix = min_shared_prefix
+        self.batch_seconds = batch_seconds
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        self.batch_lock = threading.Lock()
+        self.states = []
+        self.decoded = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls, name):
+        """
+        Loads (once per process) the model and tokenizer stored under a local path or model name
+
+        Args:
+            name (str): a local checkpoint directory or model name understood by transformers' from_pretrained()
+        Returns:
+            (LocalLM): the shared LocalLM for that model
+        """
+        with cls.loading_lock:
+            if name not in cls.loaded:
+                cls.loaded[name] = cls(AutoModelForCausalLM.from_pretrained(name), AutoTokenizer.from_pretrained(name))
+            return cls.loaded[name]
+
+    def score(self, text):
+        """
+        Scores every token of the text, as APIAccess.request() does with echo=True and max_tokens=0
+
+        Calls made while another is waiting or being scored are gathered: the first caller waits batch_seconds for others to
+        join, then scores every gathered prompt with score_batch() (or alone, extending the cache, if no other joined).
+
+        Args:
+            text (str): the formatted prompt
+        Returns:
+            output (dict): an OpenAI-style completion with the logprobs of every token of the prompt
+        """
+        future = Future()
+        with self.pending_lock:
+            self.pending.append((text, future))
+            first = len(self.pending) == 1
+        if first:
+            time.sleep(self.batch_seconds)
+            # prompts requested while the previous batch was scored join this one
+            with self.batch_lock:
+                with self.pending_lock:
+                    batch, self.pending = self.pending, []
+                try:
+                    outputs = [self.score_alone(batch[0][0])] if len(batch) == 1 else self.score_batch([text for text, _ in batch])
+                except Exception as e:
+                    for _, batch_future in batch:
+                        batch_future.set_exception(e)
+                else:
+                    for (_, batch_future), output in zip(batch, outputs):
+                        batch_future.set_result(output)
+        return future.result()
+
+    def score_alone(self, text):
+        token_ids = self.tokenizer(text)['input_ids']
+        with self.lock:
+            state = self.extend(token_ids)
+            return self.to_output(state.token_ids, state.token_logprobs, state.top_logprobs)
+
+    def score_next_token(self, text):
+        """
+        Returns the top logprobs of the token following the text, as APIAccess.request_query_only() does
+
+        Args:
+            text (str): the formatted prompt ending with the query infix
+        Returns:
+            output (dict): an OpenAI-style completion with the top logprobs of the next token
+        """
+        token_ids = self.tokenizer(text)['input_ids']
+        with self.lock:
+            state = self.extend(token_ids)
+            return {'choices': [{'logprobs': {'top_logprobs': [self.top_k_dict(state.next_logprobs)]}}]}
+
+    def generate_stream(self, text, max_tokens):
+        """
+        Greedily generates a completion of the text one token at a time, extending the cached prefix state with each generated token;
+        closing the generator stops the generation
+
+        Args:
+            text (str): the prompt to complete
+            max_tokens (int): the maximum number of tokens to generate
+        Yields:
+            chunk (dict): an OpenAI-style stream chunk with the text of the new token in ['choices'][0]['text']
+        """
+        token_ids = self.tokenizer(text)['input_ids']
+        for _ in range(max_tokens):
+            with self.lock:
+                state = self.extend(token_ids)
+                token_id = int(torch.argmax(state.next_logprobs))
+            if token_id == self.tokenizer.eos_token_id:
+                return
+            token_ids = token_ids + [token_id]
+            yield {'choices': [{'text': self.decode(token_id)}]}
+
+    def score_batch(self, texts):
+        """
+        Scores several independent prompts: prompts sharing a long enough cached prefix are extended incrementally,
+        the others are scored together in one padded forward pass
+
+        Args:
+            texts (list(str)): the formatted prompts
+        Returns:
+            outputs (list(dict)): an OpenAI-style completion for each prompt, in order
+        """
+        outputs = [None] * len(texts)
+        batch = []
+        with self.lock:
+            for i, text in enumerate(texts):
+                token_ids = self.tokenizer(text)['input_ids']
+                _, shared = self.find_state(token_ids)
+                if shared >= self.min_shared_prefix:
+                    state = self.extend(token_ids)
+                    outputs[i] = self.to_output(state.token_ids, state.token_logprobs, state.top_logprobs)
+                else:
+                    batch.append((i, token_ids))
+
+            if batch:
+                for (i, _), output in zip(batch, self.forward_batch([token_ids for _, token_ids in batch])):
+                    outputs[i] = output
+        return outputs
+
+    def find_state(self, token_ids):
+        """
+        Finds the cached state sharing the longest common token prefix with token_ids
+
+        Returns:
+            (tuple(PrefixState, int)): the state (None if there is none) and the length of the shared prefix
+        """
+        best_state = None
+        best_shared = 0
+        for state in self.states:
+            shared = 0
+            for cached_id, token_id in zip(state.token_ids, token_ids):
+                if cached_id != token_id:
+                    break
+                shared += 1
+            if shared > best_shared:
+                best_state, best_shared = state, shared
+        return best_state, best_shared
+
+    @torch.inference_mode()
+    def extend(self, token_ids):
+        """
+        Brings the state with the longest shared prefix to token_ids (cropping it if needed) and scores the new tokens only
+
+        Args:
+            token_ids (list(int)): the tokens of the prompt
+        Returns:
+            state (PrefixState): the state for token_ids, now the most recently used state
+        """
+        state, shared = self.find_state(token_ids)
+
+        if state is None:
+            state = PrefixState()
+            start = 0
+        else:
+            self.states.remove(state)
+            if shared == len(state.token_ids) and shared < len(token_ids):
+                # strict extension: the cached distribution scores the first new token
+                start = shared
+            else:
+                # re-reads the last shared token to obtain the distribution following it
+                start = min(shared, len(token_ids)) - 1
+                if start:
+                    state.cache.crop(start - len(state.token_ids))
+                else:
+                    state.cache = DynamicCache()
+                state.token_ids = state.token_ids[:start]
+                state.next_logprobs = None
+            state.token_logprobs = state.token_logprobs[:start + 1] if start else []
+            state.top_logprobs = state.top_logprobs[:start + 1] if start else []
+
+        new_ids = token_ids[start:]
+        if new_ids:
+            outputs = self.model(input_ids=torch.tensor([new_ids]), past_key_values=state.cache, use_cache=True)
+            logprobs = torch.log_softmax(outputs.logits[0].float(), dim=-1)
+            state.cache = outputs.past_key_values
+
+            # logprobs[j] is the distribution following new_ids[j]
+            previous = state.next_logprobs
+            for j, token_id in enumerate(new_ids):
+                # the first re-read token of a cropped state is already scored
+                if start + j >= len(state.token_logprobs):
+                    state.token_logprobs.append(previous[token_id].item() if previous is not None else None)
+                    state.top_logprobs.append(self.top_k_dict(previous) if previous is not None else None)
+                previous = logprobs[j]
+
+            state.token_ids = list(token_ids)
+            state.next_logprobs = previous
+
+        self.states.append(state)
+        if len(self.states) > self.max_states:
+            self.states.pop(0)
+        return state
+
+    @torch.inference_mode()
+    def forward_batch(self, batch_token_ids):
+        """
+        Scores several token sequences in one right-padded forward pass, without caching them
+
+        Returns:
+            outputs (list(dict)): an OpenAI-style completion for each token sequence
+        """
+        length = max(len(token_ids) for token_ids in batch_token_ids)
+        pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else 0
+        input_ids = torch.tensor([token_ids + [pad_id] * (length - len(token_ids)) for token_ids in batch_token_ids])
+        attention_mask = torch.tensor([[1] * len(token_ids) + [0] * (length - len(token_ids)) for token_ids in batch_token_ids])
+        logprobs = torch.log_softmax(self.model(input_ids=input_ids, attention_mask=attention_mask).logits.float(), dim=-1)
+
+        outputs = []
+        for row, token_ids in enumerate(batch_token_ids):
+            token_logprobs = [None] + [logprobs[row, j - 1, token_ids[j]].item() for j in range(1, len(token_ids))]
+            top_logprobs = [None] + [self.top_k_dict(logprobs[row, j - 1]) for j in range(1, len(token_ids))]
+            outputs.append(self.to_output(token_ids, token_logprobs, top_logprobs))
+        return outputs
+
+    def top_k_dict(self, logprobs):
+        values, indices = torch.topk(logprobs, self.top_k)
+        return {self.decode(index): value for index, value in zip(indices.tolist(), values.tolist())}
+
+    def decode(self, token_id):
+        if token_id not in self.decoded:
+            self.decoded[token_id] = self.tokenizer.decode([token_id])
+        return self.decoded[token_id]
+
+    def to_output(self, token_ids, token_logprobs, top_logprobs):
+        tokens = [self.decode(token_id) for token_id in token_ids]
+        text_offset = []
+        offset = 0
+        for token in tokens:
+            text_offset.append(offset)
+            offset += len(token)
+
+        logprobs = {'tokens': tokens, 'token_logprobs': list(token_logprobs), 'top_logprobs': list(top_logprobs), 'text_offset': text_offset}
+        return {'choices': [{'logprobs': logprobs}]}
+
+class LocalAccess(APIAccess):
+    """
+    Scores the generated prompt with a local causal LM (see LocalLM) instead of querying an API.
+    The model argument of request(), request_query_only() and request_stream() is the checkpoint directory or model name to load.
+    """
+    def request(self, model, format, needs_instruction):
+        prompt = self.generate_formatted_prompt(format, needs_instruction, to_togethercomputer=False)
+        return LocalLM.get(model).score(prompt)
+
+    def request_query_only(self, model, format, needs_instruction):
+        prompt = self.generate_query_prompt(format, needs_instruction)
+        return LocalLM.get(model).score_next_token(prompt)
+
+    def request_stream(self, model, format, needs_instruction, max_tokens=64):
+        prompt = self.generate_clarifying_prompt(format, needs_instruction)
+        return LocalLM.get(model).generate_stream(prompt, max_tokens)
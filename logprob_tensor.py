@@ -0,0 +1,198 @@
+import numpy as np
+import pandas as pd
+
+# fixed-width record stored for every parsed label row
+LABEL_DTYPE = np.dtype([
+    ('label', 'i1'),            # 1 if the correct label is 'X', 0 if 'Y', -1 if the token is neither once stripped (e.g. "'X")
+    ('logprob_X', 'f4'),        # log of the combined top-k probability of 'X' (' X', 'X', ...), -inf if not in the top-k
+    ('logprob_Y', 'f4'),        # log of the combined top-k probability of 'Y', -inf if not in the top-k
+    ('logprob_other', 'f4'),    # largest top-k logprob of any other token, -inf if there is none
+    ('residual_mass', 'f4'),    # probability mass outside of the top-k tokens
+    ('token_logprob', 'f4'),    # logprob of the label token itself (-inf if unknown, e.g. in query-only scoring)
+])
+LOGPROB_COLUMNS = list(LABEL_DTYPE.names[1:])
+LABELS = {'X': 1, 'Y': 0}
+
+class LabelLogprobs:
+    """
+    Holds the parsed label rows of one or more API outputs as fixed-width float32 records (see LABEL_DTYPE)
+    instead of one dict of top-k logprobs per row
+
+    The records replace the 'top_logprobs' / 'top_k_probs' dict columns: the '%' and 'accurate' columns computed by
+    MetricWrangler are derived from them with vectorized operations, and they are written to CSV/Parquet as plain float
+    columns.
+
+    For example, for a label row with token ' X' and top logprobs {' X': -0.1, 'X': -3.0, ' Y': -2.5, ' The': -4.0}:
+        label: 1, logprob_X: log(e^-0.1 + e^-3.0), logprob_Y: -2.5, logprob_other: -4.0
+
+    Attributes:
+        records (np.ndarray): structured array of LABEL_DTYPE with one record per label row
+    """
+    def __init__(self, records):
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    @classmethod
+    def from_top_logprobs(cls, tokens, top_logprobs, token_logprobs=None):
+        """
+        Builds the records from the label tokens and the top logprobs returned by the API
+
+        Keys which only differ from 'X'/'Y' by spaces are combined as in the original dict-based grading
+
+        Args:
+            tokens (iterable(str)): the label token of each row
+            top_logprobs (iterable(dict)): the top-k logprobs of each row
+            token_logprobs (iterable(float)): the logprob of each label token (None if unknown)
+        Returns:
+            (LabelLogprobs): the parsed records
+        """
+        tokens = list(tokens)
+        labels = []
+        x_logprobs = []
+        y_logprobs = []
+        other_logprobs = []
+        residual_masses = []
+
+        for token, top_k in zip(tokens, top_logprobs):
+            x_prob = 0.0
+            y_prob = 0.0
+            other_logprob = -np.inf
+            total = 0.0
+
+            for key, logprob in top_k.items():
+                prob = np.exp(logprob)
+                total += prob
+                normalized_key = key.replace(' ', '')
+                if normalized_key == 'X':
+                    x_prob += prob
+                elif normalized_key == 'Y':
+                    y_prob += prob
+                elif logprob > other_logprob:
+                    other_logprob = logprob
+
+            labels.append(LABELS.get(token.strip(), -1))
+            x_logprobs.append(np.log(x_prob) if x_prob > 0 else -np.inf)
+            y_logprobs.append(np.log(y_prob) if y_prob > 0 else -np.inf)
+            other_logprobs.append(other_logprob)
+            residual_masses.append(max(0.0, 1.0 - total))
+
+        records = np.empty(len(tokens), dtype=LABEL_DTYPE)
+        records['label'] = labels
+        records['logprob_X'] = x_logprobs
+        records['logprob_Y'] = y_logprobs
+        records['logprob_other'] = other_logprobs
+        records['residual_mass'] = residual_masses
+        records['token_logprob'] = -np.inf if token_logprobs is None else np.asarray(list(token_logprobs), dtype=np.float32)
+
+        return cls(records)
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        Rebuilds the records from the float columns of a result frame (e.g. a result CSV that was read back in)
+
+        Args:
+            df (pd.DataFrame): a DataFrame with a 'tokens' column and the LOGPROB_COLUMNS
+        Returns:
+            (LabelLogprobs): the parsed records
+        """
+        records = np.empty(len(df), dtype=LABEL_DTYPE)
+        records['label'] = df['tokens'].str.strip().map(LABELS).fillna(-1).to_numpy(dtype=np.int8)
+        for column in LOGPROB_COLUMNS:
+            records[column] = df[column].to_numpy(dtype=np.float32)
+        return cls(records)
+
+    def label_logprobs(self):
+        """
+        Returns the combined top-k logprob of the correct label of each row (-inf if it is not in the top-k or the token is not a label)
+        """
+        label = self.records['label']
+        return np.where(label == 1, self.records['logprob_X'], np.where(label == 0, self.records['logprob_Y'], -np.inf))
+
+    def percentages(self):
+        """
+        Returns P(correct label) in percent for each row: the combined top-k probability of the label if it is in the top-k,
+        otherwise the probability of the label token itself
+        """
+        label_logprobs = self.label_logprobs()
+        logprobs = np.where(np.isfinite(label_logprobs), label_logprobs, self.records['token_logprob'])
+        return 100 * np.exp(logprobs.astype(np.float64))
+
+    def accurate(self):
+        """
+        Returns 1 for each row in which the correct label has the highest (combined) probability among the top-k and 0 otherwise
+        """
+        label = self.records['label']
+        label_logprobs = self.label_logprobs()
+        other_label_logprobs = np.where(label == 1, self.records['logprob_Y'], self.records['logprob_X'])
+        best_other = np.maximum(other_label_logprobs, self.records['logprob_other'])
+        return (np.isfinite(label_logprobs) & (label_logprobs >= best_other)).astype(int)
+
+    def to_frame(self):
+        """
+        Returns the records as a DataFrame of float32 columns (one per entry of LOGPROB_COLUMNS)
+        """
+        return pd.DataFrame({column: self.records[column] for column in LOGPROB_COLUMNS})
+
+def add_scores(df):
+    """
+    Fills in the '%' and 'accurate' columns of a result frame from its logprob columns if they are missing
+
+    Args:
+        df (pd.DataFrame): a result frame
+    Returns:
+        df (pd.DataFrame): the result frame with '%' and 'accurate' columns
+    """
+    if ('%' in df.columns and 'accurate' in df.columns) or not set(LOGPROB_COLUMNS).issubset(df.columns):
+        return df
+
+    label_logprobs = LabelLogprobs.from_frame(df)
+    df = df.copy()
+    df['%'] = label_logprobs.percentages()
+    df['accurate'] = label_logprobs.accurate()
+    return df
+
+def load_results(tests, columns, salient_tasks=None):
+    """
+    Returns the given columns of a result frame or of a ResultStore (see result_store.py), restricted to some salient tasks
+
+    A ResultStore only reads the requested columns of the requested salient tasks (and of whatever else it was filtered on);
+    '%' and 'accurate' are derived from the logprob columns if they were not stored
+
+    Args:
+        tests (pd.DataFrame or ResultStore): the results
+        columns (list(str)): the columns to return
+        salient_tasks (list(str)): the salient tasks to keep (None for all)
+    Returns:
+        tests_df (pd.DataFrame): the selected rows and columns
+    """
+    if isinstance(tests, pd.DataFrame):
+        tests_df = add_scores(tests)
+        if salient_tasks is not None:
+            tests_df = tests_df[tests_df['salient_task'].isin(salient_tasks)]
+        return tests_df[columns]
+
+    if salient_tasks is not None:
+        tests = tests.filter(salient_task=salient_tasks)
+    stored = tests.columns
+    read_columns = [column for column in columns if column in stored]
+    if len(read_columns) < len(columns):
+        read_columns += [column for column in LOGPROB_COLUMNS if column in stored and column not in read_columns]
+    return add_scores(tests.read(read_columns))[columns]
+
+def save_results(df, file_name):
+    """
+    Writes a result frame to Parquet if file_name ends in '.parquet' and to CSV otherwise
+
+    Args:
+        df (pd.DataFrame): a result frame
+        file_name (str): path of the output file
+    Returns:
+        None
+    """
+    if file_name.endswith('.parquet'):
+        df.to_parquet(file_name)
+    else:
+        df.to_csv(file_name)
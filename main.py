@@ -1,8 +1,26 @@
 import argparse
-from tester import Tester
+import os
+from tester import Tester, SWEEPS
+from feature_schema import K_FEATURE_CONSTRUCTION_TYPES
 from visualizer import Visualizer
+from response_archive import replay_archive
+from logprob_tensor import save_results
+from work_queue import WorkQueue, run_worker, collect_results
+from frozen_corpus import materialize
+from shot_search import search_thresholds
+from cost_planner import TokenBudgetPlanner, get_tokenizer, summarize_plan
+from clarification import clarification_summary
+from structured_logging import configure_logging, LEVELS
+from credential_pool import configure_credentials
+from hedging import configure_hedging, get_hedger
+from metric_wrangler import replicate_summary
+from together_ingest import ingest_results, SOLUTIONS_PATH
+from worker_pool import get_worker_pool
+from comparison import compare_conditions, conditions_by, open_results
+from load_test import load_test_sweep
+from batch_jobs import write_batch, run_batch, collect_batch, SUBMITTERS
 
-CONSTRUCTION_TYPE_CHOICES = ['subject_location', 'propn_negation', 'religious_pronoun', 'location', 'subject', 'negation', 'pronoun', 'religious', 'propn']
+CONSTRUCTION_TYPE_CHOICES = ['subject_location', 'propn_negation', 'religious_pronoun', 'location', 'subject', 'negation', 'pronoun', 'religious', 'propn'] + K_FEATURE_CONSTRUCTION_TYPES
 
 def main():
     parser = argparse.ArgumentParser()
@@ -11,6 +29,7 @@ def main():
     parser.add_argument('--type_3', choices=CONSTRUCTION_TYPE_CHOICES, type=str, required=False, default="propn_negation")
     parser.add_argument('--shots', type=int, required=False, default=1)
     parser.add_argument('--model', type=str, required=False, default="text-davinci-003")
+    parser.add_argument('--models', type=str, required=False, default=None)
     parser.add_argument('--format_1', choices=['arrow', 'qa'], type=str, required=False, default='arrow')
     parser.add_argument('--format_2', choices=['arrow', 'qa'], type=str, required=False, default='qa')
     parser.add_argument('--needs_instruction', type=bool, required=False, default=True)
@@ -21,14 +40,157 @@ def main():
     parser.add_argument('--prob_of_ambiguous', type=float, required=False, default=50)
     parser.add_argument('--togethercomputer', type=bool, required=False, default=False)
     parser.add_argument('--finetuning_control', type=bool, required=False, default=False)
+    parser.add_argument('--stratified', type=bool, required=False, default=False)
+    parser.add_argument('--query_only', type=bool, required=False, default=False)
+    parser.add_argument('--archive', type=str, required=False, default=None)
+    parser.add_argument('--replay', type=str, required=False, default=None)
+    parser.add_argument('--workers', type=int, required=False, default=None)
+    parser.add_argument('--queue', type=str, required=False, default=None)
+    parser.add_argument('--role', choices=['coordinator', 'worker', 'collect'], type=str, required=False, default='worker')
+    parser.add_argument('--sweep', choices=SWEEPS, type=str, required=False, default='baseline_for_finetuning')
+    parser.add_argument('--results_dir', type=str, required=False, default='queue_results')
+    parser.add_argument('--cooldown', type=int, required=False, default=0)
+    parser.add_argument('--dry_run', type=bool, required=False, default=False)
+    parser.add_argument('--tokenizer', type=str, required=False, default='approx')
+    parser.add_argument('--rpm', type=int, required=False, default=3000)
+    parser.add_argument('--tpm', type=int, required=False, default=250000)
+    parser.add_argument('--materialize', type=str, required=False, default=None)
+    parser.add_argument('--corpus', type=str, required=False, default=None)
+    parser.add_argument('--seed', type=int, required=False, default=0)
+    parser.add_argument('--paired', type=bool, required=False, default=False)
+    parser.add_argument('--search_shots', type=bool, required=False, default=False)
+    parser.add_argument('--target_accuracy', type=float, required=False, default=0.8)
+    parser.add_argument('--max_queries', type=int, required=False, default=200)
+    parser.add_argument('--clarifying', type=bool, required=False, default=False)
+    parser.add_argument('--log_file', type=str, required=False, default=None)
+    parser.add_argument('--log_level', choices=LEVELS, type=str, required=False, default=None)
+    parser.add_argument('--log_sample', type=int, required=False, default=100)
+    parser.add_argument('--replicate_workers', type=int, required=False, default=1)
+    parser.add_argument('--retries', type=int, required=False, default=2)
+    parser.add_argument('--replicate_seed', type=int, required=False, default=None)
+    parser.add_argument('--ingest_togethercomputer', type=str, required=False, default=None)
+    parser.add_argument('--solutions', type=str, required=False, default=SOLUTIONS_PATH)
+    parser.add_argument('--ingest_chunk_size', type=int, required=False, default=50000)
+    parser.add_argument('--batch', type=str, required=False, default=None)
+    parser.add_argument('--batch_submitter', choices=list(SUBMITTERS), type=str, required=False, default='openai')
+    parser.add_argument('--batch_shard_size', type=int, required=False, default=50000)
+    parser.add_argument('--poll_seconds', type=int, required=False, default=60)
+    parser.add_argument('--request_timeout', type=float, required=False, default=None)
+    parser.add_argument('--hedge_budget', type=float, required=False, default=0)
+    parser.add_argument('--store', type=str, required=False, default=None)
+    parser.add_argument('--compare', type=str, required=False, default=None)
+    parser.add_argument('--compare_metric', choices=['accurate', '%'], type=str, required=False, default='accurate')
+    parser.add_argument('--compare_paired', type=bool, required=False, default=False)
+    parser.add_argument('--resamples', type=int, required=False, default=10000)
+    parser.add_argument('--correction', choices=['holm', 'bh', 'none'], type=str, required=False, default='holm')
+    parser.add_argument('--load_test', type=bool, required=False, default=False)
+    parser.add_argument('--stub_latency', type=str, required=False, default='lognormal:0.3,0.6')
+    parser.add_argument('--stub_rpm', type=int, required=False, default=0)
+    parser.add_argument('--stub_tpm', type=int, required=False, default=0)
+    parser.add_argument('--stub_window', type=float, required=False, default=60)
+    parser.add_argument('--stub_error_rate', type=float, required=False, default=0.0)
+    parser.add_argument('--stub_server_error_rate', type=float, required=False, default=0.0)
 
     args = parser.parse_args()
+
+    # full Prompts are only logged (at DEBUG level, every log_sample-th Prompt) in verbose runs
+    configure_logging(args.log_file, level=args.log_level or ('DEBUG' if args.verbose else 'INFO'), sample=args.log_sample)
+    configure_credentials(rpm=args.rpm, tpm=args.tpm)
+    configure_hedging(timeout=args.request_timeout, budget=args.hedge_budget)
+
+    # re-scores archived responses offline instead of running new tests
+    if args.replay:
+        all_tests = replay_archive(args.replay, workers=args.workers)
+        save_results(all_tests, args.replay + "_replay.csv")
+        return
+
+    # scores the results of offline TogetherComputer requests instead of running new tests
+    if args.ingest_togethercomputer:
+        rows = ingest_results(args.ingest_togethercomputer, "togethercomputer/results.csv", solutions_path=args.solutions, chunk_size=args.ingest_chunk_size)
+        print(f"{rows} result rows written to togethercomputer/results.csv")
+        return
+
+    # compares the results of several runs (or of the models of one run) instead of running new tests
+    if args.compare:
+        paths = args.compare.split(',')
+        conditions = conditions_by(open_results(paths[0])) if len(paths) == 1 else {path: open_results(path) for path in paths}
+        pool = get_worker_pool(args.workers) if args.workers else None
+        comparison_df = compare_conditions(conditions, metric=args.compare_metric, paired=args.compare_paired, resamples=args.resamples,
+                                           correction=None if args.correction == 'none' else args.correction, seed=args.replicate_seed, pool=pool)
+        print(comparison_df[comparison_df['significant']])
+        save_results(comparison_df, "comparison.csv")
+        return
+
     tester = Tester()
 
-    # all_tests = tester.run_two_feature_tests_with_two_set(args)
-    all_tests = tester.run_baseline_tests_for_finetuning(args)
-    file_name = "finetune_test"
-    all_tests.to_csv(file_name)
+    # writes the Prompts of a sweep to a frozen corpus instead of running it
+    if args.materialize:
+        manifest = materialize(args.materialize, tester.sweep_cells(args.sweep, args), seed=args.seed)
+        print(f"{manifest['prompts']} prompts written to {args.materialize}")
+        return
+
+    # estimates the shots needed to lock onto each salient task by adaptive search instead of querying every shot count
+    if args.search_shots:
+        thresholds_df, curves_df = search_thresholds(tester, args, target=args.target_accuracy, max_queries=args.max_queries)
+        print(thresholds_df)
+        save_results(thresholds_df, "shot_search.csv")
+        save_results(curves_df, "shot_search_curves.csv")
+        return
+
+    # plans the requests, tokens, cost and time of a sweep without querying any API
+    if args.dry_run:
+        planner = TokenBudgetPlanner(get_tokenizer(args.tokenizer), requests_per_minute=args.rpm, tokens_per_minute=args.tpm, tokenizer=args.tokenizer)
+        # the settings are sampled in the worker pool if a number of workers is given
+        pool = get_worker_pool(args.workers) if args.workers else None
+        plan_df = planner.plan(tester.sweep_cells(args.sweep, args), cooldown=tester.sweep_cooldown(args.sweep, args), pool=pool)
+        print(plan_df)
+        print(summarize_plan(plan_df))
+        save_results(plan_df, args.sweep + "_plan.csv")
+        return
+
+    # runs a sweep against a local stub of the OpenAI API and reports how the request path holds up, instead of querying the API
+    if args.load_test:
+        all_tests, report = load_test_sweep(tester, args)
+        for key, value in report.items():
+            print(f"{key}: {value}")
+        save_results(all_tests, args.sweep + "_load_test.csv")
+        return
+
+    # runs a sweep as offline batch jobs: writes its requests (unless a previous run did), waits for every shard and scores the results
+    if args.batch:
+        if not os.path.exists(os.path.join(args.batch, 'manifest.json')):
+            manifest = write_batch(args.batch, tester.sweep_cells(args.sweep, args), shard_size=args.batch_shard_size)
+            print(f"{manifest['requests']} requests written to {len(manifest['shards'])} shards in {args.batch}")
+        run_batch(args.batch, SUBMITTERS[args.batch_submitter](), poll_seconds=args.poll_seconds, retries=args.retries)
+        save_results(collect_batch(args.batch, workers=args.workers), os.path.join(args.batch, "results.csv"))
+        return
+
+    # distributes the cells of a sweep through a shared work queue instead of running them in this process
+    if args.queue:
+        queue = WorkQueue(args.queue)
+        if args.role == 'coordinator':
+            queue.enqueue(args.sweep, tester.sweep_cells(args.sweep, args))
+        elif args.role == 'worker':
+            run_worker(queue, tester, args.results_dir, cooldown=args.cooldown)
+        else:
+            save_results(collect_results(queue), "queue_results.csv")
+        print(queue.counts())
+        return
+
+    all_tests = tester.run_sweep(args.sweep, args)
+    file_name = "finetune_test" if args.sweep == 'baseline_for_finetuning' else args.sweep + "_test"
+    save_results(all_tests, file_name)
+    if args.store:
+        # imported here so that runs without a store do not load pyarrow
+        from result_store import ResultStore
+        ResultStore(args.store).write(all_tests)
+    if 'replicate' in all_tests.columns:
+        replicates_df = replicate_summary(all_tests)
+        print(replicates_df)
+        save_results(replicates_df, file_name + "_replicates")
+    if args.clarifying and not all_tests.empty:
+        print(clarification_summary(all_tests))
+    print(get_hedger().report())
 
 if __name__ == "__main__":
     main()
@@ -1,5 +1,11 @@
 import pandas as pd
+import logging
 import numpy as np
+from logprob_tensor import LabelLogprobs
+from structured_logging import log
+
+# identifies every example, and every label row scored for it
+EXAMPLE_KEY = ['prompt_id', 'example_number']
 
 class MetricWrangler:
     """
@@ -19,19 +25,22 @@ class MetricWrangler:
         test_example_prob (list(float)): a list of all the probabilities for the final label (query)
         final_probs_list (list(float)): a list of the all the probailities for all the alternatives for the query 
         accuracies (list(float)): a list of the accuracies for the query (either 0 or 1 for each query)
+        malformed_prompts (list(int)): ids of the Prompts dropped because their label rows did not line up with their examples
     """
     def __init__(self):
         self.test_example_prob = []
         self.final_probs_list = []
         self.accuracies = []
+        self.malformed_prompts = []
 
-    def label_probs(self, output_df, generate_instruction):
+    def label_probs(self, output_df, generate_instruction, prompt_id=0):
         """
         Isolate the probs for the X/Y labels from the output in a dataframe
 
         Args:
             output_df (pd.DataFrame): the data outputted by the OPENAI API
             generate_instruction (bool): a boolean to determine if an instruction should be generated or not
+            prompt_id (int): the id of the Prompt the output belongs to
 
         Returns:
             label_df (pd.DataFrame): a DataFrame containing only neeccessary information from the output: label tokens (X/Y) and their corresponding '
@@ -41,35 +50,71 @@ class MetricWrangler:
         # removes all rows not containig the label tokens ('X' or 'Y')
         label_df = output_df.loc[(output_df['tokens'].str.strip(' ').str.strip("'") == 'X') | (output_df['tokens'].str.strip(' ').str.strip("'") == 'Y')]
         
-        label_df['top_k_probs'] = label_df['top_logprobs'].apply(lambda row: self.as_percentages(row))
-        label_df.drop(columns=['top_logprobs'], inplace=True)
-        
         # removes label token probabilities for tokens in the instruction (as the instruction mentioned 'X' and 'Y')
         if generate_instruction:
             label_df = label_df.iloc[2: , :]
 
         # removes irrelevant column
-        label_df = label_df.reset_index()
-        label_df = label_df.drop(['index'], axis=1)
+        label_df = label_df.reset_index(drop=True)
 
+        label_df['prompt_id'] = prompt_id
         label_df['example_number'] = label_df.index + 1
 
-        self.update_accuracy(label_df)
-        
-        label_df['%'] = label_df.apply(lambda row: self.recalc_percentage(row['tokens'].strip(), row['top_k_probs'], row['%']), axis=1)
+        label_logprobs = LabelLogprobs.from_top_logprobs(label_df['tokens'], label_df['top_logprobs'], label_df['token_logprobs'])
 
-        return label_df
+        return self.score_label_rows(label_df, label_logprobs)
     
-    def recalc_percentage(self, token, token_dict, curr_percentage):
-        if token in token_dict:
-            return token_dict[token]
-        else:
-            return curr_percentage
+    def label_query_probs(self, query_df, prompt_id=0):
+        """
+        Score a query-only output (see APIAccess.to_query_dataframe) and produce the same '%' and 'accurate' columns as label_probs()
+
+        As only the top logprobs of the next token are available, '%' is the (space-combined) probability of the correct label
+        among the top logprobs, and 0 if the correct label is not among them
+
+        Args:
+            query_df (pd.DataFrame): a single-row DataFrame with the correct label ('tokens') and the top logprobs of the next token
+            prompt_id (int): the id of the Prompt the output belongs to
+
+        Returns:
+            label_df (pd.DataFrame): a DataFrame containing the label token of the query and its corresponding probabilities
+        """
+        label_logprobs = LabelLogprobs.from_top_logprobs(query_df['tokens'], query_df['top_logprobs'])
+
+        query_df = query_df.copy()
+        query_df['prompt_id'] = prompt_id
+
+        return self.score_label_rows(query_df, label_logprobs)
+
+    def score_label_rows(self, label_df, label_logprobs):
+        """
+        Replaces the top logprob dicts of the label rows with the fixed-width logprob columns and adds the '%' and 'accurate' columns
+
+        Args:
+            label_df (pd.DataFrame): the label rows ('tokens', 'prompt_id', 'example_number' and the raw logprob columns)
+            label_logprobs (LabelLogprobs): the parsed records of the label rows
+        Returns:
+            label_df (pd.DataFrame): the label rows with 'tokens', 'prompt_id', 'example_number', the LOGPROB_COLUMNS, 'accurate' and '%'
+        """
+        label_df = label_df.drop(columns=['top_logprobs', 'token_logprobs', '%'], errors='ignore')
+
+        for column, values in label_logprobs.to_frame().items():
+            label_df[column] = values.to_numpy()
+
+        self.update_accuracy(label_df, label_logprobs)
+
+        label_df['%'] = label_logprobs.percentages()
+
+        return label_df
     
     def construct_test_example_df(self, test_examples, test_examples_output_df):
         """
         Constructs the complete DataFrame for the queries including both the input and output information
 
+        Examples and label rows are joined on their (prompt_id, example_number) key, so it can be called once per Prompt as its output
+        arrives. Label rows are numbered by position (see label_probs()), so a Prompt whose output yields a different number of label
+        rows than it has examples, or a label token other than the label of its example (an extra or missing 'X'/'Y' token shifts
+        every following row), is malformed: all of its rows are dropped and its id is added to malformed_prompts.
+
         Args:
             test_examples (list(Example)): a list of all the queries and their relevant information
             test_examples_output_df (pd.DataFrame): a DataFrame of all the outputs obtained from the API for the queries
@@ -78,54 +123,63 @@ class MetricWrangler:
             corresponding examples and their corresponding probabilities
         """
         test_examples_input_df = pd.DataFrame.from_records(e.as_dict() for e in test_examples)
-        test_examples_complete_df = pd.concat([test_examples_input_df, test_examples_output_df], axis=1, join='inner')
-         
+        if test_examples_input_df.empty or test_examples_output_df.empty:
+            return pd.DataFrame()
+
+        test_examples_complete_df = test_examples_input_df.merge(test_examples_output_df, on=EXAMPLE_KEY, how='inner', validate='one_to_one')
+
+        examples = test_examples_input_df.groupby('prompt_id').size()
+        label_rows = test_examples_output_df.groupby('prompt_id').size().reindex(examples.index, fill_value=0)
+        expected_labels = np.where(test_examples_complete_df['active_task_label'] == True, 'X', 'Y')
+        mislabeled = test_examples_complete_df['tokens'].str.strip(' ').str.strip("'") != expected_labels
+        prompt_ids = sorted(set(examples.index[examples != label_rows]) | set(test_examples_complete_df.loc[mislabeled, 'prompt_id']))
+        if prompt_ids:
+            self.malformed_prompts.extend(prompt_ids)
+            log(logging.WARNING, 'malformed prompts dropped', prompt_ids=prompt_ids)
+            test_examples_complete_df = test_examples_complete_df[~test_examples_complete_df['prompt_id'].isin(prompt_ids)].reset_index(drop=True)
+
         return test_examples_complete_df
 
-    def as_percentages(self, final_logits):
-        return {keys: 100*np.exp(vals) for keys, vals in final_logits.items()}
-    
     def append_to_list(self, final_percentages):
         self.final_probs_list.append(final_percentages)
     
-    def update_accuracy(self, label_df):
+    def update_accuracy(self, label_df, label_logprobs):
         """
-        Checks whether the most recent query was classified correctly and appends the result to self.accuracies
+        Checks whether each label row was classified correctly, i.e. whether the correct label has the highest probability among the top-k
+        (combining probabilities for keys which only differ from 'X'/'Y' by extraneous spaces), and appends the results to self.accuracies
 
         Args:
-            probs_df (pd.DataFrame): a dataframe of the probabilities for the query
-            label_percentages (dict): a dictionary of the top 4 probabilities from the API for the query
+            label_df (pd.DataFrame): a dataframe of the label rows, to which the 'accurate' column is added
+            label_logprobs (LabelLogprobs): the parsed records of the label rows
         Returns:
-            ret (int): 1 if the model correctly predicted the output and 0 otherwise
+            None
         """
-        label_df['accurate'] = label_df.apply(lambda row: self.check_accuracy(row['top_k_probs'], row['tokens'].strip()), axis=1)
-
-    def check_accuracy(self, label_percentages, correct_label):
-        label_percentages = self.combine_keys(label_percentages)
-        ret = 1
-        if max(label_percentages, key=label_percentages.get) != correct_label:
-            ret = 0
-        self.accuracies.append(ret)
-        return ret
-    
-    def combine_keys(self, og_d):
-        """
-        Combines probabilities for keys which are correct but contain extraneous spaces, so wouldn't be 'graded' as correct
+        label_df['accurate'] = label_logprobs.accurate()
+        self.accuracies.extend(label_df['accurate'].tolist())
 
-        Args:
-            og_d: original 'graded' dataframe
-        Returns:
-            og_d: updated dataframe with combined probabilities for X/Y keys
-        """
-        new_d = og_d.copy()
-        if 'X' in new_d: del new_d['X']
-        if 'Y' in new_d: del new_d['Y']
-        new_d = {k.translate({32:None}) : v for k, v in new_d.items()}
-        
-        if 'X' in new_d: og_d['X'] = og_d.get('X', 0)+new_d.get('X', 0)
-        if 'Y' in new_d: og_d['Y'] = og_d.get('Y', 0)+new_d.get('Y', 0)
-
-        if ' X' in og_d: del og_d[' X']
-        if ' Y' in og_d: del og_d[' Y']
-
-        return og_d
+def replicate_summary(test_df, metric='accurate'):
+    """
+    Reports the variance between replicates alongside the pooled metric, for every model, construction type, salient task and format
+
+    Args:
+        test_df (pd.DataFrame): result rows with a 'replicate' column (see Tester.run_cells())
+        metric (str): the column to summarize
+    Returns:
+        summary_df (pd.DataFrame): per group, the number of replicates and rows, the pooled mean of metric over all rows, and the mean,
+        variance, standard error, minimum and maximum of its per-replicate means
+    """
+    keys = [key for key in ['model', 'construction_type', 'salient_task', 'format_type'] if key in test_df.columns]
+    replicate_df = test_df.groupby(keys + ['replicate'], dropna=False)[metric].agg(['mean', 'size']).reset_index()
+
+    groups = replicate_df.groupby(keys, dropna=False)
+    summary_df = pd.DataFrame({
+        'replicates': groups.size(),
+        'rows': groups['size'].sum(),
+        'pooled': test_df.groupby(keys, dropna=False)[metric].mean(),
+        'replicate_mean': groups['mean'].mean(),
+        'replicate_var': groups['mean'].var(ddof=1),
+        'replicate_min': groups['mean'].min(),
+        'replicate_max': groups['mean'].max(),
+    })
+    summary_df['replicate_se'] = np.sqrt(summary_df['replicate_var'] / summary_df['replicates'])
+    return summary_df.reset_index()
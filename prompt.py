@@ -1,7 +1,9 @@
 import random
-from example_generation import SubjectLocationGenerator, ProperNounNegationGenerator, ReligiousPronounGenerator
+import numpy as np
+from example_generation import ExampleGenerator, SubjectLocationGenerator, ProperNounNegationGenerator, ReligiousPronounGenerator
 from instruction import Instruction
-from example import Example
+from example import Example, number_examples
+from feature_schema import SCHEMAS, to_example
 
 class Prompt:
     """
@@ -24,21 +26,28 @@ class Prompt:
         for_finetuning (bool): True if generating examples with withheld salient tasks for finetuning
         finetuning_control (bool): True if generating examples for finetuning control tests
         salient_task (str): salient task for which to make examples (not required to generate examples)
+        plan (PromptPlan): pre-sampled random choices from a StratifiedSampler (only used when salient_task is given)
+        prompt_id (int): the id of the Prompt, which together with the example number keys every Example of the Prompt
+        rng (random.Random): source of every random choice made for the Prompt and its Examples, e.g. the stream of one replicate (the global random module by default)
     """
-    def __init__(self, shots, construction_type, format_type, needs_instruction, needs_informative, include_ambiguous_examples, prob_of_ambiguous, for_finetuning, finetuning_control, salient_task = None):
+    def __init__(self, shots, construction_type, format_type, needs_instruction, needs_informative, include_ambiguous_examples, prob_of_ambiguous, for_finetuning, finetuning_control, salient_task = None, plan = None, prompt_id = 0, rng = None):
+        self.rng = rng if rng is not None else random
         self.shots = shots
         self.construction_type = construction_type
         self.examples = []
         self.format_type = format_type
         self.instruction = ""
         self.clarifying_assertion = ""
+        self.prompt_id = prompt_id
 
         # makes examples based on type of test being run: either with an explicit sales task or without
         if salient_task != None:
-            self.make_given_distribution_examples(prob_of_ambiguous=prob_of_ambiguous, needs_instruction=needs_instruction, needs_informative=needs_informative, salient_task=salient_task, for_finetuning=for_finetuning, finetuning_control=finetuning_control)
+            self.make_given_distribution_examples(prob_of_ambiguous=prob_of_ambiguous, needs_instruction=needs_instruction, needs_informative=needs_informative, salient_task=salient_task, for_finetuning=for_finetuning, finetuning_control=finetuning_control, plan=plan)
         else:
             self.make_examples(needs_instruction, needs_informative, include_ambiguous_examples)
 
+        number_examples(self.examples, prompt_id)
+
     def check_construction_type(self):
         """
         Checks what type of object to make based upon the specific contruction type
@@ -49,14 +58,18 @@ class Prompt:
             construction_obj (ExampleGenerator): the object corresponding to the specific construction type
         """
         construction_generator_classes = {
-            'subject_location' : SubjectLocationGenerator(self.construction_type, self.format_type),
-            'propn_negation' : ProperNounNegationGenerator(self.construction_type, self.format_type),
-            'religious_pronoun' : ReligiousPronounGenerator(self.construction_type, self.format_type),
+            'subject_location' : SubjectLocationGenerator(self.construction_type, self.format_type, self.rng),
+            'propn_negation' : ProperNounNegationGenerator(self.construction_type, self.format_type, self.rng),
+            'religious_pronoun' : ReligiousPronounGenerator(self.construction_type, self.format_type, self.rng),
             }
         
         if self.construction_type in construction_generator_classes:
             construction_obj = construction_generator_classes[self.construction_type]
             return construction_obj
+
+        # constructions with more than two features only have a schema
+        if self.construction_type in SCHEMAS:
+            return ExampleGenerator(self.construction_type, self.format_type, self.rng)
         
         raise Exception("invalid construction type")
 
@@ -74,6 +87,9 @@ class Prompt:
         Returns:
             None
         """
+        if len(SCHEMAS[self.construction_type].features) > 2:
+            raise Exception("constructions with more than two features require a salient task")
+
         current_examples = []
 
         '''
@@ -86,7 +102,7 @@ class Prompt:
             Label 1: Y
             Label 2: X
         '''
-        examples_label_randomizer = random.choice([True, False])
+        examples_label_randomizer = self.rng.choice([True, False])
 
         '''
         Randomizes the order of the examples -- such that ~50% of the time the first example has one set of features and the second has the other
@@ -98,7 +114,7 @@ class Prompt:
             Example 1: The {animal} is in the {outdoor_location}
             Example 2: The {human} is in the {indoor_location}
         '''
-        examples_order_randomizer = random.choice([True, False])
+        examples_order_randomizer = self.rng.choice([True, False])
 
         # generates the first two examples using the randomizers explained above
         # selected the correct ExampleGenerator object based on the construction type
@@ -125,11 +141,11 @@ class Prompt:
         But if query_randomzier == False:
             Query: The {animal} is in the {indoor_location}
         '''
-        query_randomizer = random.choice([True, False])
+        query_randomizer = self.rng.choice([True, False])
 
         # Randomizes the label of the query -- such that ~50% of the time the query label is X (if query_label_randomzier = True) 
         # and the other 50% it is Y (if query_label_randomzier = False)
-        query_label_randomizer = random.choice([True, False])
+        query_label_randomizer = self.rng.choice([True, False])
 
         # Generates the query
         query = construction_obj.generate_example(query_randomizer, not query_randomizer, query_label_randomizer)
@@ -150,10 +166,13 @@ class Prompt:
             self.examples.append(example)
             current_examples.append(example)
 
-    def make_given_distribution_examples(self, prob_of_ambiguous, needs_instruction, needs_informative, for_finetuning, finetuning_control, salient_task):
+    def make_given_distribution_examples(self, prob_of_ambiguous, needs_instruction, needs_informative, for_finetuning, finetuning_control, salient_task, plan=None):
         """
         Generates examples given a salient task
 
+        If a plan is given, the labels, task orderings and ambiguous/disambiguating slots are taken from it instead of being
+        sampled independently for each Prompt (see StratifiedSampler)
+
         Args:
             needs_instruction (bool): True if instruction needed and False otherwise
             needs_informative (bool): True if instruction is informative and False otherwise
@@ -161,59 +180,50 @@ class Prompt:
             for_finetuning (bool): True if wish to generate examples for finetuning and False otherwise
             finetuning_control (bool): True if running control tests for finetuning and False otherwise
             salient_task (str): The salient task for the set of examples
+            plan (PromptPlan): pre-sampled random choices for this Prompt, or None to sample them independently
         Returns:
             None
         """
         current_examples = []
-        examples_distribution = ['ambiguous'] * prob_of_ambiguous + ['disambiguating'] * (100 - prob_of_ambiguous)
 
-        salient_task_label = random.choice([True, False])
-        active_task_label = random.choice([True, False])
-
-        possible_task_a = ['subject', 'religious', 'propn']
-        possible_task_b = ['location', 'pronoun', 'negation']
+        if plan is not None:
+            salient_task_label = plan.salient_task_label
+            active_task_label = plan.active_task_label
+        else:
+            salient_task_label = self.rng.choice([True, False])
+            active_task_label = self.rng.choice([True, False])
 
         construction_obj = self.check_construction_type()
-        
-        if salient_task in possible_task_a:
-            salient = 'task_a'
-        elif salient_task in possible_task_b:
-            salient = 'task_b'
-        else:
-            raise Exception("invalid salient task")
+        schema = construction_obj.schema
+        salient_index = schema.feature_index(salient_task)
+        salient = schema.task_keys[salient_index]
 
         if for_finetuning and finetuning_control:
-            randomize_tasks = random.choice([True, False])
+            randomize_tasks = plan.prompt_task_ordering if plan is not None else self.rng.choice([True, False])
 
         # generated specified number of examples
-        for _ in range(self.shots):
+        for i in range(self.shots):
             if not for_finetuning or not finetuning_control:
-                randomize_tasks = random.choice([True, False])
-
-            example_type = random.choice(examples_distribution)
-
-            # Randomzies the example generated which maintaining the specified salient test for the set of examples
-            if example_type == 'disambiguating':
-                if randomize_tasks and salient == 'task_a':
-                    example = construction_obj.generate_example(salient_task_label, not salient_task_label, active_task_label, salient_task)
-                elif not randomize_tasks and salient == 'task_a':
-                    example = construction_obj.generate_example(not salient_task_label, salient_task_label, not active_task_label, salient_task)
-                elif randomize_tasks and salient == 'task_b':
-                    example = construction_obj.generate_example(not salient_task_label, salient_task_label, active_task_label, salient_task)
-                else:
-                    example = construction_obj.generate_example(salient_task_label, not salient_task_label, not active_task_label, salient_task)
+                randomize_tasks = plan.task_orderings[i] if plan is not None else self.rng.choice([True, False])
+
+            if plan is not None:
+                example_type = plan.example_types[i]
             else:
-                if randomize_tasks:
-                    example = construction_obj.generate_example(salient_task_label, salient_task_label, active_task_label, salient_task)
-                else:
-                    example = construction_obj.generate_example(not salient_task_label, not salient_task_label, not active_task_label, salient_task)
+                example_type = 'ambiguous' if self.rng.random() * 100 < prob_of_ambiguous else 'disambiguating'
+
+            # the task ordering decides which label of the salient feature (and output label) the example shows; the other features
+            # agree with the salient feature in an ambiguous example and (at least one of them) disagree in a disambiguating example
+            salient_value = salient_task_label == randomize_tasks
+            labels = schema.example_labels(salient_index, salient_value, example_type == 'ambiguous', self.rng)
+            example = construction_obj.generate_feature_example(labels, active_task_label == randomize_tasks, salient_task)
         
             current_examples.append(example)
             self.examples.append(example)
 
         # adds instruction if needed
         if needs_instruction:
-           self.instruction = self.generate_instruction(current_examples, needs_informative, True, salient)
+           # the instruction is looked up from the known salient task rather than inferred from the first examples, which need not share its label
+           self.instruction = self.generate_instruction(current_examples, needs_informative, False, salient)
     
     def set_salient_task(self, current_examples, include_ambiguous_examples, salient_task_a_or_b=None):
         """
@@ -268,4 +278,54 @@ class Prompt:
             else:
                 print('<br>&gt;Y')
  
-        print("###")
\ No newline at end of file
+        print("###")
+
+
+class SchemaPrompt(Prompt):
+    """
+    A Prompt whose examples were sampled as part of a batch (see sample_prompts()); it can be used wherever a Prompt is used
+    """
+    def __init__(self, shots, construction_type, format_type, examples, instruction, prompt_id):
+        self.shots = shots
+        self.construction_type = construction_type
+        self.format_type = format_type
+        self.examples = examples
+        self.instruction = instruction
+        self.clarifying_assertion = ""
+        self.prompt_id = prompt_id
+        number_examples(self.examples, prompt_id)
+
+def sample_prompts(construction_type, format_type, queries, shots, salient_task, prob_of_ambiguous, needs_instruction, needs_informative, rng=None, prompt_id_start=0):
+    """
+    Generates a batch of Prompts for a construction type with any number of features (see FeatureSchema): the labels of every
+    example of the batch are sampled as one boolean array, the words of every slot are drawn with one array operation per slot,
+    and each informative instruction is looked up from the salient task and its label for 'X'
+
+    Args:
+        construction_type (str): one of SCHEMAS
+        format_type (str): the type of format to generate: ['qa', 'arrow']
+        queries (int): the number of Prompts
+        shots (int): the number of examples of each Prompt
+        salient_task (str): the feature determining the labels
+        prob_of_ambiguous (float): number from 0 to 100 indicating the percentage of ambiguous examples
+        needs_instruction (bool): True if wish to generate an instruction and False otherwise
+        needs_informative (bool): True if the instruction is informative and False otherwise
+        rng (np.random.Generator or int): source of randomness, or its seed
+        prompt_id_start (int): the id of the first Prompt
+    Returns:
+        prompts (list(SchemaPrompt)): the Prompts
+    """
+    schema = SCHEMAS[construction_type]
+    rng = np.random.default_rng(rng)
+    labels, active, x_values = schema.sample_labels(queries, shots, salient_task, prob_of_ambiguous, rng)
+    sentences = schema.render_batch(labels.reshape(queries * shots, -1), rng)
+    salient_key = schema.task_keys[schema.feature_index(salient_task)]
+
+    prompts = []
+    for p in range(queries):
+        examples = [to_example(schema, format_type, sentences[p * shots + s], labels[p, s], active[p, s], salient_task) for s in range(shots)]
+        instruction = ""
+        if needs_instruction:
+            instruction = schema.instruction((salient_key, bool(x_values[p]))) if needs_informative else Instruction(construction_type).make_uninformative_instruction()
+        prompts.append(SchemaPrompt(shots, construction_type, format_type, examples, instruction, prompt_id_start + p))
+    return prompts
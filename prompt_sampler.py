@@ -0,0 +1,127 @@
+import random
+from dataclasses import dataclass, field
+
+@dataclass
+class PromptPlan:
+    """
+    A dataclass holding every random choice needed to build one Prompt with make_given_distribution_examples
+
+    Attributes:
+        salient_task_label (bool): the label of the salient task feature for the set of examples
+        active_task_label (bool): the output label paired with salient_task_label
+        prompt_task_ordering (bool): the task ordering shared by every example (used by finetuning control tests)
+        task_orderings (list(bool)): the task ordering (randomize_tasks) of each example in the Prompt
+        example_types (list(str)): 'ambiguous' or 'disambiguating' for each example in the Prompt
+    """
+    salient_task_label: bool
+    active_task_label: bool
+    prompt_task_ordering: bool
+    task_orderings: list = field(default_factory=list)
+    example_types: list = field(default_factory=list)
+
+class StratifiedSampler:
+    """
+    Plans the random choices for all the Prompts of a cell (one construction_type + format_type + salient_task run) up front
+
+    Sampling each choice independently lets the label balance and the ambiguity rate of a cell drift from run to run.
+    Instead, the (salient_task_label, active_task_label) pairs are dealt out of shuffled blocks containing all four combinations,
+    the per-example task orderings are split evenly within every Prompt, and the number of ambiguous examples per Prompt
+    follows a randomly offset low-discrepancy sequence so that the whole cell hits prob_of_ambiguous as closely as possible.
+    The positions of the ambiguous examples and orderings within a Prompt are still shuffled.
+
+    For example, with queries=4, shots=5 and prob_of_ambiguous=50, every label pair appears exactly once and the cell
+    contains exactly 10 ambiguous examples (split 2/3/2/3 or 3/2/3/2 between the Prompts).
+
+    Attributes:
+        queries (int): the number of Prompts in the cell
+        shots (int): the number of examples in each Prompt
+        prob_of_ambiguous (float): number from 0 to 100 indicating the percentage of examples that should be ambiguous
+        rng (random.Random): source of every random choice (the global random module by default)
+        plans (list(PromptPlan)): the plan for each Prompt, in order
+    """
+    def __init__(self, queries, shots, prob_of_ambiguous, rng=None):
+        self.rng = rng if rng is not None else random
+        self.queries = queries
+        self.shots = shots
+        self.prob_of_ambiguous = prob_of_ambiguous
+        self.plans = self.make_plans()
+        self.next_plan_index = 0
+
+    def next_plan(self):
+        """
+        Returns the plan for the next Prompt of the cell
+
+        Returns:
+            plan (PromptPlan): the plan for the next Prompt
+        """
+        if self.next_plan_index >= len(self.plans):
+            raise Exception("stratified sampler exhausted: more prompts requested than queries in the cell")
+
+        plan = self.plans[self.next_plan_index]
+        self.next_plan_index += 1
+        return plan
+
+    def make_plans(self):
+        label_pairs = self.balanced_label_pairs(self.queries)
+        prompt_task_orderings = self.balanced_booleans(self.queries)
+        ambiguous_counts = self.low_discrepancy_counts(self.queries, self.shots, self.prob_of_ambiguous / 100)
+        ordering_counts = self.low_discrepancy_counts(self.queries, self.shots, 0.5)
+
+        plans = []
+        for i in range(self.queries):
+            example_types = ['ambiguous'] * ambiguous_counts[i] + ['disambiguating'] * (self.shots - ambiguous_counts[i])
+            task_orderings = [True] * ordering_counts[i] + [False] * (self.shots - ordering_counts[i])
+            self.rng.shuffle(example_types)
+            self.rng.shuffle(task_orderings)
+
+            plans.append(PromptPlan(
+                salient_task_label=label_pairs[i][0],
+                active_task_label=label_pairs[i][1],
+                prompt_task_ordering=prompt_task_orderings[i],
+                task_orderings=task_orderings,
+                example_types=example_types
+            ))
+        return plans
+
+    def balanced_label_pairs(self, n):
+        """
+        Deals n (salient_task_label, active_task_label) pairs out of shuffled blocks of all four combinations
+
+        Args:
+            n (int): the number of pairs needed
+        Returns:
+            pairs (list(tuple(bool, bool))): n pairs, exactly balanced for every multiple of four
+        """
+        combinations = [(True, True), (True, False), (False, True), (False, False)]
+        pairs = []
+        while len(pairs) < n:
+            block = combinations.copy()
+            self.rng.shuffle(block)
+            pairs.extend(block)
+        return pairs[:n]
+
+    def balanced_booleans(self, n):
+        values = [True] * (n // 2) + [False] * (n // 2)
+        if n % 2:
+            values.append(self.rng.choice([True, False]))
+        self.rng.shuffle(values)
+        return values
+
+    def low_discrepancy_counts(self, n, size, fraction):
+        """
+        Splits round(n * size * fraction) successes between n groups of the given size so that every group receives
+        either the floor or the ceiling of size * fraction
+
+        The rounding remainders are spread with a randomly offset sequence floor(i * size * fraction + offset),
+        which keeps the running total within one of its expected value at every prefix of the cell
+
+        Args:
+            n (int): the number of groups (Prompts)
+            size (int): the number of items in each group (shots)
+            fraction (float): number from 0.0 to 1.0, the fraction of items that are successes
+        Returns:
+            counts (list(int)): the number of successes in each group
+        """
+        offset = self.rng.random()
+        expected = size * fraction
+        return [int((i + 1) * expected + offset) - int(i * expected + offset) for i in range(n)]
@@ -1,8 +1,44 @@
+import logging
+import random
+import uuid
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from api_access import APIAccess
-from crfm_access import CRFMAccess
 from metric_wrangler import MetricWrangler
-from prompt import Prompt
+from prompt import Prompt, sample_prompts
+from feature_schema import K_FEATURE_CONSTRUCTION_TYPES
+from frozen_corpus import FrozenCorpus
+from prompt_sampler import StratifiedSampler
+from response_archive import ResponseArchive
+from clarification import consume_stream
+from structured_logging import CellSummary, sampled, log
+from hedging import get_hedger
+
+BACKENDS = ['openai', 'crfm', 'local', 'lean']
+# formats every Prompt is rendered through in paired mode
+PAIRED_FORMATS = ['qa', 'arrow']
+
+def get_access_class(backend):
+    """
+    Returns the APIAccess (sub)class used to query a backend: one of BACKENDS
+    """
+    # the CRFM client is only imported when used as it requires the Stanford benchmarking code
+    if backend == 'crfm':
+        from crfm_access import CRFMAccess
+        return CRFMAccess
+    # the local backend is only imported when used as it requires torch and transformers
+    if backend == 'local':
+        from local_access import LocalAccess
+        return LocalAccess
+    if backend == 'lean':
+        from lean_access import LeanAccess
+        return LeanAccess
+
+    access_classes = {
+        'openai': APIAccess
+    }
+    return access_classes[backend]
 
 class QueryPipeline:
     """
@@ -14,21 +50,23 @@ class QueryPipeline:
         model (str): the OpenAI model to query with the prompts
         construction_format (str): format of examples to generate: one of {qa, arrow}
         crfm (bool): True if running tests on Stanford CRFM, False otherwise
+        models (list(tuple(str, str))): (backend, model) pairs to which every Prompt is sent; defaults to [(crfm or openai, model)]
     """
-    def __init__(self, construction_type, shots, model, construction_format, crfm):
+    def __init__(self, construction_type, shots, model, construction_format, crfm, models=None):
         self.construction_type = construction_type
         self.shots = shots
         self.model = model
         self.construction_format = construction_format
         self.crfm = crfm
+        self.models = models if models else [('crfm' if crfm else 'openai', model)]
         
-    def run_pipeline(self, queries, needs_instruction, verbose, needs_informative, include_ambiguous_examples, prob_of_ambiguous, togethercomputer, for_finetuning, finetuning_control, salient_task=None):
+    def run_pipeline(self, queries, needs_instruction, verbose, needs_informative, include_ambiguous_examples, prob_of_ambiguous, togethercomputer, for_finetuning, finetuning_control, salient_task=None, stratified=False, query_only=False, archive=None, corpus=None, corpus_start=0, paired=False, clarifying=False, rng=None):
         """
         Creates a sample test pipeline with which to generate prompts, query the API, and parse the output
         Args:
             queries (str): the number of prompts to query the API with
             needs_instruction (bool): True if Prompt requires instruction, False otherwise
-            verbose (bool): True to provide printed output, False otherwise
+            verbose (bool): True to log sampled Prompts and their label rows in full at DEBUG level (see structured_logging.configure_logging())
             needs_informative (bool): True if requires informative instruction, False otherwise
             include_ambiguous_examaples (bool): True if wish to include ambiguous examples and False otherwise
             prob_of_ambiguous (float): Number from 0.0 to 1.0 indicating the probability of each example generated being an ambigous example
@@ -36,50 +74,246 @@ class QueryPipeline:
             for_finetuning (bool): True if generating examples with withheld salient tasks for finetuning
             finetuning_control (bool): True if running tests for finetuning control and False otherwise
             salient_task (str): salient task for which to make examples (not required to generate examples)
+            stratified (bool): True to balance labels, task orderings and the ambiguity rate exactly across the Prompts of this run (requires salient_task)
+            query_only (bool): True to score only the query of each Prompt from the next-token logprobs instead of echoing the whole Prompt
+            archive (str): path of a ResponseArchive to which every raw API response is appended (None to not archive responses)
+            corpus (str): path of a frozen corpus (see frozen_corpus.materialize()) from which to read the Prompts instead of generating them
+            corpus_start (int): prompt id in the corpus of the first Prompt of this run
+            paired (bool): True to render every Prompt through each of PAIRED_FORMATS and score all renderings together; rows are tagged
+                with the format they were rendered in and a 'pair_id' shared by the renderings of the same Prompt
+            clarifying (bool): True to generate a streamed answer to the query of every Prompt preceded by the clarifying assertion instead of
+                scoring the Prompt, and classify it as a direct answer or a clarifying question (see stream_clarifying())
+            rng (random.Random): source of every random choice made to generate the Prompts, e.g. the stream of one replicate (the global random module by default)
 
         Returns:
             complete_test_df (pd.DataFrame): a DataFrame containing all of the information from the set of Prompts for the current construction_type + format_type
         """
+        prompt_dfs = {model: [] for _, model in self.models}
+        for prompt_df in self.stream_pipeline(queries=queries, needs_instruction=needs_instruction, verbose=verbose, needs_informative=needs_informative, include_ambiguous_examples=include_ambiguous_examples,
+                                              prob_of_ambiguous=prob_of_ambiguous, togethercomputer=togethercomputer, for_finetuning=for_finetuning, finetuning_control=finetuning_control,
+                                              salient_task=salient_task, stratified=stratified, query_only=query_only, archive=archive, corpus=corpus, corpus_start=corpus_start, paired=paired, clarifying=clarifying, rng=rng):
+            prompt_dfs[prompt_df['model'].iloc[0]].append(prompt_df)
+
+        # keeps the rows of each model together, as before the results were streamed
+        model_dfs = [df for model_prompt_dfs in prompt_dfs.values() for df in model_prompt_dfs]
+        complete_test_df = pd.concat(model_dfs, ignore_index=True) if model_dfs else pd.DataFrame()
+
+        return complete_test_df
+
+    def stream_pipeline(self, queries, needs_instruction, verbose, needs_informative, include_ambiguous_examples, prob_of_ambiguous, togethercomputer, for_finetuning, finetuning_control, salient_task=None, stratified=False, query_only=False, archive=None, corpus=None, corpus_start=0, paired=False, clarifying=False, rng=None):
+        """
+        Runs the pipeline as run_pipeline() does, but yields the result rows of every Prompt and model as soon as they are parsed,
+        so that a consumer writing them out (e.g. work_queue.run_worker()) only holds one Prompt in memory at a time
+
+        Every Prompt has the id corpus_start + i, and its examples are joined with their label rows on (prompt_id, example_number)
+
+        Args:
+            see run_pipeline()
+        Yields:
+            prompt_df (pd.DataFrame): the result rows of one Prompt for one model, with a 'model' column
+        """
+        formats = PAIRED_FORMATS if paired else [self.construction_format]
+        run_id = uuid.uuid4().hex[:8]
+        prompts = self.iter_prompts(queries=queries, needs_instruction=needs_instruction, needs_informative=needs_informative, include_ambiguous_examples=include_ambiguous_examples, prob_of_ambiguous=prob_of_ambiguous,
+                                    for_finetuning=for_finetuning, finetuning_control=finetuning_control, salient_task=salient_task, stratified=stratified, corpus=corpus, corpus_start=corpus_start, rng=rng)
+
+        summary = CellSummary(construction_type=self.construction_type, format_type=self.construction_format, shots=self.shots, salient_task=salient_task, models=[model for _, model in self.models],
+                              paired=paired, query_only=query_only, clarifying=clarifying)
+        for prompt_df in self.stream_prompts(prompts, formats, run_id, summary, needs_instruction, verbose, togethercomputer, for_finetuning, salient_task, query_only, archive, paired, clarifying):
+            summary.add(prompt_df)
+            yield prompt_df
+        summary.emit()
+        # cumulative over the process, so the last record reports the whole run
+        log(logging.INFO, 'latency', **get_hedger().report())
+
+    def stream_prompts(self, prompts, formats, run_id, summary, needs_instruction, verbose, togethercomputer, for_finetuning, salient_task, query_only, archive, paired, clarifying):
+        """
+        Queries and scores every Prompt of a run (see stream_pipeline()), counting the Prompts in summary
+        """
+        if clarifying:
+            yield from self.stream_clarifying(prompts, needs_instruction, formats, run_id if paired else None, verbose, summary=summary)
+            return
+
         wrangler = MetricWrangler()
-        examples = []
-        test_examples_output_df = pd.DataFrame()
+        response_archive = ResponseArchive(archive) if archive else None
         
-        for i in range(queries):
-            prompt = Prompt(construction_type=self.construction_type, shots=self.shots, format_type=self.construction_format, needs_instruction=needs_instruction, needs_informative=needs_informative, include_ambiguous_examples=include_ambiguous_examples, salient_task=salient_task, prob_of_ambiguous=prob_of_ambiguous, for_finetuning=for_finetuning, finetuning_control=finetuning_control)
-            
-            examples.extend(prompt.get_examples())
-
-            if verbose: prompt.print()
+        with ThreadPoolExecutor(max_workers=len(self.models) * len(formats)) as executor:
+            for prompt_id, prompt in prompts:
+                examples = prompt.get_examples()[-1:] if query_only else prompt.get_examples()
+                summary.prompts += 1
+                logged = verbose and sampled(prompt_id)
 
-            api_access = CRFMAccess(prompt) if self.crfm else APIAccess(prompt)
+                if logged: log(logging.DEBUG, 'prompt', prompt_id=prompt_id, instruction=prompt.get_instruction(), examples=[e.as_dict() for e in prompt.get_examples()])
 
-            if for_finetuning:
-                api_access.generate_data_for_openai_finetuning(format=self.construction_format, needs_instruction=needs_instruction)
-            
-            elif togethercomputer:
-                if self.construction_format == 'qa':
-                    max_tokens = 2
+                if for_finetuning:
+                    api_access = get_access_class('crfm' if self.crfm else 'openai')(prompt)
+                    api_access.generate_data_for_openai_finetuning(format=self.construction_format, needs_instruction=needs_instruction)
+                
+                elif togethercomputer:
+                    api_access = get_access_class('crfm' if self.crfm else 'openai')(prompt)
+                    if self.construction_format == 'qa':
+                        max_tokens = 2
+                    else:
+                        max_tokens = 1
+                    api_access.to_togethercomputer(format=self.construction_format, request_type="language-model-inference", model="t0pp", needs_instruction=needs_instruction, max_tokens=max_tokens, logprobs=4)
                 else:
-                    max_tokens = 1
-                api_access.to_togethercomputer(format=self.construction_format, request_type="language-model-inference", model="t0pp", needs_instruction=needs_instruction, max_tokens=max_tokens, logprobs=4)
+                    # renders the prompt once per backend and format, then sends every rendering to every model concurrently
+                    api_accesses = {}
+                    for backend, _ in self.models:
+                        if backend not in api_accesses:
+                            api_accesses[backend] = get_access_class(backend)(prompt)
+                            for format in formats:
+                                self.render(api_accesses[backend], format, needs_instruction, query_only)
+
+                    futures = {(backend, model, format): executor.submit(self.request, api_accesses[backend], model, format, needs_instruction, query_only) for backend, model in self.models for format in formats}
+
+                    for (backend, model, format), future in futures.items():
+                        output = future.result()
+                        api_access = api_accesses[backend]
+                        
+                        if response_archive:
+                            cell = {'model': model, 'construction_type': self.construction_type, 'format_type': format, 'shots': self.shots,
+                                    'salient_task': salient_task, 'needs_instruction': needs_instruction, 'query_only': query_only}
+                            if paired: cell['pair_id'] = f"{run_id}-{prompt_id}"
+                            response_archive.write(prompt, self.render(api_access, format, needs_instruction, query_only), output, cell, backend)
+
+                        if query_only:
+                            labeled_df = wrangler.label_query_probs(api_access.to_query_dataframe(output), prompt_id)
+                        else:
+                            probs_df = api_access.isolate_probs(api_access.to_numpy_dataframe(output))
+
+                            labeled_df = wrangler.label_probs(probs_df, needs_instruction, prompt_id)
+                        
+                        if logged: log(logging.DEBUG, 'labels', prompt_id=prompt_id, model=model, format_type=format, labels=labeled_df[['example_number', 'tokens', '%', 'accurate']].to_dict('records'))
+
+                        malformed = len(wrangler.malformed_prompts)
+                        prompt_df = wrangler.construct_test_example_df(test_examples=examples, test_examples_output_df=labeled_df)
+                        summary.malformed += len(wrangler.malformed_prompts) - malformed
+                        if not prompt_df.empty:
+                            prompt_df['model'] = model
+                            if paired:
+                                prompt_df['format_type'] = format
+                                prompt_df['pair_id'] = f"{run_id}-{prompt_id}"
+                            yield prompt_df
+
+    def iter_prompts(self, queries, needs_instruction, needs_informative, include_ambiguous_examples, prob_of_ambiguous, for_finetuning, finetuning_control, salient_task, stratified, corpus, corpus_start, rng=None):
+        """
+        Generates the Prompts of a run, or reads them from a frozen corpus
+
+        Yields:
+            (tuple(int, Prompt)): the id (corpus_start + i) and the i-th Prompt of the run
+        """
+        sampler = StratifiedSampler(queries, self.shots, prob_of_ambiguous, rng) if stratified and salient_task != None else None
+        frozen_corpus = FrozenCorpus.open(corpus) if corpus else None
+        if frozen_corpus:
+            frozen_corpus.check_settings(self.construction_type, salient_task, self.construction_format, self.shots, needs_instruction=needs_instruction, needs_informative=needs_informative,
+                                         include_ambiguous_examples=include_ambiguous_examples, for_finetuning=for_finetuning, finetuning_control=finetuning_control)
+
+        # Prompts of constructions with more than two features are sampled as one vectorized batch
+        # (as for two-feature Prompts with a salient task, the rate of ambiguous examples is set by prob_of_ambiguous alone, so
+        # include_ambiguous_examples does not apply)
+        if self.construction_type in K_FEATURE_CONSTRUCTION_TYPES and not frozen_corpus:
+            if salient_task == None:
+                raise Exception(f"{self.construction_type} Prompts require a salient task")
+            if stratified:
+                raise Exception(f"stratified sampling is not supported for {self.construction_type} Prompts")
+            if for_finetuning or finetuning_control:
+                raise Exception(f"finetuning Prompts are not supported for {self.construction_type}")
+            batch_rng = np.random.default_rng((rng or random).getrandbits(64))
+            for prompt in sample_prompts(self.construction_type, self.construction_format, queries, self.shots, salient_task, prob_of_ambiguous, needs_instruction, needs_informative, batch_rng, corpus_start):
+                yield prompt.prompt_id, prompt
+            return
+
+        for i in range(queries):
+            prompt_id = corpus_start + i
+            if frozen_corpus:
+                yield prompt_id, frozen_corpus.get(self.construction_type, salient_task, self.construction_format, self.shots, prompt_id)
             else:
-                output = api_access.request(self.model, self.construction_format, needs_instruction)
-                unpacked_df = api_access.to_numpy_dataframe(output)
-                
-                probs_df = api_access.isolate_probs(unpacked_df)
-                
-                if verbose: print("CURRENT PROMPT PROBS DF")
+                plan = sampler.next_plan() if sampler else None
+                yield prompt_id, Prompt(construction_type=self.construction_type, shots=self.shots, format_type=self.construction_format, needs_instruction=needs_instruction, needs_informative=needs_informative, include_ambiguous_examples=include_ambiguous_examples, salient_task=salient_task, prob_of_ambiguous=prob_of_ambiguous, for_finetuning=for_finetuning, finetuning_control=finetuning_control, plan=plan, prompt_id=prompt_id, rng=rng)
 
-                labeled_df = wrangler.label_probs(probs_df, needs_instruction)
-                
-                if verbose: print(labeled_df)
+    def stream_clarifying(self, prompts, needs_instruction, formats, run_id=None, verbose=False, max_workers=8, max_tokens=64, summary=None):
+        """
+        Prepends the clarifying assertion to the query of every Prompt (see APIAccess.generate_clarifying_prompt()), requests a streamed
+        greedy completion from every model and classifies it as it arrives: a direct 'X'/'Y' answer, a clarifying 'question' or 'other'.
+        Each stream is closed as soon as its outcome is decided, and up to max_workers streams are read concurrently.
 
-                test_examples_output_df = test_examples_output_df.append(labeled_df, ignore_index=True)
-                if verbose: print(test_examples_output_df)
+        Args:
+            prompts (iterable(tuple(int, Prompt))): the ids and Prompts of the run (see iter_prompts())
+            needs_instruction (bool): True if Prompt requires instruction, False otherwise
+            formats (list(str)): the formats in which every Prompt is rendered
+            run_id (str): prefix of the 'pair_id' of every Prompt in paired mode (None otherwise)
+            verbose (bool): True to log the outcomes of sampled Prompts at DEBUG level
+            max_workers (int): number of streams read concurrently
+            max_tokens (int): the maximum number of tokens generated for each response
+            summary (CellSummary): the summary of the cell, in which the Prompts are counted
+        Yields:
+            prompt_df (pd.DataFrame): one row for the query of one Prompt, model and format, in the order the outcomes are decided, with the
+            columns of the query Example, 'tokens' (the correct label), 'response_type', 'response', 'chunks', 'decision_seconds', 'accurate' and 'model'
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for prompt_id, prompt in prompts:
+                query = prompt.get_examples()[-1]
+                if summary: summary.prompts += 1
+                api_accesses = {}
+                for backend, model in self.models:
+                    if backend not in api_accesses:
+                        api_accesses[backend] = get_access_class(backend)(prompt)
+                        for format in formats:
+                            api_accesses[backend].generate_clarifying_prompt(format, needs_instruction)
 
-        complete_test_df = wrangler.construct_test_example_df(test_examples=examples, test_examples_output_df=test_examples_output_df)
-        
-        print("TEST EXAMPLES DF\n" + str(complete_test_df))
+                    for format in formats:
+                        future = executor.submit(lambda api_access, model, format: consume_stream(api_access.request_stream(model, format, needs_instruction, max_tokens)), api_accesses[backend], model, format)
+                        futures[future] = (prompt_id, query, model, format)
 
-        return complete_test_df
-        
+            for future in as_completed(futures):
+                prompt_id, query, model, format = futures[future]
+                row = dict(query.as_dict(), tokens='X' if query.active_task_label else 'Y', **future.result())
+                row['accurate'] = int(row['response_type'] == row['tokens'])
+                row['model'] = model
+                if run_id:
+                    row['format_type'] = format
+                    row['pair_id'] = f"{run_id}-{prompt_id}"
+
+                if verbose and sampled(prompt_id): log(logging.DEBUG, 'clarifying', prompt_id=prompt_id, model=model, format_type=format, response_type=row['response_type'], response=row['response'], chunks=row['chunks'])
+
+                yield pd.DataFrame([row])
+
+    def render(self, api_access, format, needs_instruction, query_only):
+        """
+        Renders (and caches on api_access) the exact prompt text that request() sends
+        """
+        if query_only:
+            return api_access.generate_query_prompt(format, needs_instruction)
+        return api_access.generate_formatted_prompt(format, needs_instruction, to_togethercomputer=False)
+
+    def request(self, api_access, model, format, needs_instruction, query_only):
+        """
+        Sends the scoring request of a Prompt through the hedger, which enforces the request deadline and may send the (idempotent) request twice
+        """
+        if query_only:
+            return get_hedger().call(lambda: api_access.request_query_only(model, format, needs_instruction), model)
+        return get_hedger().call(lambda: api_access.request(model, format, needs_instruction), model)
+
+def parse_model_specs(models, crfm):
+    """
+    Parses a comma-separated list of models, each optionally prefixed by its backend, e.g. "davinci,openai:text-davinci-002,crfm:ai21/j1-jumbo,local:checkpoints/gpt2"
+
+    Only the text before the first ':' can be a backend, and only if it is one of BACKENDS: the rest is the model name, which may
+    contain ':' itself (finetuned models such as "davinci:ft-personal-2022-10-01-00-00-00" or "ft:davinci-002:org::abc", local paths)
+
+    Args:
+        models (str): the comma-separated list of models
+        crfm (bool): True if models without a backend prefix run on Stanford CRFM, False if they run on the OpenAI API
+    Returns:
+        model_specs (list(tuple(str, str))): a (backend, model) pair for each model
+    """
+    model_specs = []
+    for model in models.split(','):
+        prefix, _, name = model.strip().partition(':')
+        if name and prefix in BACKENDS:
+            model_specs.append((prefix, name))
+        else:
+            model_specs.append(('crfm' if crfm else 'openai', model.strip()))
+    return model_specs
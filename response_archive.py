@@ -0,0 +1,185 @@
+import hashlib
+import json
+import struct
+import dataclasses
+from types import SimpleNamespace
+import pandas as pd
+import zstandard
+from example import Example, number_examples
+from metric_wrangler import MetricWrangler
+from worker_pool import get_worker_pool
+
+# every record is a 4-byte little-endian length followed by one independently compressed zstd frame
+RECORD_HEADER = struct.Struct('<I')
+
+class ArchivedPrompt:
+    """
+    Stands in for a Prompt when replaying an archived response: holds the archived Examples and instruction
+
+    Attributes:
+        examples (list(Example)): the examples (including the query) of the archived Prompt
+        instruction (str): the instruction of the archived Prompt ("" if none)
+    """
+    def __init__(self, examples, instruction):
+        self.examples = examples
+        self.instruction = instruction
+
+    def get_examples(self):
+        return self.examples
+
+    def get_instruction(self):
+        return self.instruction
+
+class ResponseArchive:
+    """
+    Appends every raw API response, together with the metadata of the Prompt that produced it, to a compressed archive file
+
+    Each record is a JSON object compressed into its own zstd frame, so records can be appended across runs and
+    decompressed independently (and in parallel) when replaying. A record contains:
+        key: sha256 hash of the exact prompt text sent to the API
+        cell: the model, construction_type, format_type, shots, salient_task, needs_instruction and query_only of the run (and pair_id in paired mode,
+              replicate for batch jobs, see batch_jobs.py)
+        backend: 'openai' or 'crfm'
+        instruction: the instruction of the Prompt
+        examples: the Examples of the Prompt (as_dict())
+        response: the raw API response
+
+    Attributes:
+        path (str): path of the archive file
+        compressor (zstandard.ZstdCompressor): compressor used for every record
+    """
+    def __init__(self, path, level=10):
+        self.path = path
+        self.compressor = zstandard.ZstdCompressor(level=level)
+
+    def write(self, prompt, prompt_text, response, cell, backend):
+        """
+        Compresses and appends one record to the archive
+
+        Args:
+            prompt (Prompt): the Prompt that was sent to the API
+            prompt_text (str): the formatted prompt text that was sent to the API
+            response (openai.openai_object.OpenAIObject or RequestResult): the raw output of the API
+            cell (dict): the settings of the current run (see class docstring)
+            backend (str): 'openai' or 'crfm'
+        Returns:
+            key (str): the hash of the prompt text
+        """
+        key = hashlib.sha256(prompt_text.encode('utf-8')).hexdigest()
+        record = {
+            'key': key,
+            'cell': cell,
+            'backend': backend,
+            'instruction': prompt.get_instruction(),
+            'examples': [e.as_dict() for e in prompt.get_examples()],
+            'response': dataclasses.asdict(response) if dataclasses.is_dataclass(response) else response,
+        }
+        frame = self.compressor.compress(json.dumps(record).encode('utf-8'))
+
+        # a single unbuffered append, so that records from concurrent writers do not interleave
+        with open(self.path, 'ab', buffering=0) as f:
+            f.write(RECORD_HEADER.pack(len(frame)) + frame)
+
+        return key
+
+    def iter_frames(self):
+        """
+        Yields the compressed frames of the archive one at a time without decompressing them
+        """
+        with open(self.path, 'rb') as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                (length,) = RECORD_HEADER.unpack(header)
+                frame = f.read(length)
+                if len(frame) < length:
+                    raise Exception(f"truncated record at the end of {self.path}")
+                yield frame
+
+    def __iter__(self):
+        decompressor = zstandard.ZstdDecompressor()
+        for frame in self.iter_frames():
+            yield json.loads(decompressor.decompress(frame))
+
+def score_record(record):
+    """
+    Re-runs parsing and scoring of one archived response exactly as QueryPipeline.run_pipeline does
+
+    Args:
+        record (dict): a decompressed archive record
+    Returns:
+        complete_df (pd.DataFrame): the result rows for the archived Prompt, tagged with its model and prompt hash
+    """
+    # imported here so that replaying OpenAI-only archives does not require the CRFM client
+    if record['backend'] == 'crfm':
+        from crfm_access import CRFMAccess as access_class
+        response = to_crfm_result(record['response'])
+    else:
+        from api_access import APIAccess as access_class
+        response = record['response']
+
+    cell = record['cell']
+    examples = [Example(**e) for e in record['examples']]
+    # records archived before examples were keyed are numbered in order
+    if examples[0].example_number is None:
+        number_examples(examples, 0)
+    prompt_id = examples[0].prompt_id
+    api_access = access_class(ArchivedPrompt(examples, record['instruction']))
+    api_access.format_constructions(cell['format_type'])
+    wrangler = MetricWrangler()
+
+    if cell['query_only']:
+        labeled_df = wrangler.label_query_probs(api_access.to_query_dataframe(response), prompt_id)
+        examples = examples[-1:]
+    else:
+        probs_df = api_access.isolate_probs(api_access.to_numpy_dataframe(response))
+        labeled_df = wrangler.label_probs(probs_df, cell['needs_instruction'], prompt_id)
+
+    complete_df = wrangler.construct_test_example_df(test_examples=examples, test_examples_output_df=labeled_df)
+    complete_df['model'] = cell['model']
+    complete_df['prompt_hash'] = record['key']
+    if 'pair_id' in cell:
+        complete_df['format_type'] = cell['format_type']
+        complete_df['pair_id'] = cell['pair_id']
+    if 'replicate' in cell:
+        complete_df['replicate'] = cell['replicate']
+    return complete_df
+
+def to_crfm_result(response):
+    """
+    Rebuilds the attribute access used by CRFMAccess (output.completions[0].tokens[0].top_logprobs) from an archived RequestResult dict
+    """
+    completions = [SimpleNamespace(tokens=[SimpleNamespace(**token) for token in c['tokens']]) for c in response['completions']]
+    return SimpleNamespace(completions=completions)
+
+def score_frames(frames):
+    decompressor = zstandard.ZstdDecompressor()
+    scored = [score_record(json.loads(decompressor.decompress(frame))) for frame in frames]
+    return pd.concat(scored, ignore_index=True) if scored else pd.DataFrame()
+
+def replay_archive(path, workers=None, batch_size=64):
+    """
+    Re-parses and re-scores every response in an archive across the worker pool (see worker_pool.py), without querying any API
+
+    Args:
+        path (str): path of the archive file
+        workers (int): number of worker processes, if the worker pool is not started yet (defaults to the number of CPUs)
+        batch_size (int): number of records handed to a worker at a time
+    Returns:
+        all_tests (pd.DataFrame): the result rows for every archived Prompt, in archive order
+    """
+    archive = ResponseArchive(path)
+    batches = []
+    batch = []
+    for frame in archive.iter_frames():
+        batch.append(frame)
+        if len(batch) == batch_size:
+            batches.append(batch)
+            batch = []
+    if batch:
+        batches.append(batch)
+
+    scored = get_worker_pool(workers).map_frames(score_frames, batches)
+
+    return pd.concat(scored, ignore_index=True) if scored else pd.DataFrame()
@@ -0,0 +1,142 @@
+import os
+import uuid
+from urllib.parse import quote
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# directory levels of the store, as <column>=<value> (hive partitioning)
+PARTITION_COLUMNS = ['model', 'salient_task', 'format_type']
+PARTITION_SCHEMA = pa.schema([(column, pa.string()) for column in PARTITION_COLUMNS])
+# directory name pyarrow reads back as a missing value (e.g. the salient_task of tests without one)
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+ROW_GROUP_SIZE = 65536
+
+class ResultStore:
+    """
+    Stores result frames as Parquet files partitioned by model, salient_task and format_type, and reads back only the requested
+    columns of the requested partitions
+
+    Filters on the partition columns select directories without opening the files of any other partition; the shots filter is
+    checked against the statistics of each row group (rows are sorted by shots and example_number when written), and only the
+    requested columns are decoded. Reading a slice of the results therefore reads about as many bytes as the slice holds.
+
+    A ResultStore is immutable: filter() returns a new ResultStore over the same files with more filters, so a filtered store can be
+    handed to the Visualizer in place of a DataFrame, e.g. Visualizer.visualize_probs_across_shots(store.filter(model='davinci'))
+
+    Layout of the store directory:
+        model=<model>/salient_task=<salient task>/format_type=<format>/part-<id>.parquet (values are percent-encoded)
+
+    Attributes:
+        path (str): directory of the store
+        filters (dict): the value (or list of values) selected for each filtered partition column, and the inclusive (low, high)
+            range of 'shots'
+    """
+    def __init__(self, path, filters=None):
+        self.path = path
+        self.filters = filters or {}
+
+    def write(self, df, shots=None):
+        """
+        Appends a result frame to the store, as one file per partition
+
+        Args:
+            df (pd.DataFrame): result rows (see Tester.run_test()) with a 'model' column
+            shots (int): the shots of every row, if df has no 'shots' column
+        Returns:
+            paths (list(str)): the files written
+        """
+        if df.empty:
+            return []
+        df = df.copy()
+        if 'shots' not in df.columns:
+            if shots is None:
+                raise Exception("result rows without a 'shots' column need the shots of the test")
+            df['shots'] = shots
+        for column in PARTITION_COLUMNS:
+            if column not in df.columns:
+                df[column] = None
+
+        paths = []
+        for values, partition_df in df.groupby(PARTITION_COLUMNS, dropna=False, sort=False):
+            directory = os.path.join(self.path, *(f"{column}={partition_value(value)}" for column, value in zip(PARTITION_COLUMNS, values)))
+            os.makedirs(directory, exist_ok=True)
+            partition_df = partition_df.drop(columns=PARTITION_COLUMNS).sort_values(['shots', 'example_number'], kind='stable')
+            path = os.path.join(directory, f"part-{uuid.uuid4().hex}.parquet")
+            temporary_path = path + '.tmp'
+            pq.write_table(pa.Table.from_pandas(partition_df, preserve_index=False), temporary_path, row_group_size=ROW_GROUP_SIZE)
+            # readers never see a partly written file
+            os.replace(temporary_path, path)
+            paths.append(path)
+        return paths
+
+    def filter(self, model=None, salient_task=None, format_type=None, shots=None):
+        """
+        Returns the store restricted to the given partitions and shots
+
+        Args:
+            model, salient_task, format_type (str or list(str)): the value(s) to keep (None to keep all)
+            shots (int or tuple(int, int)): the shots, or inclusive range of shots, to keep (None to keep all)
+        Returns:
+            (ResultStore): the filtered store
+        """
+        filters = dict(self.filters)
+        for column, value in [('model', model), ('salient_task', salient_task), ('format_type', format_type)]:
+            if value is not None:
+                filters[column] = [value] if isinstance(value, str) else list(value)
+        if shots is not None:
+            filters['shots'] = (shots, shots) if isinstance(shots, int) else tuple(shots)
+        return ResultStore(self.path, filters)
+
+    def expression(self):
+        expression = None
+        for column in PARTITION_COLUMNS:
+            if column in self.filters:
+                condition = ds.field(column).isin(self.filters[column])
+                expression = condition if expression is None else expression & condition
+        if 'shots' in self.filters:
+            low, high = self.filters['shots']
+            condition = (ds.field('shots') >= low) & (ds.field('shots') <= high)
+            expression = condition if expression is None else expression & condition
+        return expression
+
+    def dataset(self):
+        """
+        Opens the files of the selected partitions, with the union of their columns (files written by different runs may have different
+        columns, e.g. 'pair_id' or 'replicate'); only the footers of the selected files are read
+        """
+        partitioning = ds.partitioning(PARTITION_SCHEMA, flavor='hive')
+        dataset = ds.dataset(self.path, format='parquet', partitioning=partitioning, exclude_invalid_files=True)
+        fragments = list(dataset.get_fragments(filter=self.expression()))
+        schema = pa.unify_schemas([fragment.physical_schema for fragment in fragments] + [PARTITION_SCHEMA], promote_options='permissive')
+        return ds.FileSystemDataset([fragment for fragment in fragments], schema, ds.ParquetFileFormat(), dataset.filesystem)
+
+    @property
+    def columns(self):
+        return self.dataset().schema.names
+
+    def scanner(self, columns=None, batch_size=ROW_GROUP_SIZE):
+        return self.dataset().scanner(columns=columns, filter=self.expression(), batch_size=batch_size)
+
+    def read(self, columns=None):
+        """
+        Reads the selected rows
+
+        Args:
+            columns (list(str)): the columns to read (None for all)
+        Returns:
+            df (pd.DataFrame): the selected rows and columns
+        """
+        return self.scanner(columns).to_table().to_pandas()
+
+    def iter_batches(self, columns=None, batch_size=ROW_GROUP_SIZE):
+        """
+        Yields the selected rows as DataFrames of at most batch_size rows, reading one batch at a time
+        """
+        for batch in self.scanner(columns, batch_size).to_batches():
+            if batch.num_rows:
+                yield batch.to_pandas()
+
+def partition_value(value):
+    return NULL_PARTITION if pd.isna(value) else quote(str(value), safe='')
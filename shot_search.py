@@ -0,0 +1,199 @@
+import numpy as np
+import pandas as pd
+from query_pipeline import parse_model_specs
+from feature_schema import CONSTRUCTION_TYPES_MAP
+
+SALIENT_TASKS = ['subject', 'location', 'religious', 'pronoun', 'propn', 'negation']
+
+
+def isotonic_fit(successes, trials):
+    """
+    Fits a nondecreasing accuracy curve to per-shot success counts with the pool adjacent violators algorithm
+
+    Args:
+        successes (np.ndarray): number of accurate queries at each shot count, in increasing order of shots
+        trials (np.ndarray): number of queries at each shot count (shot counts without queries are interpolated from their neighbours)
+    Returns:
+        fitted (np.ndarray): the fitted accuracy at each shot count
+    """
+    sampled = trials > 0
+    values = []
+    weights = []
+    sizes = []
+    for rate, weight in zip(successes[sampled] / trials[sampled], trials[sampled]):
+        values.append(rate)
+        weights.append(weight)
+        sizes.append(1)
+        # merges the last two blocks while they violate monotonicity
+        while len(values) > 1 and values[-2] > values[-1]:
+            weight = weights[-2] + weights[-1]
+            values[-2:] = [(values[-2] * weights[-2] + values[-1] * weights[-1]) / weight]
+            weights[-2:] = [weight]
+            sizes[-2:] = [sizes[-2] + sizes[-1]]
+
+    fitted = np.full(len(trials), np.nan)
+    fitted[sampled] = np.repeat(values, sizes)
+    positions = np.arange(len(trials))
+    return np.interp(positions, positions[sampled], fitted[sampled])
+
+def threshold_index(fitted, target):
+    """
+    Returns the index of the first shot count whose fitted accuracy reaches target, or len(fitted) if none does
+    """
+    reached = np.flatnonzero(fitted >= target)
+    return reached[0] if len(reached) else len(fitted)
+
+class ShotSearch:
+    """
+    Estimates how many shots a model needs before it locks onto the salient task: the smallest shot count at which the
+    (nondecreasing) accuracy of the query reaches target, with a bootstrap confidence interval (see confidence_interval())
+
+    Instead of querying every shot count equally, queries are allocated in rounds: after a coarse first round, each round fits
+    an isotonic accuracy curve and sends its batch to the shot counts where it is least certain whether accuracy has reached
+    target (under a Beta posterior of the fitted accuracy), which concentrates queries around the transition. The search
+    stops once the confidence interval is narrow enough, the query budget is spent or a round returns no outcomes.
+
+    Attributes:
+        evaluate (function): (shots, queries) -> np.ndarray of 0/1 query accuracies (see tester_evaluator())
+        shots (np.ndarray): the shot counts searched, in increasing order
+        target (float): accuracy at which the model counts as locked onto the salient task
+        batch_size (int): number of queries per round
+        initial_queries (int): number of queries at each shot count of the coarse first round
+        max_queries (int): total query budget
+        ci_width (int): the search stops when the confidence interval spans at most this many shots
+        confidence (float): level of the confidence interval
+        bootstrap_samples (int): number of bootstrap resamples for the confidence interval
+        rng (np.random.Generator): source of randomness for the bootstrap
+    """
+    def __init__(self, evaluate, min_shots=3, max_shots=19, target=0.8, batch_size=10, initial_queries=4, max_queries=200, ci_width=2, confidence=0.95, bootstrap_samples=1000, seed=None):
+        self.evaluate = evaluate
+        self.shots = np.arange(min_shots, max_shots + 1)
+        self.target = target
+        self.batch_size = batch_size
+        self.initial_queries = initial_queries
+        self.max_queries = max_queries
+        self.ci_width = ci_width
+        self.confidence = confidence
+        self.bootstrap_samples = bootstrap_samples
+        self.rng = np.random.default_rng(seed)
+        self.successes = np.zeros(len(self.shots))
+        self.trials = np.zeros(len(self.shots))
+
+    def query(self, index, queries):
+        outcomes = np.asarray(self.evaluate(int(self.shots[index]), queries))
+        self.successes[index] += outcomes.sum()
+        self.trials[index] += len(outcomes)
+
+    def run(self):
+        """
+        Runs the search
+
+        Returns:
+            result (dict): 'threshold' (shots, NaN if target is never reached), 'ci_low' and 'ci_high' (NaN bounds mean the interval
+            extends past the searched shot counts), 'queries' spent and 'curve', a DataFrame of the queries, successes, raw and fitted
+            accuracy at each shot count
+        """
+        # coarse first round: both ends and evenly spaced shot counts in between
+        for index in np.unique(np.linspace(0, len(self.shots) - 1, 5).round().astype(int)):
+            self.query(index, self.initial_queries)
+        if not self.trials.sum():
+            raise Exception("the first round of the search returned no outcomes (e.g. every Prompt was dropped as malformed)")
+
+        while True:
+            low, high = self.confidence_interval()
+            if high - low <= self.ci_width or self.trials.sum() >= self.max_queries:
+                break
+
+            queried = self.trials.sum()
+            allocation = self.allocate(min(self.batch_size, int(self.max_queries - self.trials.sum())))
+            for index in np.flatnonzero(allocation):
+                self.query(index, int(allocation[index]))
+            # a round which returned no outcomes would be repeated forever
+            if self.trials.sum() == queried:
+                break
+
+        fitted = isotonic_fit(self.successes, self.trials)
+        low, high = self.confidence_interval()
+        curve = pd.DataFrame({'shots': self.shots, 'queries': self.trials.astype(int), 'successes': self.successes.astype(int),
+                              'accuracy': np.divide(self.successes, self.trials, out=np.full(len(self.shots), np.nan), where=self.trials > 0), 'fitted': fitted})
+        return {'threshold': self.to_shots(threshold_index(fitted, self.target)), 'ci_low': self.to_shots(low), 'ci_high': self.to_shots(high),
+                'queries': int(self.trials.sum()), 'curve': curve}
+
+    def allocate(self, queries):
+        """
+        Splits a batch of queries across shot counts in proportion to the uncertainty of whether accuracy has reached target there,
+        i.e. min(P, 1 - P) with P = P(accuracy >= target) under a Beta posterior centred on the fitted curve
+        """
+        fitted = isotonic_fit(self.successes, self.trials)
+        alpha = fitted * self.trials + 1
+        beta = (1 - fitted) * self.trials + 1
+        draws = self.rng.beta(alpha[:, None], beta[:, None], size=(len(self.shots), 256))
+        above = (draws >= self.target).mean(axis=1)
+        uncertainty = np.minimum(above, 1 - above) + 1e-3
+
+        return self.rng.multinomial(queries, uncertainty / uncertainty.sum())
+
+    def confidence_interval(self):
+        """
+        Returns the (low, high) indices of the threshold's bootstrap interval: the accuracy at every sampled shot count is redrawn from
+        its Beta(successes + 1, failures + 1) posterior (which, unlike resampling the observed rate, stays uncertain after a few queries
+        which all succeeded or all failed), and the isotonic fit and threshold are recomputed for each draw
+        """
+        draws = self.rng.beta(self.successes + 1, self.trials - self.successes + 1, size=(self.bootstrap_samples, len(self.shots)))
+
+        thresholds = np.array([threshold_index(isotonic_fit(accuracies * self.trials, self.trials), self.target) for accuracies in draws])
+        tail = (1 - self.confidence) / 2
+        return np.quantile(thresholds, tail, method='lower'), np.quantile(thresholds, 1 - tail, method='higher')
+
+    def to_shots(self, index):
+        return float(self.shots[index]) if index < len(self.shots) else np.nan
+
+def tester_evaluator(tester, cell):
+    """
+    Returns an evaluate function for ShotSearch which runs query-only tests of a cell at the requested shot count
+
+    Args:
+        tester (Tester): the Tester used to run the tests
+        cell (dict): the keyword arguments of Tester.run_test(), except shots and queries
+    Returns:
+        evaluate (function): (shots, queries) -> np.ndarray of 0/1 query accuracies
+    """
+    def evaluate(shots, queries):
+        test_df = tester.run_test(**dict(cell, shots=shots, queries=queries, query_only=True))
+        return test_df['accurate'].to_numpy() if not test_df.empty else np.zeros(0)
+    return evaluate
+
+def search_thresholds(tester, args, min_shots=3, max_shots=19, target=0.8, max_queries=200):
+    """
+    Runs a ShotSearch for every salient task, format and model given in args
+
+    Args:
+        tester (Tester): the Tester used to run the tests
+        args (ArgumentParser.args): command line arguments from main
+        min_shots (int): smallest shot count searched
+        max_shots (int): largest shot count searched
+        target (float): accuracy at which the model counts as locked onto the salient task
+        max_queries (int): query budget of each search
+    Returns:
+        (tuple(pd.DataFrame, pd.DataFrame)):
+        thresholds_df (pd.DataFrame): one row per salient task, format and model with the threshold, its confidence interval and the queries spent
+        curves_df (pd.DataFrame): the curve of every search
+    """
+    model_specs = [model.strip() for model in args.models.split(',')] if args.models else [None]
+    rows = []
+    curves = []
+    for model_spec in model_specs:
+        model = parse_model_specs(model_spec, args.crfm)[0][1] if model_spec else args.model
+        for construction_format in [args.format_2, args.format_1]:
+            for salient_task in SALIENT_TASKS:
+                cell = dict(construction_type=CONSTRUCTION_TYPES_MAP[salient_task], model=model, construction_format=construction_format, crfm=args.crfm,
+                            needs_instruction=args.needs_instruction, verbose=False, needs_informative=args.needs_informative, include_ambiguous_examples=True,
+                            salient_task=salient_task, prob_of_ambiguous=args.prob_of_ambiguous, togethercomputer=False, for_finetuning=False,
+                            finetuning_control=False, stratified=True, archive=args.archive, models=model_spec)
+                result = ShotSearch(tester_evaluator(tester, cell), min_shots=min_shots, max_shots=max_shots, target=target, max_queries=max_queries).run()
+
+                key = {'model': model, 'format_type': construction_format, 'salient_task': salient_task}
+                rows.append(dict(key, threshold=result['threshold'], ci_low=result['ci_low'], ci_high=result['ci_high'], queries=result['queries']))
+                curves.append(result['curve'].assign(**key))
+
+    return pd.DataFrame(rows), pd.concat(curves, ignore_index=True)
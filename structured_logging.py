@@ -0,0 +1,99 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+LOGGER_NAME = 'ambibench'
+LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+
+logger = logging.getLogger(LOGGER_NAME)
+
+# every sample_every-th Prompt is logged in full (see sampled())
+sample_every = 1
+listener = None
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Formats every record as one JSON object: time, level, event (the message) and the fields passed as extra={'fields': {...}}
+    """
+    def format(self, record):
+        entry = {'time': round(record.created, 3), 'level': record.levelname, 'event': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, default=str)
+
+def configure_logging(path=None, level='INFO', sample=1):
+    """
+    Sends the records of the 'ambibench' logger through a queue to a background thread which formats them as JSON lines,
+    so that logging from the query loop only costs putting a record on the queue
+
+    Args:
+        path (str): file to which the JSON lines are appended (None for stderr)
+        level (str): one of LEVELS; full Prompts and per-Prompt results are logged at DEBUG, per-cell summaries at INFO
+        sample (int): log every sample-th Prompt in full (0 to log none)
+    Returns:
+        None; the listener runs until stop_logging() is called (at the latest at exit)
+    """
+    global sample_every, listener
+    stop_logging()
+    sample_every = sample
+
+    handler = logging.FileHandler(path) if path else logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonLinesFormatter())
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+
+    logger.handlers = [logging.handlers.QueueHandler(records)]
+    logger.setLevel(level)
+    logger.propagate = False
+
+@atexit.register
+def stop_logging():
+    """
+    Stops the listener (if any) once it has written every queued record
+    """
+    global listener
+    if listener:
+        listener.stop()
+        listener = None
+
+def sampled(prompt_id):
+    """
+    Returns True if the Prompt with this id is logged in full, i.e. if DEBUG records are enabled and it is an every sample_every-th Prompt
+    """
+    return sample_every > 0 and prompt_id % sample_every == 0 and logger.isEnabledFor(logging.DEBUG)
+
+def log(level, event, **fields):
+    logger.log(level, event, extra={'fields': fields})
+
+class CellSummary:
+    """
+    Accumulates the result rows of a cell as they are yielded, and logs one compact record for the whole cell
+
+    Attributes:
+        cell (dict): the settings identifying the cell (construction_type, format_type, shots, ...)
+        start (float): time at which the cell started
+        prompts (int): number of Prompts seen
+        rows (dict): number of result rows per model
+        accurate (dict): number of accurate rows per model
+        malformed (int): number of outputs dropped because their label rows did not line up with the examples of their Prompt
+    """
+    def __init__(self, **cell):
+        self.cell = cell
+        self.start = time.perf_counter()
+        self.prompts = 0
+        self.malformed = 0
+        self.rows = {}
+        self.accurate = {}
+
+    def add(self, prompt_df):
+        model = prompt_df['model'].iloc[0]
+        self.rows[model] = self.rows.get(model, 0) + len(prompt_df)
+        self.accurate[model] = self.accurate.get(model, 0) + int(prompt_df['accurate'].sum())
+
+    def emit(self):
+        accuracy = {model: round(self.accurate[model] / self.rows[model], 4) for model in self.rows}
+        log(logging.INFO, 'cell', prompts=self.prompts, malformed=self.malformed, rows=self.rows, accuracy=accuracy, seconds=round(time.perf_counter() - self.start, 3), **self.cell)
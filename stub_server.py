@@ -0,0 +1,284 @@
+import collections
+import gzip
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote_plus
+import numpy as np
+# prompts are tokenized as GPT-2 pre-tokenizes them, so that labels are tokens of their own (' X')
+from cost_planner import GPT_PRETOKENIZER as TOKENIZER
+
+# tokens offered in every top_logprobs entry besides the token itself, most likely first
+ALTERNATIVES = [' X', ' Y', 'X', 'Y', ' the', '\n', ' A']
+# a clarifying question, streamed by models asked to complete a clarifying prompt (see clarification.py)
+QUESTION = " Do you mean the subject or the location?"
+
+def parse_latency(spec):
+    """
+    Parses a latency distribution, in seconds
+
+    Args:
+        spec (str): 'fixed:<s>', 'uniform:<low>,<high>', 'exponential:<mean>' or 'lognormal:<median>,<sigma>' (heavy-tailed, as
+            the latencies of a loaded API)
+    Returns:
+        (function): random.Random -> seconds
+    """
+    kind, _, parameters = spec.partition(':')
+    values = [float(value) for value in parameters.split(',')] if parameters else []
+    if kind == 'fixed':
+        return lambda rng: values[0]
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == 'exponential':
+        return lambda rng: rng.expovariate(1 / values[0])
+    if kind == 'lognormal':
+        return lambda rng: rng.lognormvariate(np.log(values[0]), values[1])
+    raise Exception("invalid latency distribution")
+
+class RateWindow:
+    """
+    The requests and tokens of one API key over the last window_seconds, as the API counts them for its rate limits
+    """
+    def __init__(self):
+        self.events = collections.deque()
+        self.tokens = 0
+
+    def admit(self, now, tokens, rpm, tpm, window_seconds):
+        """
+        Records a request of tokens tokens if it fits in the limits of the window, and returns whether it does
+        """
+        while self.events and self.events[0][0] <= now - window_seconds:
+            self.tokens -= self.events.popleft()[1]
+        if (rpm and len(self.events) + 1 > rpm) or (tpm and self.tokens + tokens > tpm):
+            return False
+        self.events.append((now, tokens))
+        self.tokens += tokens
+        return True
+
+class StubServer:
+    """
+    A local HTTP server answering OpenAI completion requests (POST /v1/engines/<model>/completions, or /v1/completions with a
+    'model'), to load-test the request path without querying the API
+
+    Every prompt of a request (a string or a list of prompts) gets a choice: echo requests are scored token by token (tokens,
+    token_logprobs, top_logprobs with `logprobs` entries and text_offset, with None for the first token), completions generate
+    ' X' or ' Y' (or a clarifying question when streamed). Logprobs are drawn from the prompt, so that sending a request twice
+    gets the same answer.
+
+    Each request waits for a latency drawn from the latency distribution plus token_latency seconds per prompt token. Requests
+    over the rpm or tpm limit of their API key (over a window of window_seconds) get a 429 rate limit error, and a fraction
+    error_rate of the others a 429 and server_error_rate a 500; prompts longer than context_window tokens get a 400.
+    GET /stats returns the counts of the server (see stats()).
+
+    Attributes:
+        latency (function): random.Random -> seconds (see parse_latency())
+        token_latency (float): extra seconds per prompt token
+        rpm (int): requests per window allowed for each API key (0 for no limit)
+        tpm (int): tokens per window allowed for each API key (0 for no limit)
+        window_seconds (float): length of the rate limit window
+        error_rate (float): probability of a spurious 429 error
+        server_error_rate (float): probability of a 500 error
+        context_window (int): maximum prompt tokens of a request (0 for no limit)
+        host (str), port (int): the address of the server (port 0 picks a free port)
+    """
+    def __init__(self, latency='fixed:0', token_latency=0.0, rpm=0, tpm=0, window_seconds=60, error_rate=0.0, server_error_rate=0.0,
+                 context_window=0, host='127.0.0.1', port=0, seed=None):
+        self.latency = parse_latency(latency)
+        self.token_latency = token_latency
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window_seconds = window_seconds
+        self.error_rate = error_rate
+        self.server_error_rate = server_error_rate
+        self.context_window = context_window
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.windows = collections.defaultdict(RateWindow)
+        self.counts = collections.Counter()
+        self.server = ThreadingHTTPServer((host, port), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stats(self):
+        """
+        Returns the counts of requests received, answered ('ok'), rate limited ('rate_limited': over the limits, 'injected_429':
+        spurious), failed ('server_errors', 'context_errors'), and the prompts, prompt tokens and response bytes answered
+        """
+        with self.lock:
+            return dict(self.counts)
+
+    def count(self, **counts):
+        with self.lock:
+            self.counts.update(counts)
+
+    def handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately: without this, kept-alive connections stall on delayed ACKs
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.rstrip('/').endswith('/stats'):
+                    self.send_json(200, stub.stats())
+                else:
+                    self.send_json(404, error_body("not found", 'invalid_request_error'))
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                match = re.search(r"/engines/([^/]+)/completions$", self.path)
+                if not match and not self.path.endswith('/completions'):
+                    self.send_json(404, error_body("not found", 'invalid_request_error'))
+                    return
+                model = unquote_plus(match.group(1)) if match else body.get('model')
+                api_key = self.headers.get('Authorization', '').replace('Bearer ', '')
+                status, response = stub.complete(model, body, api_key)
+                if status == 200 and body.get('stream'):
+                    self.send_stream(response)
+                else:
+                    self.send_json(status, response)
+
+            def send_json(self, status, response):
+                data = json.dumps(response).encode('utf-8')
+                # as the API, compresses responses for clients which accept it (both the SDK and LeanClient do)
+                compressed = 'gzip' in self.headers.get('Accept-Encoding', '')
+                if compressed:
+                    data = gzip.compress(data, compresslevel=1)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                if compressed:
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                stub.count(response_bytes=len(data))
+
+            def send_stream(self, chunks):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.close_connection = True
+                for chunk in chunks + ['[DONE]']:
+                    data = f"data: {chunk if isinstance(chunk, str) else json.dumps(chunk)}\n\n".encode('utf-8')
+                    self.wfile.write(data)
+                    self.wfile.flush()
+                    stub.count(response_bytes=len(data))
+
+        return Handler
+
+    def complete(self, model, body, api_key):
+        """
+        Answers one completion request
+
+        Returns:
+            (tuple(int, dict or list)): the HTTP status and the response (the list of chunks of a streamed response)
+        """
+        prompts = body.get('prompt', '')
+        prompts = prompts if isinstance(prompts, list) else [prompts]
+        max_tokens = body.get('max_tokens', 16)
+        tokenized = [TOKENIZER.findall(prompt) for prompt in prompts]
+        prompt_tokens = sum(len(tokens) for tokens in tokenized)
+        self.count(requests=1)
+
+        now = time.time()
+        with self.lock:
+            admitted = self.windows[api_key].admit(now, prompt_tokens + max_tokens * len(prompts), self.rpm, self.tpm, self.window_seconds)
+            draw = self.rng.random()
+            latency = self.latency(self.rng) + self.token_latency * prompt_tokens
+        if not admitted:
+            self.count(rate_limited=1)
+            return 429, error_body(f"Rate limit reached for {model} on requests per min or tokens per min. Limit: {self.rpm} / min.", 'requests')
+        if draw < self.error_rate:
+            self.count(injected_429=1)
+            return 429, error_body("The server is currently overloaded with other requests (429).", 'server_error')
+        if self.context_window and max(len(tokens) for tokens in tokenized) + max_tokens > self.context_window:
+            self.count(context_errors=1)
+            return 400, error_body(f"This model's maximum context length is {self.context_window} tokens.", 'invalid_request_error')
+
+        time.sleep(latency)
+        if draw > 1 - self.server_error_rate:
+            self.count(server_errors=1)
+            return 500, error_body("The server had an error while processing your request.", 'server_error')
+
+        self.count(ok=1, prompts=len(prompts), prompt_tokens=prompt_tokens)
+        logprobs = min(body.get('logprobs') or 0, 5)
+        if body.get('stream'):
+            return 200, [completion_body(model, [choice]) for choice in stream_choices(prompts[0], max_tokens)]
+        choices = [score_choice(i, model, prompt, tokens, body.get('echo', False), max_tokens, logprobs) for i, (prompt, tokens) in enumerate(zip(prompts, tokenized))]
+        return 200, completion_body(model, choices, prompt_tokens, max_tokens * len(prompts))
+
+def error_body(message, error_type):
+    return {'error': {'message': message, 'type': error_type, 'param': None, 'code': None}}
+
+def completion_body(model, choices, prompt_tokens=0, completion_tokens=0):
+    return {'id': 'cmpl-stub', 'object': 'text_completion', 'created': int(time.time()), 'model': model, 'choices': choices,
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}}
+
+def top_entry(token, logprob, logprobs, rng):
+    """
+    Returns the top_logprobs entry of a token: the token and the most likely alternatives, which share (part of) the probability
+    mass the token leaves, so that the entry is a valid distribution
+    """
+    entry = {token: logprob}
+    alternatives = [alternative for alternative in ALTERNATIVES if alternative != token][:max(logprobs - 1, 0)]
+    remaining = 1 - np.exp(logprob)
+    for alternative in alternatives:
+        share = remaining * rng.uniform(0.2, 0.6)
+        remaining -= share
+        entry[alternative] = round(float(np.log(max(share, 1e-12))), 4)
+    return entry
+
+def score_choice(index, model, prompt, tokens, echo, max_tokens, logprobs):
+    """
+    Returns the choice of one prompt: the logprobs of the prompt tokens if echo, followed by those of max_tokens generated labels
+    """
+    rng = random.Random(hashlib.sha1(f"{model}\0{prompt}".encode('utf-8')).digest())
+    generated = [rng.choice([' X', ' Y']) for _ in range(max_tokens)]
+    scored = (tokens if echo else []) + generated
+    token_logprobs = [round(-rng.expovariate(1.5), 4) for _ in scored]
+    offsets = np.cumsum([0] + [len(token) for token in scored[:-1]]).tolist() if scored else []
+    top_logprobs = [top_entry(token, logprob, logprobs, rng) for token, logprob in zip(scored, token_logprobs)]
+    if echo and tokens:
+        # the first token of a prompt has no logprob
+        token_logprobs[0] = None
+        top_logprobs[0] = None
+    return {'text': (prompt if echo else '') + ''.join(generated), 'index': index, 'finish_reason': 'length',
+            'logprobs': {'tokens': scored, 'token_logprobs': token_logprobs, 'top_logprobs': top_logprobs if logprobs else None, 'text_offset': offsets} if logprobs else None}
+
+def stream_choices(prompt, max_tokens):
+    """
+    Returns the chunks of a streamed completion: a direct label for most prompts, a clarifying question for the others
+    """
+    rng = random.Random(hashlib.sha1(prompt.encode('utf-8')).digest())
+    text = QUESTION if rng.random() < 0.3 else rng.choice([' X', ' Y'])
+    pieces = TOKENIZER.findall(text)[:max_tokens]
+    return [{'text': piece, 'index': 0, 'logprobs': None, 'finish_reason': 'length' if i == len(pieces) - 1 else None} for i, piece in enumerate(pieces)]
@@ -1,9 +1,27 @@
+import logging
+import random
 import time
 import pandas as pd
-from query_pipeline import QueryPipeline
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from query_pipeline import QueryPipeline, parse_model_specs, PAIRED_FORMATS
+from frozen_corpus import assign_prompt_ids, corpus_key
+from feature_schema import SCHEMAS, K_FEATURE_CONSTRUCTION_TYPES, CONSTRUCTION_TYPES_MAP
+from structured_logging import log
+
+SWEEPS = ['two_feature', 'two_feature_with_two_set', 'baseline_for_finetuning', 'finetuned_set', 'k_feature']
+
+def replicate_rng(cell, replicate, seed=None):
+    """
+    Returns the random stream of one replicate of a cell: derived from seed, the corpus key of the cell and the replicate if seed is
+    given (so a retried replicate regenerates the same Prompts), and freshly seeded otherwise
+    """
+    if seed is None:
+        return random.Random()
+    construction_type, salient_task, construction_format, shots = corpus_key(cell)
+    return random.Random(f"{seed}:{construction_type}:{salient_task}:{construction_format}:{shots}:{replicate}")
 
 class Tester():
-    def run_test(self, construction_type, shots, model, construction_format, crfm, queries, needs_instruction, verbose, needs_informative, include_ambiguous_examples, prob_of_ambiguous, togethercomputer, for_finetuning, finetuning_control, salient_task=None):
+    def run_test(self, construction_type, shots, model, construction_format, crfm, queries, needs_instruction, verbose, needs_informative, include_ambiguous_examples, prob_of_ambiguous, togethercomputer, for_finetuning, finetuning_control, salient_task=None, stratified=False, query_only=False, archive=None, models=None, corpus=None, corpus_start=0, paired=False, clarifying=False, replicate=None, seed=None):
         """
         Runs a single test which consists of a single query to the API with one Prompt
         Args:
@@ -22,14 +40,101 @@ class Tester():
             for_finetuning (bool): if True runs the test for finetuning, False otherwise
             finetuning_control (bool): True if running finetuning control tests
             salient_task (str): if not None, the salient task for the current test
+            stratified (bool): if True balances labels and the ambiguity rate exactly across the queries of the test
+            query_only (bool): if True only scores the query of each Prompt (from the next-token logprobs) instead of every example
+            archive (str): if not None, path of the archive to which every raw API response is appended
+            models (str): if not None, comma-separated list of models (optionally prefixed by 'openai:' or 'crfm:') to which every Prompt is sent concurrently instead of model
+            corpus (str): if not None, path of a frozen corpus from which the Prompts are read instead of generated
+            corpus_start (int): prompt id in the corpus of the first Prompt of the test (see frozen_corpus.assign_prompt_ids())
+            paired (bool): if True renders every Prompt in both formats (PAIRED_FORMATS) and tags the rows of each Prompt with a shared pair_id
+            clarifying (bool): if True classifies a streamed completion of the query (preceded by the clarifying assertion) as a direct answer or a clarifying question instead of scoring the Prompt
+            replicate (int): if not None, the replicate of the cell this test is: its Prompts are generated from their own random stream (see replicate_rng()) and its rows carry a 'replicate' column
+            seed (int): if not None, the seed from which the random stream of the replicate is derived
 
         Returns:
-            test_df (pd.DataFrame): DataFrame containing all relevant information obtained from running the test 
+            test_df (pd.DataFrame): DataFrame containing all relevant information obtained from running the test, with a 'shots' column
         """
-        test = QueryPipeline(construction_type, shots, model, construction_format, crfm)
-        test_df = test.run_pipeline(queries=queries, needs_instruction=needs_instruction, verbose=verbose, needs_informative=needs_informative, include_ambiguous_examples=include_ambiguous_examples, salient_task=salient_task, prob_of_ambiguous=prob_of_ambiguous, togethercomputer=togethercomputer, finetuning_control=finetuning_control, for_finetuning=for_finetuning)
+        model_specs = parse_model_specs(models, crfm) if models else None
+        test = QueryPipeline(construction_type, shots, model, construction_format, crfm, models=model_specs)
+        rng = replicate_rng(dict(construction_type=construction_type, salient_task=salient_task, construction_format=construction_format, shots=shots), replicate, seed) if replicate is not None else None
+        test_df = test.run_pipeline(queries=queries, needs_instruction=needs_instruction, verbose=verbose, needs_informative=needs_informative, include_ambiguous_examples=include_ambiguous_examples, salient_task=salient_task, prob_of_ambiguous=prob_of_ambiguous, togethercomputer=togethercomputer, finetuning_control=finetuning_control, for_finetuning=for_finetuning, stratified=stratified, query_only=query_only, archive=archive, corpus=corpus, corpus_start=corpus_start, paired=paired, clarifying=clarifying, rng=rng)
+        if not test_df.empty:
+            # the shots of every row, so that results of several tests can be filtered by shots (see result_store.py)
+            test_df['shots'] = shots
+            if replicate is not None:
+                test_df['replicate'] = replicate
         return test_df
+
+    def stream_test(self, construction_type, shots, model, construction_format, crfm, models=None, replicate=None, seed=None, **pipeline_args):
+        """
+        Runs a single test as run_test() does, but returns a generator of the result rows of every Prompt (see QueryPipeline.stream_pipeline())
+
+        Args:
+            the arguments of run_test()
+        Returns:
+            (generator(pd.DataFrame)): the result rows of each Prompt and model, in the order they are parsed
+        """
+        model_specs = parse_model_specs(models, crfm) if models else None
+        test = QueryPipeline(construction_type, shots, model, construction_format, crfm, models=model_specs)
+        if replicate is None:
+            return (prompt_df.assign(shots=shots) for prompt_df in test.stream_pipeline(**pipeline_args))
+
+        rng = replicate_rng(dict(pipeline_args, construction_type=construction_type, construction_format=construction_format, shots=shots), replicate, seed)
+        return (prompt_df.assign(shots=shots, replicate=replicate) for prompt_df in test.stream_pipeline(rng=rng, **pipeline_args))
     
+    def run_cells(self, cells, cooldown=0, workers=1, retries=0):
+        """
+        Runs the given tests, up to workers at a time
+
+        Every test (e.g. one replicate of a cell) is isolated: a test which fails is retried alone, up to retries times, and a test
+        which still fails is logged and left out of the results (its index is listed in all_tests.attrs['failed_cells']) instead of
+        stopping the other tests; all_tests.attrs['retries'] counts the retries of the tests which succeeded. The results are
+        concatenated in the order of cells whatever order the tests finish in.
+
+        Args:
+            cells (list(dict)): the keyword arguments of run_test() for every test
+            cooldown (int): seconds each worker waits after each test in order to not overload API and stay within OpenAI constraints
+            workers (int): number of tests run concurrently
+            retries (int): number of times a failed test is retried
+        Returns:
+            all_tests (pd.DataFrame): DataFrame containg the relevant information from all Prompts queried
+        """
+        results = [None] * len(cells)
+        failed_cells = []
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            futures = {executor.submit(self.run_cell, cell, cooldown, retries): i for i, cell in enumerate(cells)}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    failed_cells.append(i)
+                    log(logging.ERROR, 'cell failed', cell=i, replicate=cells[i].get('replicate'), error=repr(e))
+
+        test_dfs = [test_df for test_df in results if test_df is not None]
+        all_tests = pd.concat(test_dfs, ignore_index=True) if test_dfs else pd.DataFrame()
+        all_tests.attrs['failed_cells'] = sorted(failed_cells)
+        all_tests.attrs['retries'] = sum(test_df.attrs.get('retries', 0) for test_df in test_dfs)
+        return all_tests
+
+    def run_cell(self, cell, cooldown=0, retries=0):
+        """
+        Runs one test, retrying it alone if it fails (see run_cells())
+        """
+        for attempt in range(retries + 1):
+            try:
+                test_df = self.run_test(**cell)
+                break
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                log(logging.WARNING, 'retrying cell', replicate=cell.get('replicate'), attempt=attempt + 1, error=repr(e))
+                time.sleep(2 ** attempt)
+
+        test_df.attrs['retries'] = attempt
+        if cooldown: time.sleep(cooldown)
+        return test_df
+
     def run_two_feature_tests(self, args):
         """
         Runs all standard tests which are two-feature tests {'subject_location', 'religious_pronoun', 'propn_negation'}
@@ -39,26 +144,140 @@ class Tester():
         Returns:
             all_tests (pd.DataFrame): DataFrame containg the relevant information from all Prompts queried
         """
-        all_tests = pd.DataFrame()
-        
-        construction_formats_list = [args.format_2, args.format_1]
-        salient_tasks_list = ['subject', 'location', 'religious', 'negation', 'propn', 'pronoun']
+        return self.run_cells(self.sweep_cells('two_feature', args), self.sweep_cooldown('two_feature', args), args.replicate_workers, args.retries)
+    
+    def run_two_feature_tests_with_two_set(self, args):
+        """
+        Runs all standard tests which are two-feature tests {'subject_location', 'religious_pronoun', 'propn_negation'}
+
+        Args:
+            args (ArgumentParser.args): command line arguments from main
+        Returns:
+            all_tests (pd.DataFrame): DataFrame containg the relevant information from all Prompts queried
+        """
+        return self.run_cells(self.sweep_cells('two_feature_with_two_set', args), self.sweep_cooldown('two_feature_with_two_set', args), args.replicate_workers, args.retries)
+
+    def run_baseline_tests_for_finetuning(self, args):
+        """
+        Runs all standard tests which are two-feature tests {'subject_location', 'religious_pronoun', 'propn_negation'}
+
+        Args    :
+            args (ArgumentParser.args): command line arguments from main
+        Returns:
+            all_tests (pd.DataFrame): DataFrame containg the relevant information from all Prompts queried
+        """
+        return self.run_cells(self.sweep_cells('baseline_for_finetuning', args), self.sweep_cooldown('baseline_for_finetuning', args), args.replicate_workers, args.retries)
+
+    def run_finetuned_set(self, args):
+        """
+        Generates finetuning set with two of the six features
+
+        Args:
+            args (ArgumentParser.args): command line arguments from main
+        Returns:
+            all_tests (pd.DataFrame): DataFrame containg the relevant information from all Prompts queried
+        """
+        return self.run_cells(self.sweep_cells('finetuned_set', args), self.sweep_cooldown('finetuned_set', args), args.replicate_workers, args.retries)
+
+    def run_k_feature_tests(self, args):
+        """
+        Runs the tests of the constructions with more than two features, one for each of their features as the salient task
+
+        Args:
+            args (ArgumentParser.args): command line arguments from main
+        Returns:
+            all_tests (pd.DataFrame): DataFrame containg the relevant information from all Prompts queried
+        """
+        return self.run_cells(self.sweep_cells('k_feature', args), self.sweep_cooldown('k_feature', args), args.replicate_workers, args.retries)
+
+    def run_sweep(self, sweep, args):
+        """
+        Runs a sweep by name: one of SWEEPS (see sweep_cells())
+
+        Args:
+            sweep (str): the name of the sweep
+            args (ArgumentParser.args): command line arguments from main
+        Returns:
+            all_tests (pd.DataFrame): DataFrame containg the relevant information from all Prompts queried
+        """
+        return self.run_cells(self.sweep_cells(sweep, args), self.sweep_cooldown(sweep, args), args.replicate_workers, args.retries)
+
+    def sweep_cells(self, sweep, args):
+        """
+        Lists the tests of a sweep by name: one of SWEEPS
+
+        Args:
+            sweep (str): the name of the sweep
+            args (ArgumentParser.args): command line arguments from main
+        Returns:
+            cells (list(dict)): the keyword arguments of run_test() for every test of the sweep
+        """
+        sweeps = {
+            'two_feature': self.two_feature_cells,
+            'two_feature_with_two_set': self.two_feature_with_two_set_cells,
+            'baseline_for_finetuning': self.baseline_for_finetuning_cells,
+            'finetuned_set': self.finetuned_set_cells,
+            'k_feature': self.k_feature_cells
+        }
+
+        if sweep in sweeps:
+            if sweep == 'baseline_for_finetuning' and getattr(args, 'clarifying', False):
+                raise Exception("clarifying runs need a sweep which scores Prompts: baseline_for_finetuning only writes finetuning files")
+            if sweep == 'k_feature' and getattr(args, 'stratified', False):
+                raise Exception("stratified sampling is not supported for the k_feature sweep")
+            cells = sweeps[sweep](args)
+            # reads the Prompts of every cell from a frozen corpus of the same sweep
+            if getattr(args, 'corpus', None):
+                cells = assign_prompt_ids(cells, args.corpus)
+            return cells
 
-        construction_types_map = {
-            'location' : 'subject_location',
-            'subject' :'subject_location',
-            'religious' : 'religious_pronoun',
-            'pronoun' : 'religious_pronoun',
-            'propn' : 'propn_negation',
-            'negation' : 'propn_negation'
+        raise Exception("invalid sweep")
+
+    def sweep_cooldown(self, sweep, args):
+        """
+        Returns the seconds to wait after each test of a sweep in order to not overload API and stay within OpenAI constraints
+        """
+        cooldowns = {
+            'two_feature': 60 if not args.crfm and not args.togethercomputer else 0,
+            'two_feature_with_two_set': 60 if not args.crfm else 0,
+            'baseline_for_finetuning': 0,
+            'finetuned_set': 60,
+            'k_feature': 60 if not args.crfm else 0
         }
 
-        all_tests = pd.DataFrame()
+        if sweep in cooldowns:
+            return cooldowns[sweep]
+
+        raise Exception("invalid sweep")
+
+    def construction_formats(self, args):
+        """
+        Returns the formats for which a sweep generates cells: both formats, or only one in paired mode as each Prompt is then rendered in both formats
+        """
+        if args.paired:
+            return PAIRED_FORMATS[:1]
+        return [args.format_2, args.format_1]
+
+    def two_feature_cells(self, args):
+        """
+        Lists all standard tests which are two-feature tests {'subject_location', 'religious_pronoun', 'propn_negation'}, one for each salient task
+
+        Args:
+            args (ArgumentParser.args): command line arguments from main
+        Returns:
+            cells (list(dict)): the keyword arguments of run_test() for every test of the sweep
+        """
+        cells = []
+        construction_formats_list = self.construction_formats(args)
+        salient_tasks_list = ['subject', 'location', 'religious', 'negation', 'propn', 'pronoun']
+
         for cf in construction_formats_list:
             for st in salient_tasks_list:
-                for _ in range(3): # need loop in order to not overload API and stay within OpenAI constraints
-                    curr_test = self.run_test(
-                        construction_type=construction_types_map[st],
+                for replicate in range(3): # replicates of the cell, run concurrently by run_cells()
+                    cell = dict(
+                        replicate=replicate,
+                        seed=args.replicate_seed,
+                        construction_type=CONSTRUCTION_TYPES_MAP[st],
                         shots=args.shots, 
                         model=args.model, 
                         construction_format=cf, 
@@ -72,32 +291,84 @@ class Tester():
                         prob_of_ambiguous=args.prob_of_ambiguous,
                         togethercomputer=args.togethercomputer,
                         for_finetuning=False, 
-                        finetuning_control=False
+                        finetuning_control=False,
+                        stratified=args.stratified,
+                        query_only=args.query_only,
+                        archive=args.archive,
+                        models=args.models,
+                        paired=args.paired,
+                        clarifying=args.clarifying
                         )
 
-                    all_tests = pd.concat([all_tests, curr_test], ignore_index=True)
-                    if not args.crfm and not args.togethercomputer: time.sleep(60)
+                    cells.append(cell)
         
-        return all_tests
+        return cells
     
-    def run_two_feature_tests_with_two_set(self, args):
+    def k_feature_cells(self, args):
         """
-        Runs all standard tests which are two-feature tests {'subject_location', 'religious_pronoun', 'propn_negation'}
+        Lists the tests of the constructions with more than two features (see feature_schema.K_FEATURE_CONSTRUCTION_TYPES), one for each feature as the salient task
 
         Args:
             args (ArgumentParser.args): command line arguments from main
         Returns:
-            all_tests (pd.DataFrame): DataFrame containg the relevant information from all Prompts queried
+            cells (list(dict)): the keyword arguments of run_test() for every test of the sweep
+        """
+        cells = []
+        construction_formats_list = self.construction_formats(args)
+
+        for cf in construction_formats_list:
+            for ct in K_FEATURE_CONSTRUCTION_TYPES:
+                for st in SCHEMAS[ct].feature_names:
+                    for replicate in range(3): # replicates of the cell, run concurrently by run_cells()
+                        cell = dict(
+                            replicate=replicate,
+                            seed=args.replicate_seed,
+                            construction_type=ct,
+                            shots=args.shots, 
+                            model=args.model, 
+                            construction_format=cf, 
+                            crfm=args.crfm, 
+                            queries=20, 
+                            needs_instruction=args.needs_instruction, 
+                            verbose=args.verbose,
+                            needs_informative=args.needs_informative,
+                            include_ambiguous_examples=args.include_ambiguous_examples,
+                            salient_task=st,
+                            prob_of_ambiguous=args.prob_of_ambiguous,
+                            togethercomputer=args.togethercomputer,
+                            for_finetuning=False, 
+                            finetuning_control=False,
+                            stratified=args.stratified,
+                            query_only=args.query_only,
+                            archive=args.archive,
+                            models=args.models,
+                            paired=args.paired,
+                            clarifying=args.clarifying
+                            )
+
+                        cells.append(cell)
+        
+        return cells
+
+    def two_feature_with_two_set_cells(self, args):
         """
-        all_tests = pd.DataFrame()
+        Lists all standard tests which are two-feature tests {'subject_location', 'religious_pronoun', 'propn_negation'}, one for each construction type
+
+        Args:
+            args (ArgumentParser.args): command line arguments from main
+        Returns:
+            cells (list(dict)): the keyword arguments of run_test() for every test of the sweep
+        """
+        cells = []
         construction_types_list = [args.type_1, args.type_2, args.type_3]
-        construction_formats_list = [args.format_2, args.format_1]
+        construction_formats_list = self.construction_formats(args)
 
-        all_tests = pd.DataFrame()
         for cf in construction_formats_list:
             for ct in construction_types_list:
-                for _ in range(3): # need loop in order to not overload API and stay within OpenAI constraints
-                    curr_test = self.run_test(
+                for replicate in range(3): # replicates of the cell, run concurrently by run_cells()
+                    cell = dict(
+                        replicate=replicate,
+                        seed=args.replicate_seed,
                         construction_type=ct,
                         shots=args.shots, 
                         model=args.model, 
@@ -112,44 +383,39 @@ class Tester():
                         prob_of_ambiguous=args.prob_of_ambiguous,
                         togethercomputer=args.togethercomputer,
                         for_finetuning=False,
-                        finetuning_control=False
+                        finetuning_control=False,
+                        query_only=args.query_only,
+                        archive=args.archive,
+                        models=args.models,
+                        paired=args.paired,
+                        clarifying=args.clarifying
                         )
 
-                    all_tests = pd.concat([all_tests, curr_test], ignore_index=True)
-                    if not args.crfm: time.sleep(60)
+                    cells.append(cell)
         
-        return all_tests
+        return cells
 
-    def run_baseline_tests_for_finetuning(self, args):
+    def baseline_for_finetuning_cells(self, args):
         """
-        Runs all standard tests which are two-feature tests {'subject_location', 'religious_pronoun', 'propn_negation'}
+        Lists the tests generating the finetuning data for the salient tasks which are not withheld
 
         Args    :
             args (ArgumentParser.args): command line arguments from main
         Returns:
-            all_tests (pd.DataFrame): DataFrame containg the relevant information from all Prompts queried
+            cells (list(dict)): the keyword arguments of run_test() for every test of the sweep
         """
-        all_tests = pd.DataFrame()
-        
+        cells = []
         construction_formats_list = [args.format_2, args.format_1]
         salient_tasks_list = ['religious', 'pronoun', 'propn', 'negation']
 
-        construction_types_map = {
-            'location' : 'subject_location',
-            'subject' :'subject_location',
-            'religious' : 'religious_pronoun',
-            'pronoun' : 'religious_pronoun',
-            'propn' : 'propn_negation',
-            'negation' : 'propn_negation'
-        }
-
-        all_tests = pd.DataFrame()
         for cf in construction_formats_list:
             for st in salient_tasks_list:
-                for _ in range(2):
-                    for i in range (3,20): # need loop in order to not overload API and stay within OpenAI constraints
-                        curr_test = self.run_test(
-                            construction_type=construction_types_map[st],
+                for replicate in range(2):
+                    for i in range (3,20):
+                        cell = dict(
+                            replicate=replicate,
+                            seed=args.replicate_seed,
+                            construction_type=CONSTRUCTION_TYPES_MAP[st],
                             shots=i, 
                             model=args.model, 
                             construction_format=cf, 
@@ -163,42 +429,34 @@ class Tester():
                             prob_of_ambiguous=args.prob_of_ambiguous,
                             togethercomputer=args.togethercomputer,
                             for_finetuning=True,
-                            finetuning_control=args.finetuning_control
+                            finetuning_control=args.finetuning_control,
+                            stratified=args.stratified
                             )
 
-                        all_tests = pd.concat([all_tests, curr_test], ignore_index=True)
+                        cells.append(cell)
         
-        return all_tests
+        return cells
 
-    def run_finetuned_set(self, args):
+    def finetuned_set_cells(self, args):
         """
-        Generates finetuning set with two of the six features
+        Lists the tests of the finetuned model on the two withheld features
 
         Args:
             args (ArgumentParser.args): command line arguments from main
         Returns:
-            all_tests (pd.DataFrame): DataFrame containg the relevant information from all Prompts queried
+            cells (list(dict)): the keyword arguments of run_test() for every test of the sweep
         """
-        all_tests = pd.DataFrame()
-        
-        construction_formats_list = [args.format_2, args.format_1]
+        cells = []
+        construction_formats_list = self.construction_formats(args)
         salient_tasks_list = ['propn', 'negation']
 
-        construction_types_map = {
-            'location' : 'subject_location',
-            'subject' :'subject_location',
-            'religious' : 'religious_pronoun',
-            'pronoun' : 'religious_pronoun',
-            'propn' : 'propn_negation',
-            'negation' : 'propn_negation'
-        }
-
-        all_tests = pd.DataFrame()
         for cf in construction_formats_list:
             for st in salient_tasks_list:
-                for _ in range(3): # need loop in order to not overload API and stay within OpenAI constraints
-                    curr_test = self.run_test(
-                        construction_type=construction_types_map[st],
+                for replicate in range(3): # replicates of the cell, run concurrently by run_cells()
+                    cell = dict(
+                        replicate=replicate,
+                        seed=args.replicate_seed,
+                        construction_type=CONSTRUCTION_TYPES_MAP[st],
                         shots=20, 
                         model=args.model, 
                         construction_format=cf, 
@@ -212,10 +470,15 @@ class Tester():
                         prob_of_ambiguous=args.prob_of_ambiguous,
                         togethercomputer=args.togethercomputer,
                         for_finetuning=False,
-                        finetuning_control=False
+                        finetuning_control=False,
+                        stratified=args.stratified,
+                        query_only=args.query_only,
+                        archive=args.archive,
+                        models=args.models,
+                        paired=args.paired,
+                        clarifying=args.clarifying
                         )
 
-                    all_tests = pd.concat([all_tests, curr_test], ignore_index=True)
-                    time.sleep(60)
+                    cells.append(cell)
         
-        return all_tests
\ No newline at end of file
+        return cells
@@ -0,0 +1,12 @@
+import os
+import sys
+import types
+
+# the modules of the repository are imported from its root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# keys.py holds the API keys and is not checked in: tests never send a request, so placeholder keys are enough
+try:
+    import keys
+except ImportError:
+    sys.modules['keys'] = types.SimpleNamespace(OPENAI_API_KEY='test-key', CRFM_API_KEY='test-key')
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+import pytest
+from comparison import compare_conditions, conditions_by
+
+def results(accurate, models=('davinci',)):
+    """
+    Results of one salient task and format for the given models, one row per Prompt (of one example each)
+    """
+    rows = len(accurate)
+    return pd.concat([pd.DataFrame({'salient_task': 'subject', 'format_type': 'arrow', 'example_number': 0, 'construction_type': 'subject_location',
+                                    'shots': 1, 'replicate': 0, 'prompt_id': np.arange(rows), 'model': model, 'accurate': accurate}) for model in models],
+                     ignore_index=True)
+
+def test_paired_comparison():
+    comparison_df = compare_conditions({'a': results([1, 1, 1, 0]), 'b': results([0, 1, 0, 0])}, paired=True, resamples=100, seed=0)
+    assert comparison_df[['n_a', 'n_b', 'mean_a', 'mean_b']].values.tolist() == [[4, 4, 0.75, 0.25]]
+
+def test_paired_comparison_rejects_duplicate_keys():
+    # two models in one condition would pair every row of the other condition with both of them
+    with pytest.raises(Exception, match="must be unique"):
+        compare_conditions({'a': results([1, 1, 1, 0], models=('davinci', 'ada')), 'b': results([0, 1, 0, 0])}, paired=True, resamples=100)
+
+def test_paired_comparison_needs_prompt_id():
+    with pytest.raises(Exception, match="no prompt_id column"):
+        compare_conditions({'a': results([1, 1]).drop(columns='prompt_id'), 'b': results([0, 1]).drop(columns='prompt_id')}, paired=True, resamples=100)
+    # unpaired comparisons do not need it
+    assert len(compare_conditions({'a': results([1, 1]).drop(columns='prompt_id'), 'b': results([0, 1]).drop(columns='prompt_id')}, resamples=100)) == 1
+
+def test_conditions_by_store_column(tmp_path):
+    from result_store import ResultStore
+    store = ResultStore(str(tmp_path / "store"))
+    tests = pd.concat([results([1, 0], models=('davinci', 'ada')), results([1, 1]).assign(salient_task='location', replicate=1)], ignore_index=True)
+    store.write(tests)
+
+    # partition columns select partitions of the store, other columns split the rows read from it
+    for column in ['model', 'salient_task']:
+        conditions = conditions_by(store, column)
+        assert {value: len(condition.read(['accurate'])) for value, condition in conditions.items()} == tests[column].value_counts().to_dict()
+    conditions = conditions_by(store, 'replicate')
+    assert {value: len(condition) for value, condition in conditions.items()} == {0: 4, 1: 2}
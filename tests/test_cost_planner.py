@@ -0,0 +1,19 @@
+import pytest
+from cost_planner import CLARIFYING_MAX_TOKENS, TokenBudgetPlanner, get_tokenizer
+
+def cell(**settings):
+    return dict(dict(construction_type='subject_location', construction_format='arrow', shots=4, salient_task='subject', needs_instruction=False,
+                     needs_informative=False, include_ambiguous_examples=False, prob_of_ambiguous=0.0, for_finetuning=False, finetuning_control=False,
+                     togethercomputer=False, crfm=False, model='gpt-3.5-turbo-instruct', queries=10), **settings)
+
+def test_clarifying_cells_count_the_assertion_and_the_completion():
+    planner = TokenBudgetPlanner(get_tokenizer('approx'), samples=5)
+    plan_df = planner.plan([cell(query_only=True), cell(clarifying=True)])
+    query_only, clarifying = plan_df.to_dict('records')
+
+    assert query_only['completion_tokens'] == 10
+    assert clarifying['completion_tokens'] == 10 * CLARIFYING_MAX_TOKENS
+    # the clarifying assertion precedes the same query prompt
+    assert clarifying['mean_prompt_tokens'] > query_only['mean_prompt_tokens']
+    prompt_tokens = clarifying['total_tokens'] - clarifying['completion_tokens']
+    assert clarifying['cost'] == pytest.approx((prompt_tokens * 0.0015 + clarifying['completion_tokens'] * 0.002) / 1000)
@@ -0,0 +1,56 @@
+import openai
+import pytest
+import credential_pool
+from credential_pool import CredentialPool, classify_error
+
+class FlakyRequest:
+    """
+    A request which fails with the given errors, one per call, and then answers with the key it was sent with
+    """
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.keys = []
+
+    def __call__(self, api_key):
+        self.keys.append(api_key)
+        if self.errors:
+            raise self.errors.pop(0)
+        return api_key
+
+@pytest.fixture(autouse=True)
+def short_quarantines(monkeypatch):
+    monkeypatch.setitem(credential_pool.QUARANTINE_SECONDS, 'rate', 0.05)
+
+def test_classify_error():
+    assert classify_error(openai.error.AuthenticationError("Incorrect API key provided", http_status=401)) == 'auth'
+    assert classify_error(openai.error.APIError("forbidden", http_status=403)) == 'auth'
+    assert classify_error(openai.error.RateLimitError("You exceeded your current quota", http_status=429)) == 'quota'
+    assert classify_error(openai.error.RateLimitError("Rate limit reached", http_status=429)) == 'rate'
+    assert classify_error(openai.error.APIError("slow down", http_status=429)) == 'rate'
+    # statuses and token counts in the text of other errors are not taken for the kind of the error
+    assert classify_error(Exception("This model's maximum context length is 4097 tokens, you requested 4401 tokens")) is None
+    assert classify_error(openai.error.APIError("The server had an error while processing your request", http_status=500)) is None
+
+def test_rate_limited_single_key_waits_and_retries():
+    pool = CredentialPool(['key-1'])
+    request = FlakyRequest([openai.error.RateLimitError("Rate limit reached", http_status=429)] * 3)
+    assert pool.call(request, 10) == 'key-1'
+    assert len(request.keys) == 4
+
+def test_rate_limit_retries_are_bounded():
+    pool = CredentialPool(['key-1', 'key-2'])
+    request = FlakyRequest([openai.error.RateLimitError("Rate limit reached", http_status=429)] * 100)
+    with pytest.raises(openai.error.RateLimitError):
+        pool.call(request, 10)
+    assert len(request.keys) == credential_pool.RATE_LIMIT_RETRIES + 1
+
+def test_auth_failure_moves_to_next_key():
+    pool = CredentialPool(['key-1', 'key-2'])
+    request = FlakyRequest([openai.error.AuthenticationError("Incorrect API key provided", http_status=401)])
+    assert pool.call(request, 10) == 'key-2'
+
+    pool = CredentialPool(['key-1'])
+    request = FlakyRequest([openai.error.AuthenticationError("Incorrect API key provided", http_status=401)])
+    with pytest.raises(openai.error.AuthenticationError):
+        pool.call(request, 10)
+    assert len(request.keys) == 1
@@ -0,0 +1,75 @@
+import threading
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+
+from local_access import LocalLM
+
+class CharTokenizer:
+    """
+    One token per character, so that tests need no tokenizer files
+    """
+    pad_token_id = None
+    eos_token_id = None
+
+    def __call__(self, text):
+        return {'input_ids': [ord(character) % 128 for character in text]}
+
+    def decode(self, token_ids):
+        return ''.join(chr(token_id) for token_id in token_ids)
+
+@pytest.fixture
+def lm():
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(vocab_size=128, n_positions=256, n_embd=32, n_layer=2, n_head=2)
+    return LocalLM(transformers.GPT2LMHeadModel(config), CharTokenizer(), min_shared_prefix=8)
+
+def full_logprobs(lm, text):
+    token_ids = lm.tokenizer(text)['input_ids']
+    with torch.inference_mode():
+        logprobs = torch.log_softmax(lm.model(input_ids=torch.tensor([token_ids])).logits[0].float(), dim=-1)
+    return [None] + [logprobs[j - 1, token_ids[j]].item() for j in range(1, len(token_ids))]
+
+def assert_scores_match(lm, output, text):
+    logprobs = output['choices'][0]['logprobs']
+    assert ''.join(logprobs['tokens']) == text
+    for scored, expected in zip(logprobs['token_logprobs'], full_logprobs(lm, text)):
+        assert (scored is None and expected is None) or scored == pytest.approx(expected, abs=1e-5)
+
+INSTRUCTION = "Output 'X' if the sentence contains a subject.\n"
+
+def test_incremental_extension_matches_full_scoring(lm):
+    lm.score(INSTRUCTION + "The cat is in the house.\n>")
+    text = INSTRUCTION + "The cat is in the house.\n> X\nThe dog is in the park.\n>"
+    assert_scores_match(lm, lm.score(text), text)
+
+def test_cropped_prefix_matches_full_scoring(lm):
+    lm.score(INSTRUCTION + "The cat is in the house.\n> X")
+    text = INSTRUCTION + "The owl is in the forest.\n> Y"
+    assert_scores_match(lm, lm.score(text), text)
+
+def test_batch_matches_full_scoring(lm):
+    texts = ["The cat is in the house.\n> X", "A bear.\n> Y", INSTRUCTION + "The owl is in the forest.\n> Y"]
+    for output, text in zip(lm.score_batch(texts), texts):
+        assert_scores_match(lm, output, text)
+
+def test_concurrent_requests_are_batched(lm):
+    texts = [f"Sentence number {i} is in the house.\n> X" for i in range(6)]
+    lm.batch_seconds = 0.2
+    batches = []
+    score_batch = lm.score_batch
+    lm.score_batch = lambda batch_texts: batches.append(len(batch_texts)) or score_batch(batch_texts)
+
+    outputs = [None] * len(texts)
+    def score(i):
+        outputs[i] = lm.score(texts[i])
+    threads = [threading.Thread(target=score, args=(i,)) for i in range(len(texts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(batches) == len(texts) and len(batches) < len(texts)
+    for output, text in zip(outputs, texts):
+        assert_scores_match(lm, output, text)
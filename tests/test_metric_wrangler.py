@@ -0,0 +1,53 @@
+import pandas as pd
+from example import Example, number_examples
+from metric_wrangler import MetricWrangler
+
+LABELS = [True, False, False, True]
+
+def make_examples(prompt_id):
+    examples = [Example('subject_location', 'arrow', f"Sentence {i}.", label, label, label, 'subject') for i, label in enumerate(LABELS)]
+    number_examples(examples, prompt_id)
+    return examples
+
+def output_df(tokens):
+    """
+    Echoed output of a prompt with an instruction mentioning 'X' and 'Y' followed by the given tokens
+    """
+    tokens = ['Output', ' X', ' or', ' Y', '.'] + tokens
+    top_logprobs = [None] + [{' X': -0.2, ' Y': -1.8} for _ in tokens[1:]]
+    return pd.DataFrame({'tokens': tokens, 'token_logprobs': [None] + [-0.5] * (len(tokens) - 1), 'top_logprobs': top_logprobs})
+
+def prompt_tokens(labels):
+    tokens = []
+    for i, label in enumerate(labels):
+        tokens += ['\n', 'Sentence', f' {i}', '.', '\n', '>', ' X' if label else ' Y']
+    return tokens
+
+def test_aligned_prompt_is_kept():
+    wrangler = MetricWrangler()
+    label_df = wrangler.label_probs(output_df(prompt_tokens(LABELS)), True, prompt_id=7)
+    complete_df = wrangler.construct_test_example_df(make_examples(7), label_df)
+    assert len(complete_df) == len(LABELS)
+    assert complete_df['example_number'].tolist() == [1, 2, 3, 4]
+    assert (complete_df['tokens'].str.strip() == ['X', 'Y', 'Y', 'X']).all()
+    assert wrangler.malformed_prompts == []
+
+def test_shifted_label_rows_drop_the_prompt():
+    wrangler = MetricWrangler()
+    tokens = prompt_tokens(LABELS)
+    # a stray 'X' token in the first sentence shifts every following label row by one
+    tokens.insert(2, ' X')
+    label_df = wrangler.label_probs(output_df(tokens), True, prompt_id=7)
+    assert wrangler.construct_test_example_df(make_examples(7), label_df).empty
+    assert wrangler.malformed_prompts == [7]
+
+def test_shift_with_equal_count_drops_the_prompt():
+    wrangler = MetricWrangler()
+    tokens = prompt_tokens(LABELS)
+    # a stray label token before the first example and a missing one at the end keep the count but misalign every row
+    tokens.insert(2, ' Y')
+    tokens = tokens[:-1]
+    label_df = wrangler.label_probs(output_df(tokens), True, prompt_id=3)
+    assert len(label_df) == len(LABELS)
+    assert wrangler.construct_test_example_df(make_examples(3), label_df).empty
+    assert wrangler.malformed_prompts == [3]
@@ -0,0 +1,19 @@
+import pytest
+from query_pipeline import parse_model_specs
+
+@pytest.mark.parametrize('backend, model', [
+    ('openai', 'davinci'),
+    ('openai', 'davinci:ft-personal-2022-10-01-00-00-00'),
+    ('openai', 'ft:davinci-002:org::abc'),
+    ('lean', 'davinci:ft-personal-2022-10-01-00-00-00'),
+    ('crfm', 'ai21/j1-jumbo'),
+    ('local', 'checkpoints/gpt2'),
+    ('local', 'C:/checkpoints/gpt2:step-100'),
+])
+def test_model_specs_round_trip(backend, model):
+    assert parse_model_specs(f"{backend}:{model}", crfm=False) == [(backend, model)]
+
+def test_models_without_backend():
+    models = "davinci, davinci:ft-personal-2022-10-01-00-00-00,ft:davinci-002:org::abc"
+    assert parse_model_specs(models, crfm=False) == [('openai', 'davinci'), ('openai', 'davinci:ft-personal-2022-10-01-00-00-00'), ('openai', 'ft:davinci-002:org::abc')]
+    assert parse_model_specs("ai21/j1-jumbo", crfm=True) == [('crfm', 'ai21/j1-jumbo')]
@@ -0,0 +1,39 @@
+import random
+import sys
+import types
+import pytest
+from prompt import Prompt
+from response_archive import score_record
+
+@pytest.fixture
+def crfm_client(monkeypatch):
+    # the CRFM client is a local checkout of the benchmarking repository: replaying never sends a request, so empty modules are enough
+    for name in ['src', 'src.common', 'src.common.authentication', 'src.common.perspective_api_request', 'src.common.request',
+                 'src.common.tokenization_request', 'src.proxy', 'src.proxy.accounts', 'proxy', 'proxy.remote_service']:
+        monkeypatch.setitem(sys.modules, name, types.SimpleNamespace(
+            Authentication=None, PerspectiveAPIRequest=None, PerspectiveAPIRequestResult=None, Request=None, RequestResult=None,
+            TokenizationRequest=None, TokenizationRequestResult=None, Account=None, RemoteService=None))
+    monkeypatch.delitem(sys.modules, 'crfm_access', raising=False)
+
+def test_replay_crfm_query_only_record(crfm_client):
+    prompt = Prompt(shots=4, construction_type='subject_location', format_type='arrow', needs_instruction=False, needs_informative=False,
+                    include_ambiguous_examples=False, prob_of_ambiguous=0.0, for_finetuning=False, finetuning_control=False,
+                    salient_task='subject', rng=random.Random(0))
+    query = prompt.get_examples()[-1]
+    record = {
+        'key': 'hash',
+        'cell': {'model': 'ai21/j1-jumbo', 'construction_type': 'subject_location', 'format_type': 'arrow', 'shots': 4,
+                 'salient_task': 'subject', 'needs_instruction': False, 'query_only': True},
+        'backend': 'crfm',
+        'instruction': prompt.get_instruction(),
+        'examples': [e.as_dict() for e in prompt.get_examples()],
+        # a RequestResult as archived: dataclasses.asdict() of the completion and its tokens
+        'response': {'success': True, 'completions': [{'text': ' X', 'logprob': -0.1, 'tokens': [
+            {'text': ' X', 'logprob': -0.1, 'top_logprobs': {' X': -0.1, ' Y': -2.5}}]}]},
+    }
+
+    complete_df = score_record(record)
+    assert len(complete_df) == 1
+    assert complete_df['model'].iloc[0] == 'ai21/j1-jumbo'
+    assert complete_df['example_number'].iloc[0] == query.example_number
+    assert complete_df['accurate'].iloc[0] == query.active_task_label
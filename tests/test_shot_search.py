@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+from shot_search import ShotSearch
+
+def test_search_stops_when_a_round_returns_no_outcomes():
+    rounds = []
+
+    def evaluate(shots, queries):
+        rounds.append(shots)
+        # after the coarse first round every Prompt is dropped (e.g. as malformed)
+        return np.ones(queries) if len(rounds) <= 5 else np.array([])
+
+    result = ShotSearch(evaluate, ci_width=0, seed=0).run()
+    assert result['queries'] == 5 * 4
+    assert result['threshold'] == 3
+
+def test_search_without_outcomes_raises():
+    with pytest.raises(Exception, match="no outcomes"):
+        ShotSearch(lambda shots, queries: np.array([]), seed=0).run()
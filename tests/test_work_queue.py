@@ -0,0 +1,46 @@
+import os
+import time
+import pandas as pd
+from work_queue import WorkQueue, run_worker
+
+def test_expired_leases_count_as_attempts(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.db"), lease_seconds=0.01, max_attempts=2)
+    queue.enqueue('sweep', [{'shots': 1}])
+
+    assert queue.lease('worker-1')[0] == 1
+    time.sleep(0.02)
+    # the second worker takes over the expired lease: the first attempt is used up
+    assert queue.lease('worker-2')[0] == 1
+    time.sleep(0.02)
+    assert queue.lease('worker-3') is None
+    assert queue.counts() == {'failed': 1}
+
+def test_only_the_lease_holder_completes(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.db"), lease_seconds=0.01)
+    queue.enqueue('sweep', [{'shots': 1}])
+    result_path = str(tmp_path / "1.csv")
+
+    queue.lease('worker-1')
+    time.sleep(0.02)
+    queue.lease('worker-2')
+    (tmp_path / "stale.tmp").write_text("stale")
+    assert not queue.complete(1, 'worker-1', str(tmp_path / "stale.tmp"), result_path)
+    assert not os.path.exists(result_path)
+
+    (tmp_path / "new.tmp").write_text("new")
+    assert queue.complete(1, 'worker-2', str(tmp_path / "new.tmp"), result_path)
+    assert open(result_path).read() == "new"
+    assert queue.result_paths() == [result_path]
+
+class FailingTester:
+    def stream_test(self, **cell):
+        yield pd.DataFrame({'shots': [cell['shots']]})
+        raise Exception("the API went away")
+
+def test_failed_cell_leaves_no_temporary_file(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.db"), max_attempts=1)
+    queue.enqueue('sweep', [{'shots': 1}])
+
+    run_worker(queue, FailingTester(), str(tmp_path / "results"), worker='worker-1', poll_seconds=0)
+    assert queue.counts() == {'failed': 1}
+    assert os.listdir(tmp_path / "results") == []
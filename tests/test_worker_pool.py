@@ -0,0 +1,21 @@
+import numpy as np
+import pandas as pd
+from worker_pool import frame_from_shared, frame_to_shared
+
+def test_shared_frame_round_trip():
+    df = pd.DataFrame({
+        'shots': np.arange(4),
+        '%': [0.5, np.nan, 12.25, 99.0],
+        'accurate': [True, False, True, True],
+        'model': ['davinci', 'davinci', None, 'ada'],
+        'missing': [None] * 4,
+        'feature_labels': [['1', '0'], ['0', '0'], None, ['1', '1']],
+        'tokens': pd.Series([1, None, 3, 4], dtype='Int64'),
+        'correct': pd.Series([True, None, False, True], dtype='boolean'),
+        'salient_task': pd.Series(['subject', None, 'location', 'subject'], dtype='string'),
+        'format_type': pd.Categorical(['qa', 'arrow', 'qa', 'qa']),
+        'time': pd.date_range('2022-10-01', periods=4, tz='UTC'),
+    }, index=[7, 3, 5, 1])
+
+    shared = frame_from_shared(frame_to_shared(df))
+    pd.testing.assert_frame_equal(shared, df.reset_index(drop=True))
@@ -0,0 +1,213 @@
+import glob
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import pandas as pd
+from logprob_tensor import LabelLogprobs
+from metric_wrangler import MetricWrangler
+from structured_logging import log
+
+# written by APIAccess.to_togethercomputer(): one record per request, {"request_id", "model", "solution", "example"}
+SOLUTIONS_PATH = "togethercomputer/for_rebuttal_solutions.jsonl"
+# sentencepiece models (such as T0pp) mark a leading space with this character instead of ' '
+SENTENCEPIECE_SPACE = '▁'
+
+class SolutionIndex:
+    """
+    Indexes the exported solutions by request_id in a SQLite file, so that results can be joined to them in chunks
+    without holding every solution in memory
+
+    Attributes:
+        path (str): path of the SQLite file
+        columns (list(str)): the example columns seen in the solutions, in order (feature_labels only if some example has it)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.columns = []
+        self.connection = sqlite3.connect(path)
+        # the index is a scratch file rebuilt on every ingestion
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS solutions (request_id TEXT PRIMARY KEY, model TEXT, solution TEXT, record TEXT, ingested INTEGER DEFAULT 0)")
+        self.connection.execute("CREATE TEMP TABLE chunk (request_id TEXT PRIMARY KEY)")
+
+    def load(self, path, batch_size=10000):
+        """
+        Adds every solution record of a JSON-lines file (a request_id exported twice keeps its first record)
+
+        Returns:
+            (int): the number of records read
+        """
+        columns = dict.fromkeys(self.columns)
+        records = 0
+        batch = []
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                columns.update(dict.fromkeys(record['example']))
+                batch.append((record['request_id'], record['model'], record['solution'], line))
+                if len(batch) == batch_size:
+                    self.insert(batch)
+                    records += len(batch)
+                    batch = []
+        self.insert(batch)
+        self.columns = list(columns)
+        return records + len(batch)
+
+    def insert(self, batch):
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO solutions (request_id, model, solution, record) VALUES (?, ?, ?, ?)", batch)
+
+    def take(self, request_ids):
+        """
+        Returns the solutions of a chunk of request ids which have not been ingested yet, and marks them as ingested
+        (so that a request whose result appears in several result files is only scored once)
+
+        Returns:
+            (list(tuple(str, str, str, str))): the (request_id, model, solution, solution record) of every matched solution
+        """
+        with self.connection:
+            self.connection.execute("DELETE FROM chunk")
+            self.connection.executemany("INSERT OR IGNORE INTO chunk VALUES (?)", ((request_id,) for request_id in request_ids))
+            rows = self.connection.execute("SELECT s.request_id, s.model, s.solution, s.record FROM chunk JOIN solutions s USING (request_id) WHERE s.ingested = 0").fetchall()
+            self.connection.execute("UPDATE solutions SET ingested = 1 WHERE request_id IN (SELECT request_id FROM chunk)")
+        return rows
+
+    def missing(self):
+        return self.connection.execute("SELECT COUNT(*) FROM solutions WHERE ingested = 0").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+def parse_result(line):
+    """
+    Extracts the request id and the top logprobs of the answer from one line of a result file
+
+    The id is read from 'request_id' or 'id', at the top level or in the echoed 'request', and the completion from 'result',
+    'output' or the record itself (['choices'][0]['logprobs'] as in the OpenAI completion format)
+
+    Returns:
+        (tuple(str, dict)): the request id and the top logprobs of the answer (see answer_top_logprobs())
+    """
+    record = json.loads(line)
+    request = record.get('request') or {}
+    request_id = record.get('request_id') or record.get('id') or request.get('request_id')
+    result = record.get('result') or record.get('output') or record
+    return request_id, answer_top_logprobs(result['choices'][0]['logprobs'])
+
+def answer_top_logprobs(logprobs):
+    """
+    Returns the top logprobs of the first generated token which is not only whitespace (for 'qa' prompts, which end with 'A:',
+    the model may generate the space before the label as a token of its own), with sentencepiece spaces replaced by ' '
+    """
+    top_logprobs = logprobs.get('top_logprobs') or [{}]
+    position = 0
+    for i, token in enumerate(logprobs.get('tokens') or []):
+        if token.replace(SENTENCEPIECE_SPACE, ' ').strip():
+            position = i
+            break
+    return {key.replace(SENTENCEPIECE_SPACE, ' '): logprob for key, logprob in (top_logprobs[position] or {}).items()}
+
+def expand_paths(result_paths):
+    """
+    Returns the result files named by a comma-separated list of paths and glob patterns, in order
+    """
+    paths = []
+    for pattern in result_paths.split(','):
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    return paths
+
+def iter_result_chunks(paths, chunk_size):
+    """
+    Yields the parsed lines of the result files in chunks of at most chunk_size {request_id: top logprobs}; unreadable lines
+    are counted and logged instead of stopping the ingestion
+    """
+    chunk = {}
+    unreadable = 0
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    request_id, top_logprobs = parse_result(line)
+                except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+                    unreadable += 1
+                    continue
+                chunk.setdefault(request_id, top_logprobs)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = {}
+    if chunk:
+        yield chunk
+    if unreadable:
+        log(logging.WARNING, 'unreadable result lines skipped', lines=unreadable)
+
+def score_chunk(rows, results, columns):
+    """
+    Scores a chunk of matched results at once, as MetricWrangler.label_query_probs() scores the next-token logprobs of a query
+
+    Args:
+        rows (list(tuple)): the matched solutions (see SolutionIndex.take())
+        results (dict(str, dict)): the top logprobs of the answer of every request id
+        columns (list(str)): the example columns of the result frame
+    Returns:
+        label_df (pd.DataFrame): the example columns, 'tokens', the LOGPROB_COLUMNS, 'accurate', '%' and 'model', as in the frames of
+        QueryPipeline.run_pipeline()
+    """
+    label_df = pd.DataFrame.from_records((json.loads(record)['example'] for _, _, _, record in rows), columns=columns)
+    label_df['tokens'] = [solution.strip() for _, _, solution, _ in rows]
+    label_df['top_logprobs'] = [results[request_id] for request_id, _, _, _ in rows]
+
+    label_logprobs = LabelLogprobs.from_top_logprobs(label_df['tokens'], label_df['top_logprobs'])
+    label_df = MetricWrangler().score_label_rows(label_df, label_logprobs)
+    label_df['model'] = [model for _, model, _, _ in rows]
+    return label_df
+
+def iter_ingested(result_paths, solutions_path=SOLUTIONS_PATH, chunk_size=50000, index_dir=None):
+    """
+    Streams the result files of offline TogetherComputer requests, joins every result to its exported solution by request id
+    and scores it, one chunk at a time: memory is bounded by chunk_size whatever the size of the files, as the solutions are
+    looked up in a SQLite index (written to a temporary directory)
+
+    Results without a solution (or repeating an already scored request id) are skipped, and counted in the final log record
+    together with the solutions left without a result
+
+    Args:
+        result_paths (str): comma-separated paths (or glob patterns) of the result JSON-lines files
+        solutions_path (str): the solutions exported by APIAccess.to_togethercomputer()
+        chunk_size (int): number of result lines scored at a time
+        index_dir (str): directory of the temporary SQLite index (defaults to the system temporary directory)
+    Yields:
+        label_df (pd.DataFrame): the result rows of a chunk (see score_chunk())
+    """
+    with tempfile.TemporaryDirectory(dir=index_dir) as directory:
+        index = SolutionIndex(os.path.join(directory, 'solutions.sqlite'))
+        try:
+            solutions = index.load(solutions_path)
+            results = 0
+            scored = 0
+            for chunk in iter_result_chunks(expand_paths(result_paths), chunk_size):
+                results += len(chunk)
+                rows = index.take(chunk)
+                if rows:
+                    scored += len(rows)
+                    yield score_chunk(rows, chunk, index.columns)
+            log(logging.INFO, 'togethercomputer ingestion', solutions=solutions, results=results, scored=scored, unmatched_results=results - scored, missing_results=index.missing())
+        finally:
+            index.close()
+
+def ingest_results(result_paths, output_path, solutions_path=SOLUTIONS_PATH, chunk_size=50000):
+    """
+    Writes the result rows of iter_ingested() to a CSV file chunk by chunk
+
+    Returns:
+        rows (int): the number of result rows written
+    """
+    rows = 0
+    for label_df in iter_ingested(result_paths, solutions_path, chunk_size):
+        label_df.to_csv(output_path, mode='w' if rows == 0 else 'a', header=rows == 0, index=False)
+        rows += len(label_df)
+    return rows
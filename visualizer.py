@@ -1,20 +1,46 @@
 import seaborn as sns
 import pandas as pd
 import matplotlib.pyplot as plt
+from logprob_tensor import add_scores, load_results
 
 class Visualizer:
     """
     Makes either barplot or lineplots using seaborn to visualize the results of the tests.
     
     Attributes:
-        all_test_df (pd.DataFrame): dataframe containing outputs from all tests to be visualized
+        all_test_df (pd.DataFrame): dataframe containing outputs from all tests to be visualized ('%' and 'accurate' are derived
+            from the logprob columns if they are missing)
         needs_instruction (bool): True if tests required instructions, False otherwise
         
     """
     def __init__(self, all_test_df, needs_instruction):
-        self.all_test_df = all_test_df
+        self.all_test_df = add_scores(all_test_df)
         self.needs_instruction = needs_instruction
 
+    def visualize_paired_format_difference(self, metric='accurate'):
+        """
+        Make a bar plot of the within-pair difference between the formats (arrow - qa) for each salient task, from results of paired
+        mode (see QueryPipeline.run_pipeline()); as both formats score the same Prompts, the sampling noise of the Prompts cancels out
+
+        Args:
+            metric (str): the column to compare: 'accurate' or '%'
+        """
+        paired_df = self.all_test_df.dropna(subset=['pair_id'])
+        paired_df = paired_df.pivot_table(index=['model', 'salient_task', 'pair_id', 'example_number'], columns='format_type', values=metric).dropna().reset_index()
+        paired_df['difference'] = paired_df['arrow'] - paired_df['qa']
+
+        sns.set_theme(style="whitegrid")
+        
+        plot = sns.catplot(
+            data=paired_df, kind="bar",
+            x="salient_task", y="difference", hue="model",
+            ci=95, palette="dark", alpha=.6
+        )
+        plot.despine(left=True)
+        plot.set_axis_labels("Salient Task", f"{metric} (arrow - qa)")
+
+        plt.savefig("")
+
     def visualize_probs(self):
         """
         Make a bar plot of the P(correct answer) across different construction and format types
@@ -54,9 +80,12 @@ class Visualizer:
     def visualize_probs_across_shots(self, tests_df):
         """
         Make a line plot of the probability across different construction and format types
+
+        Args:
+            tests_df (pd.DataFrame or ResultStore): the results; only the plotted columns are read from a ResultStore
         """
         sns.set_theme(style="whitegrid")
-        tests_df = tests_df[['salient_task','format_type', 'example_number','%']]
+        tests_df = load_results(tests_df, ['salient_task','format_type', 'example_number','%'])
         sns.relplot(kind='line', data=tests_df, x='example_number', y='%', hue='format_type', col='salient_task', col_wrap=3)
         
         plt.savefig("")
@@ -64,10 +93,13 @@ class Visualizer:
     def visualize_accuracy_across_shots(self, tests_df):
         """
         Make a line plot of the accuracy across different construction and format types
+
+        Args:
+            tests_df (pd.DataFrame or ResultStore): the results; only the plotted columns are read from a ResultStore
         """
         sns.set_theme(style="whitegrid")
         
-        tests_df = tests_df[['salient_task','format_type', 'example_number', 'accurate']]
+        tests_df = load_results(tests_df, ['salient_task','format_type', 'example_number', 'accurate'])
         sns.relplot(kind='line', data=tests_df, x='example_number', y='accurate', hue='format_type', col='salient_task', col_wrap=3)
     
         plt.savefig("")
@@ -79,33 +111,26 @@ class Visualizer:
         Parameters:
             heldout_task_1 (str): first task heldout when finetuing
             heldout_task_2 (str): second task heldout when finetuning
-            d_reg (pd.DataFrame):  DataFrame for davinci 20-examples test (task disambiguation using multiple examples)
-            d_i (pd.DataFrame): DataFrame for text-davinci-002 20-examples test (task disambiguation using multiple examples)
-            control (pd.DataFrame): DataFrame from control finetuning test 
-            ambig (pd.DataFrame): DataFrame from ambiguous finetuning test 
+            d_reg (pd.DataFrame or ResultStore):  DataFrame for davinci 20-examples test (task disambiguation using multiple examples)
+            d_i (pd.DataFrame or ResultStore): DataFrame for text-davinci-002 20-examples test (task disambiguation using multiple examples)
+            control (pd.DataFrame or ResultStore): DataFrame from control finetuning test 
+            ambig (pd.DataFrame or ResultStore): DataFrame from ambiguous finetuning test 
         Returns:
             None
         """
 
         a = heldout_task_1 
         b = heldout_task_2
+        columns = ['salient_task','format_type', 'example_number', 'accurate']
     
-        davinci_regular = d_reg
-        davinci_instruct = d_i
-        two_feature_alternating = ambig
-        one_feature_alternating = control
-        two_feature_alternating['Model'] = 'davinci finetuned (ambiguous)'
-        one_feature_alternating['Model'] = 'davinci finetuned (control)'
-        davinci_regular['Model'] = 'davinci'
-        davinci_instruct['Model'] = 'text-davinci-002'
-
-        selected_models = pd.concat([davinci_instruct, davinci_regular])
-        selected_models = selected_models[(selected_models['salient_task'] == a) | (selected_models['salient_task'] == b)]
+        davinci_regular = load_results(d_reg, columns, salient_tasks=[a, b]).assign(Model='davinci')
+        davinci_instruct = load_results(d_i, columns, salient_tasks=[a, b]).assign(Model='text-davinci-002')
+        two_feature_alternating = load_results(ambig, columns).assign(Model='davinci finetuned (ambiguous)')
+        one_feature_alternating = load_results(control, columns).assign(Model='davinci finetuned (control)')
 
         sns.set_theme(style='darkgrid')
-        selected_models = pd.concat([selected_models, one_feature_alternating, two_feature_alternating])
+        selected_models = pd.concat([davinci_instruct, davinci_regular, one_feature_alternating, two_feature_alternating])
         selected_models = selected_models.reset_index(drop=True)
-        selected_models = selected_models[['salient_task','format_type', 'example_number', 'accurate', 'Model']]
         plot = sns.lineplot(data=selected_models, x='example_number', y='accurate', hue='Model', palette='rocket')
         plt.ylim(0, 1.0)
         plot.set(xlabel="Example Number", ylabel="Accuracy")
@@ -0,0 +1,240 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+import pandas as pd
+
+class WorkQueue:
+    """
+    A durable queue of sweep cells (the keyword arguments of Tester.run_test()) stored in a SQLite database
+
+    A coordinator enqueues the cells of a sweep once; any number of worker processes, on one machine or on several hosts
+    sharing the database file, then lease cells, run them and mark them done. A lease expires if its worker does not renew it
+    (e.g. because the worker died), after which the cell can be leased again, so every cell is run at least once; an expired
+    lease counts as a failed attempt, so a cell which keeps killing its workers ends up failed. Results are written to one file
+    per cell, named after the cell id, which only the worker holding the lease may put in place (see complete()).
+
+    Note that SQLite relies on file locks, which some network filesystems do not implement correctly; on such storage
+    give each host its own copy of the results directory and only share the database over a filesystem with working locks.
+
+    Attributes:
+        path (str): path of the SQLite database
+        lease_seconds (int): how long a lease lasts before another worker may take over the cell
+        max_attempts (int): number of failed runs (or expired leases) after which a cell is marked as failed instead of being retried
+    """
+    def __init__(self, path, lease_seconds=1800, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        with closing(self.connect()) as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS cells (
+                    id INTEGER PRIMARY KEY,
+                    sweep TEXT NOT NULL,
+                    cell TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    result_path TEXT
+                )""")
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        connection.execute("PRAGMA busy_timeout = 60000")
+        return connection
+
+    def enqueue(self, sweep, cells):
+        """
+        Adds the cells of a sweep to the queue
+
+        Args:
+            sweep (str): the name of the sweep the cells belong to
+            cells (list(dict)): the keyword arguments of Tester.run_test() for every cell
+        Returns:
+            None
+        """
+        with closing(self.connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany("INSERT INTO cells (sweep, cell) VALUES (?, ?)", [(sweep, json.dumps(cell)) for cell in cells])
+            connection.execute("COMMIT")
+
+    def lease(self, worker):
+        """
+        Leases the next cell which is pending or whose lease has expired; taking over an expired lease counts as an attempt, and a
+        cell whose lease expired on its last attempt is marked as failed instead
+
+        Args:
+            worker (str): the id of the worker taking the lease
+        Returns:
+            (tuple(int, dict)): the id and keyword arguments of the leased cell, or None if no cell can be leased right now
+        """
+        now = time.time()
+        with closing(self.connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("""
+                UPDATE cells SET attempts = attempts + 1, error = 'lease expired', lease_expires = NULL, status = 'failed'
+                WHERE status = 'leased' AND lease_expires < ? AND attempts + 1 >= ?""", (now, self.max_attempts))
+            row = connection.execute("""
+                SELECT id, cell FROM cells
+                WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?)
+                ORDER BY id LIMIT 1""", (now,)).fetchone()
+            if row is None:
+                connection.execute("COMMIT")
+                return None
+
+            connection.execute("""
+                UPDATE cells SET attempts = attempts + CASE WHEN status = 'leased' THEN 1 ELSE 0 END,
+                    error = CASE WHEN status = 'leased' THEN 'lease expired' ELSE error END,
+                    status = 'leased', worker = ?, lease_expires = ?
+                WHERE id = ?""", (worker, now + self.lease_seconds, row[0]))
+            connection.execute("COMMIT")
+        return row[0], json.loads(row[1])
+
+    def renew(self, cell_id, worker):
+        """
+        Extends the lease on a cell, as long as the worker still holds it
+
+        Returns:
+            (bool): True if the lease was extended, False if another worker has taken over the cell
+        """
+        with closing(self.connect()) as connection:
+            cursor = connection.execute("UPDATE cells SET lease_expires = ? WHERE id = ? AND status = 'leased' AND worker = ?", (time.time() + self.lease_seconds, cell_id, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, cell_id, worker, temporary_path, result_path):
+        """
+        Marks a cell as done and moves its result from temporary_path to result_path, as long as the worker still holds the lease
+        (the move happens while the database is locked, so a worker whose lease expired cannot overwrite the result of the next one)
+
+        Returns:
+            (bool): True if the cell was completed, False if another worker has taken over the cell
+        """
+        with closing(self.connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            cursor = connection.execute("UPDATE cells SET status = 'done', lease_expires = NULL, result_path = ? WHERE id = ? AND status = 'leased' AND worker = ?",
+                                        (result_path, cell_id, worker))
+            if cursor.rowcount != 1:
+                connection.execute("ROLLBACK")
+                return False
+            try:
+                os.replace(temporary_path, result_path)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        return True
+
+    def fail(self, cell_id, worker, error):
+        """
+        Releases a cell after a failed run: the cell becomes pending again unless it has failed max_attempts times
+        """
+        with closing(self.connect()) as connection:
+            connection.execute("""
+                UPDATE cells SET attempts = attempts + 1, error = ?, lease_expires = NULL,
+                    status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END
+                WHERE id = ? AND status = 'leased' AND worker = ?""", (error, self.max_attempts, cell_id, worker))
+
+    def counts(self):
+        """
+        Returns:
+            (dict): the number of cells in each status ('pending', 'leased', 'done', 'failed')
+        """
+        with closing(self.connect()) as connection:
+            return dict(connection.execute("SELECT status, COUNT(*) FROM cells GROUP BY status").fetchall())
+
+    def result_paths(self):
+        with closing(self.connect()) as connection:
+            return [row[0] for row in connection.execute("SELECT result_path FROM cells WHERE status = 'done' ORDER BY id")]
+
+class LeaseKeeper(threading.Thread):
+    """
+    Renews a worker's lease in the background while a cell is running
+    """
+    def __init__(self, queue, cell_id, worker):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.cell_id = cell_id
+        self.worker = worker
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.queue.lease_seconds / 3):
+            if not self.queue.renew(self.cell_id, self.worker):
+                return
+
+    def stop(self):
+        self.stopped.set()
+
+def run_worker(queue, tester, results_dir, worker=None, cooldown=0, poll_seconds=30):
+    """
+    Leases cells from the queue and runs them with Tester.stream_test() until every cell is done or failed
+
+    Each result is written to results_dir/<cell id>.csv through a temporary file, so a result file is either complete or absent;
+    the temporary file is removed whether or not the cell completes
+
+    Args:
+        queue (WorkQueue): the queue to work on
+        tester (Tester): the Tester used to run the cells
+        results_dir (str): directory (shared between the workers) in which the result of every cell is written
+        worker (str): the id of this worker (defaults to host name, process id and a random suffix)
+        cooldown (int): seconds to wait after each cell in order to stay within the rate limits of the API key used by this worker
+        poll_seconds (int): seconds to wait before checking again when the remaining cells are all leased by other workers
+    Returns:
+        None
+    """
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    os.makedirs(results_dir, exist_ok=True)
+
+    while True:
+        leased = queue.lease(worker)
+        if leased is None:
+            counts = queue.counts()
+            if counts.get('pending', 0) + counts.get('leased', 0) == 0:
+                return
+            time.sleep(poll_seconds)
+            continue
+
+        cell_id, cell = leased
+        lease_keeper = LeaseKeeper(queue, cell_id, worker)
+        lease_keeper.start()
+        result_path = os.path.join(results_dir, f"{cell_id}.csv")
+        temporary_path = f"{result_path}.{worker}.tmp"
+        try:
+            if os.path.exists(temporary_path): os.remove(temporary_path)
+
+            # appends the rows of each Prompt as they arrive, so a worker holds one Prompt in memory rather than the whole cell
+            written = 0
+            for prompt_df in tester.stream_test(**cell):
+                prompt_df.index = range(written, written + len(prompt_df))
+                prompt_df.to_csv(temporary_path, mode='a', header=written == 0)
+                written += len(prompt_df)
+            if not written:
+                pd.DataFrame().to_csv(temporary_path)
+
+            queue.complete(cell_id, worker, temporary_path, result_path)
+        except Exception as e:
+            queue.fail(cell_id, worker, repr(e))
+        finally:
+            lease_keeper.stop()
+            if os.path.exists(temporary_path): os.remove(temporary_path)
+
+        if cooldown: time.sleep(cooldown)
+
+def collect_results(queue):
+    """
+    Concatenates the results of every cell which is done
+
+    Args:
+        queue (WorkQueue): the queue whose results to collect
+    Returns:
+        all_tests (pd.DataFrame): DataFrame containg the relevant information from all Prompts queried
+    """
+    result_dfs = [pd.read_csv(path, index_col=0) for path in queue.result_paths()]
+    return pd.concat(result_dfs, ignore_index=True) if result_dfs else pd.DataFrame()
@@ -0,0 +1,176 @@
+import atexit
+import os
+import pickle
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+import pandas as pd
+
+# every array in a shared memory block starts at a multiple of this many bytes
+ALIGNMENT = 8
+
+def frame_to_shared(df):
+    """
+    Copies a frame into one shared memory block, so that it can be handed to another process without pickling it
+
+    Numeric and bool columns are stored as their NumPy arrays; object columns of strings (with missing values) as the int32 code
+    of every row and the UTF-8 bytes of the distinct strings, separated by NUL; any other column (e.g. lists of feature labels,
+    or a nullable extension dtype such as Int64 or string) is pickled on its own, as the array of the column so that its dtype
+    is restored. The index of the frame is not kept.
+
+    Args:
+        df (pd.DataFrame): the frame to share
+    Returns:
+        descriptor (dict): the name of the block and the layout of every column (see frame_from_shared())
+    """
+    columns = []
+    arrays = []
+    for column in df.columns:
+        values = df[column]
+        if isinstance(values.dtype, np.dtype) and values.dtype.kind in 'biufcmM':
+            kind, parts = 'numeric', [np.ascontiguousarray(values.to_numpy())]
+        else:
+            kind = 'pickle'
+            if values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) in ('string', 'empty'):
+                # dictionary encoded: result columns repeat a few distinct strings (models, tasks, constructions)
+                codes, uniques = pd.factorize(values)
+                if not any('\0' in unique for unique in uniques):
+                    kind, parts = 'string', [codes.astype(np.int32), np.frombuffer('\0'.join(uniques).encode('utf-8'), dtype=np.uint8)]
+            if kind == 'pickle':
+                parts = [np.frombuffer(pickle.dumps(values.array, protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8)]
+        columns.append((column, kind, len(arrays), len(parts)))
+        arrays.extend(parts)
+
+    layout = []
+    size = 0
+    for array in arrays:
+        layout.append((array.dtype.str, len(array), size))
+        size += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        for array, (dtype, length, offset) in zip(arrays, layout):
+            np.ndarray(length, dtype=dtype, buffer=block.buf, offset=offset)[:] = array
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    block.close()
+    # the block now belongs to the process which reads it (and unlinks it): the tracker of this process must not remove it at exit
+    resource_tracker.unregister(block._name, 'shared_memory')
+    return {'name': block.name, 'rows': len(df), 'columns': columns, 'layout': layout}
+
+def frame_from_shared(descriptor):
+    """
+    Rebuilds a frame written by frame_to_shared() and frees its shared memory block
+    """
+    block = shared_memory.SharedMemory(name=descriptor['name'])
+    try:
+        arrays = [np.ndarray(length, dtype=dtype, buffer=block.buf, offset=offset).copy() for dtype, length, offset in descriptor['layout']]
+    finally:
+        block.close()
+        block.unlink()
+
+    data = {}
+    for column, kind, first, count in descriptor['columns']:
+        parts = arrays[first:first + count]
+        if kind == 'numeric':
+            data[column] = parts[0]
+        elif kind == 'string':
+            codes, text = parts
+            uniques = text.tobytes().decode('utf-8').split('\0') if (codes >= 0).any() else []
+            # code -1 (the last element) marks a missing value
+            data[column] = np.array(uniques + [None], dtype=object)[codes]
+        else:
+            data[column] = pickle.loads(parts[0].tobytes())
+    return pd.DataFrame(data, index=pd.RangeIndex(descriptor['rows']), columns=[column for column, _, _, _ in descriptor['columns']])
+
+def run_to_shared(function, *args):
+    return frame_to_shared(function(*args))
+
+def warm_worker():
+    """
+    Prepares a worker process once, before its first task: reseeds it (forked workers would otherwise all draw the same random
+    Prompts) and renders a Prompt of every construction type in every format, so that the generators, instructions and formats
+    (and the modules behind them) are loaded before any task is timed
+    """
+    random.seed()
+    np.random.seed()
+    from api_access import APIAccess
+    from feature_schema import SCHEMAS
+    from prompt import Prompt
+    from query_pipeline import PAIRED_FORMATS
+    for construction_type, schema in SCHEMAS.items():
+        for format_type in PAIRED_FORMATS:
+            prompt = Prompt(shots=1, construction_type=construction_type, format_type=format_type, needs_instruction=True, needs_informative=True,
+                            include_ambiguous_examples=False, prob_of_ambiguous=0.0, for_finetuning=False, finetuning_control=False,
+                            salient_task=schema.feature_names[0])
+            APIAccess(prompt).generate_formatted_prompt(format_type, True, to_togethercomputer=False)
+
+class WorkerPool:
+    """
+    A pool of worker processes started (and warmed, see warm_worker()) once and reused by every CPU stage: scoring archived
+    responses or batch results, and rendering sample prompts when planning a sweep
+
+    A task then only pays for sending its arguments; frames come back through shared memory (see frame_to_shared()) rather than
+    being pickled through the result pipe of the pool, so even the tasks of a 20-query cell are worth sending to a worker.
+
+    Attributes:
+        workers (int): number of worker processes
+        executor (ProcessPoolExecutor): the worker processes
+    """
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count()
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_worker)
+        self.warm()
+
+    def warm(self):
+        # processes are started on demand: one short task per worker starts (and warms) all of them now
+        wait([self.executor.submit(time.sleep, 0.01) for _ in range(self.workers)])
+
+    def map(self, function, *iterables):
+        """
+        Returns function applied to every element of the iterables in the workers, in order (the results are pickled)
+        """
+        return list(self.executor.map(function, *iterables))
+
+    def map_frames(self, function, *iterables):
+        """
+        Returns the frames returned by function for every element of the iterables in the workers, in order, passed back through
+        shared memory; every block is freed even if a task fails
+
+        Args:
+            function (function): a module-level function returning a pd.DataFrame
+        Returns:
+            frames (list(pd.DataFrame)): the frame of every task
+        """
+        futures = [self.executor.submit(run_to_shared, function, *args) for args in zip(*iterables)]
+        frames = []
+        error = None
+        for future in futures:
+            try:
+                descriptor = future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            frames.append(frame_from_shared(descriptor))
+        if error is not None:
+            raise error
+        return frames
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+pool = None
+
+def get_worker_pool(workers=None):
+    """
+    Returns the worker pool of the process, started on first use with workers processes (defaults to the number of CPUs)
+    """
+    global pool
+    if pool is None:
+        pool = WorkerPool(workers)
+        atexit.register(pool.shutdown)
+    return pool